@@ -13,6 +13,12 @@ def create_app(config_class=Config):
 
     db.init_app(app)
     login.init_app(app)
+    _apply_sqlite_pragmas(app)
+
+    # Registers the schema upgrade, the events that keep the search index,
+    # category paths, parsed prices, bid summaries and content versions in sync, and the job handlers
+    from app import schema, search, categories, pricing, jobs, httpcache, usercache, archive, bidding
+    app.jinja_env.globals['request_row'] = httpcache.request_row
 
     from app.routes import bp as main_bp
     app.register_blueprint(main_bp)
@@ -20,4 +26,42 @@ def create_app(config_class=Config):
     from app.admin.routes import bp as admin_bp
     app.register_blueprint(admin_bp)
 
+    from app import api
+    app.register_blueprint(api.bp)
+
+    from app.bulk import import_requests_command
+    app.cli.add_command(import_requests_command)
+    app.cli.add_command(pricing.backfill_prices_command)
+    app.cli.add_command(jobs.run_jobs_command)
+    from app.bootstrap import bootstrap_command
+    app.cli.add_command(bootstrap_command)
+    app.cli.add_command(archive.archive_requests_command)
+    from app import ticker_history
+    app.cli.add_command(ticker_history.ingest_prices_command)
+    app.cli.add_command(api.create_api_token_command)
+    app.cli.add_command(api.revoke_api_token_command)
+
+    from app import metrics
+    metrics.init_app(app)
+
     return app
+
+def precompile_templates(app):
+    """Compile every template now rather than on its first render. Called by wsgi.py
+    in the gunicorn master, so preforked workers share the compiled code."""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+def _apply_sqlite_pragmas(app):
+    pragmas = app.config.get('SQLITE_PRAGMAS')
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return
+
+    @db.event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
@@ -1,18 +1,31 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, SelectField, IntegerField, SubmitField
-from wtforms.validators import DataRequired
+from flask_wtf.file import FileField, FileRequired, FileAllowed
+from wtforms import StringField, SelectField, IntegerField, FloatField, SubmitField
+from wtforms.validators import DataRequired, InputRequired, ValidationError
+from app.categories import parse_fields
 
 class AddCategoryForm(FlaskForm):
     name = StringField('Category Name', validators=[DataRequired()])
     parent_id = SelectField('Parent Category', coerce=int) # Choices populated dynamically
+    schema = StringField('Fields (e.g. Grade, MFI:number)')
     submit = SubmitField('Add')
 
+    def validate_schema(self, schema):
+        try:
+            parse_fields(schema.data)
+        except (ValueError, AttributeError):
+            raise ValidationError('Use "Name, Other:number" or a JSON list of fields.')
+
 class AddTickerForm(FlaskForm):
+    # Records a price point now; the change rate is computed from the history
     name = StringField('Name', validators=[DataRequired()])
-    value = StringField('Value', validators=[DataRequired()])
-    change = StringField('Change', validators=[DataRequired()])
+    value = FloatField('Value', validators=[InputRequired()])
     submit = SubmitField('Add')
 
+class ImportPricesForm(FlaskForm):
+    file = FileField('CSV file (ticker,timestamp,value)', validators=[FileRequired(), FileAllowed(['csv'], 'CSV only')])
+    submit = SubmitField('Import')
+
 class SiteSettingsForm(FlaskForm):
     announcement = StringField('Announcement')
     contact_info = StringField('Contact Info')
@@ -1,25 +1,44 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request
-from app import db
-from app.models import User, Request, CreditTransaction, SiteSetting, Ticker, Category
+import csv
+import io
+import json
+import os
+from flask import Blueprint, render_template, redirect, url_for, flash, request, abort, Response, \
+    stream_with_context, current_app, send_from_directory
+from app import db, jobs
+from app.models import User, Request, CreditTransaction, SiteSetting, Ticker, Category, Job, Notification
 from app.admin.utils import admin_required
-from app.admin.forms import AddCategoryForm, AddTickerForm, SiteSettingsForm, AdminActionForm
-from datetime import datetime
+from app.cache import site_cache
+from app.pagination import keyset_page
+from app.categories import get_category_tree, walk, invalidate as invalidate_categories
+from app import stats, ledger, ticker_history, archive
+from app.metrics import get_metrics
+from app.admin.forms import AddCategoryForm, AddTickerForm, ImportPricesForm, SiteSettingsForm, AdminActionForm
+from datetime import datetime, timedelta
 
 bp = Blueprint('admin', __name__, url_prefix='/admin')
 
+DASHBOARD_RANGES = (7, 30, 90, 365)
+
 @bp.route('/')
 @admin_required
 def index():
-    user_count = User.query.count()
-    request_count = Request.query.count()
-    # Sum of all credit transactions that are positive (purchases)
-    # This is a simplification.
-    volume = db.session.query(db.func.sum(CreditTransaction.amount)).filter(CreditTransaction.amount > 0).scalar() or 0
-    
-    return render_template('admin/dashboard.html', 
-                           user_count=user_count, 
-                           request_count=request_count, 
-                           volume=volume)
+    # Everything here reads the daily_stat rollup, never the base tables
+    days = request.args.get('days', 30, type=int)
+    if days not in DASHBOARD_RANGES:
+        days = 30
+    totals = stats.totals()
+    metrics = (stats.SIGNUPS, stats.REQUESTS, stats.BIDS,
+               stats.CREDITS_PURCHASED, stats.CREDITS_SPENT)
+    labels, series = stats.series(days, metrics)
+
+    return render_template('admin/dashboard.html',
+                           user_count=totals.get(stats.SIGNUPS, 0),
+                           request_count=totals.get(stats.REQUESTS, 0),
+                           bid_count=totals.get(stats.BIDS, 0),
+                           volume=totals.get(stats.CREDITS_PURCHASED, 0) + totals.get(stats.CREDITS_GRANTED, 0),
+                           days=days, ranges=DASHBOARD_RANGES,
+                           labels=[d.isoformat() for d in labels], series=series,
+                           categories=stats.category_totals(days))
 
 @bp.route('/users')
 @admin_required
@@ -32,20 +51,21 @@ def users():
 @admin_required
 def categories():
     form = AddCategoryForm()
-    # Populate parent choices
-    parents = Category.query.filter(Category.parent_id == None).all()
-    form.parent_id.choices = [(0, 'No Parent (Top Level)')] + [(c.id, c.name) for c in parents]
+    tree = get_category_tree()
+    # Any node can be a parent; indent by depth so the hierarchy shows in the dropdown
+    form.parent_id.choices = [(0, 'No Parent (Top Level)')] + \
+        [(c['id'], '— ' * c['depth'] + c['name']) for c in walk(tree)]
     
     if form.validate_on_submit():
         parent_id = form.parent_id.data if form.parent_id.data != 0 else None
-        cat = Category(name=form.name.data, parent_id=parent_id)
+        cat = Category(name=form.name.data, parent_id=parent_id, schema=form.schema.data or None)
         db.session.add(cat)
+        invalidate_categories()
         db.session.commit()
         flash('Category added.')
         return redirect(url_for('admin.categories'))
             
-    categories = Category.query.all()
-    return render_template('admin/categories.html', categories=categories, form=form)
+    return render_template('admin/categories.html', categories=list(walk(tree)), form=form)
 
 @bp.route('/users/<int:id>/toggle_block', methods=['POST'])
 @admin_required
@@ -78,9 +98,15 @@ def add_credits(id):
     user = db.session.get(User, id)
     amount = request.form.get('amount', type=int)
     if user and amount:
-        user.credits += amount
-        trans = CreditTransaction(user_id=user.id, amount=amount, description="Admin Manual Adjustment")
-        db.session.add(trans)
+        try:
+            ledger.apply(user.id, amount, "Admin Manual Adjustment")
+        except ledger.InsufficientCredits:
+            flash(f'{user.username} only has {user.credits} credits.')
+            return redirect(url_for('admin.users'))
+        if amount > 0:
+            stats.record(stats.CREDITS_GRANTED, amount)
+        else:
+            stats.record(stats.CREDITS_SPENT, -amount)
         db.session.commit()
         flash(f'Added {amount} credits to {user.username}.')
     return redirect(url_for('admin.users'))
@@ -88,9 +114,14 @@ def add_credits(id):
 @bp.route('/requests')
 @admin_required
 def requests():
-    requests = Request.query.order_by(Request.timestamp.desc()).all()
+    history = request.args.get('history') == '1'
+    try:
+        requests, next_cursor = archive.requests_for_admin(history, request.args.get('cursor'))
+    except ValueError:
+        abort(400)
     form = AdminActionForm()
-    return render_template('admin/requests.html', requests=requests, form=form)
+    return render_template('admin/requests.html', requests=requests, next_cursor=next_cursor, form=form,
+                           history=history)
 
 @bp.route('/requests/<int:id>/delete', methods=['POST'])
 @admin_required
@@ -99,6 +130,8 @@ def delete_request(id):
     if form.validate_on_submit():
         req = db.session.get(Request, id)
         if req:
+            # Inbox entries would otherwise point at a request that no longer exists
+            db.session.execute(db.delete(Notification).where(Notification.request_id == req.id))
             db.session.delete(req)
             db.session.commit()
             flash('Request deleted.')
@@ -109,15 +142,30 @@ def delete_request(id):
 def tickers():
     form = AddTickerForm()
     if form.validate_on_submit():
-        ticker = Ticker(name=form.name.data, value=form.value.data, change_rate=form.change.data)
-        db.session.add(ticker)
+        ticker_history.ingest([(form.name.data.strip(), datetime.utcnow(), form.value.data)])
         db.session.commit()
-        flash('Ticker added.')
+        flash('Price recorded.')
         return redirect(url_for('admin.tickers'))
         
     tickers = Ticker.query.all()
     action_form = AdminActionForm()
-    return render_template('admin/tickers.html', tickers=tickers, form=form, action_form=action_form)
+    return render_template('admin/tickers.html', tickers=tickers, form=form, action_form=action_form,
+                           import_form=ImportPricesForm())
+
+@bp.route('/tickers/import', methods=['POST'])
+@admin_required
+def import_prices():
+    form = ImportPricesForm()
+    if form.validate_on_submit():
+        try:
+            count = ticker_history.ingest(ticker_history.read_points(form.file.data.stream))
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e))
+            return redirect(url_for('admin.tickers'))
+        db.session.commit()
+        flash(f'Imported {count} price points.')
+    return redirect(url_for('admin.tickers'))
 
 @bp.route('/tickers/<int:id>/delete', methods=['POST'])
 @admin_required
@@ -126,7 +174,9 @@ def delete_ticker(id):
     if form.validate_on_submit():
         ticker = db.session.get(Ticker, id)
         if ticker:
+            ticker_history.delete_history(ticker.id)
             db.session.delete(ticker)
+            site_cache.invalidate('tickers')
             db.session.commit()
             flash('Ticker deleted.')
     return redirect(url_for('admin.tickers'))
@@ -138,20 +188,167 @@ def settings():
     if not setting:
         setting = SiteSetting()
         db.session.add(setting)
+        site_cache.invalidate('site_setting')
         db.session.commit()
     
     form = SiteSettingsForm(obj=setting)
     if form.validate_on_submit():
         setting.announcement = form.announcement.data
         setting.contact_info = form.contact_info.data
+        site_cache.invalidate('site_setting')
         db.session.commit()
         flash('Settings updated.')
         return redirect(url_for('admin.settings'))
         
     return render_template('admin/settings.html', form=form)
 
+def _parse_day(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        abort(400)
+
+def _transaction_filters(args=None):
+    # Returns (where clauses, active filters) shared by the log view and its exports
+    args = request.args if args is None else args
+    clauses, filters = [], {}
+    username = args.get('user', '').strip()
+    if username:
+        clauses.append(CreditTransaction.user_id.in_(db.select(User.id).where(User.username == username)))
+        filters['user'] = username
+    date_from = _parse_day(args.get('date_from'))
+    if date_from:
+        clauses.append(CreditTransaction.timestamp >= date_from)
+        filters['date_from'] = args['date_from']
+    date_to = _parse_day(args.get('date_to'))
+    if date_to:
+        # Inclusive of the whole end day
+        clauses.append(CreditTransaction.timestamp < date_to + timedelta(days=1))
+        filters['date_to'] = args['date_to']
+    sign = args.get('sign')
+    if sign in ('credit', 'debit'):
+        clauses.append(CreditTransaction.amount > 0 if sign == 'credit' else CreditTransaction.amount < 0)
+        filters['sign'] = sign
+    return clauses, filters
+
 @bp.route('/transactions')
 @admin_required
 def transactions():
-    transactions = CreditTransaction.query.order_by(CreditTransaction.timestamp.desc()).all()
-    return render_template('admin/transactions.html', transactions=transactions)
+    clauses, filters = _transaction_filters()
+    query = CreditTransaction.query.options(db.joinedload(CreditTransaction.user)).filter(*clauses)
+    try:
+        transactions, next_cursor = keyset_page(query, CreditTransaction.timestamp, CreditTransaction.id,
+                                                cursor=request.args.get('cursor'), limit=100)
+    except ValueError:
+        abort(400)
+    return render_template('admin/transactions.html', transactions=transactions,
+                           next_cursor=next_cursor, filters=filters, form=AdminActionForm())
+
+@bp.route('/metrics')
+@admin_required
+def metrics():
+    metrics = get_metrics()
+    if metrics is None:
+        flash('Instrumentation is off. Set METRICS_ENABLED=1 to collect request metrics.')
+        return render_template('admin/metrics.html', endpoints=[], slow_queries=[])
+    with metrics.lock:
+        slow_queries = list(metrics.slow_queries)
+    return render_template('admin/metrics.html', endpoints=metrics.summary(), slow_queries=slow_queries)
+
+EXPORT_COLUMNS = ('id', 'user_id', 'username', 'amount', 'description', 'timestamp')
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+def _export_chunks(clauses, fmt):
+    # Plain column tuples fetched yield_per rows at a time, so memory stays
+    # flat no matter how many ledger rows are exported
+    query = (db.select(CreditTransaction.id, CreditTransaction.user_id, User.username,
+                       CreditTransaction.amount, CreditTransaction.description, CreditTransaction.timestamp)
+             .outerjoin(User, User.id == CreditTransaction.user_id)
+             .where(*clauses)
+             .order_by(CreditTransaction.timestamp, CreditTransaction.id)
+             .execution_options(yield_per=1000))
+    result = db.session.execute(query)
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        for rows in result.partitions():
+            for row in rows:
+                writer.writerow(row[:-1] + (row.timestamp.isoformat() if row.timestamp else '',))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    else:
+        for rows in result.partitions():
+            yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row[:-1] + (
+                row.timestamp.isoformat() if row.timestamp else None,)))) + '\n' for row in rows)
+
+@bp.route('/transactions/export')
+@admin_required
+def export_transactions():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_MIMETYPES:
+        abort(400)
+    clauses, filters = _transaction_filters()
+    return Response(stream_with_context(_export_chunks(clauses, fmt)), mimetype=EXPORT_MIMETYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename=transactions.{fmt}'})
+
+def _export_dir():
+    return current_app.config['EXPORT_DIR'] or os.path.join(current_app.instance_path, 'exports')
+
+@bp.route('/transactions/export/background', methods=['POST'])
+@admin_required
+def export_transactions_background():
+    form = AdminActionForm()
+    fmt = request.form.get('format', 'csv')
+    if fmt not in EXPORT_MIMETYPES:
+        abort(400)
+    if not form.validate_on_submit():
+        return redirect(url_for('admin.transactions'))
+    _, filters = _transaction_filters(request.form)
+    jobs.enqueue('export_transactions', fmt=fmt, filters=filters)
+    db.session.commit()
+    flash('Export queued. It can be downloaded here once it is done.')
+    return redirect(url_for('admin.jobs_list'))
+
+@jobs.handler('export_transactions')
+def export_transactions_job(job, fmt, filters):
+    clauses, _ = _transaction_filters(filters)
+    os.makedirs(_export_dir(), exist_ok=True)
+    filename = f'transactions-{job.id}.{fmt}'
+    # Written under a temporary name so a half-finished file is never served
+    path = os.path.join(_export_dir(), filename)
+    with open(path + '.part', 'w', newline='') as f:
+        for chunk in _export_chunks(clauses, fmt):
+            f.write(chunk)
+    os.replace(path + '.part', path)
+    return filename
+
+@bp.route('/jobs')
+@admin_required
+def jobs_list():
+    recent = Job.query.order_by(Job.id.desc()).limit(100).all()
+    form = AdminActionForm()
+    return render_template('admin/jobs.html', jobs=recent, form=form)
+
+@bp.route('/jobs/<int:id>/download')
+@admin_required
+def download_export(id):
+    job = db.get_or_404(Job, id)
+    if job.kind != 'export_transactions' or job.status != 'done':
+        abort(404)
+    return send_from_directory(_export_dir(), job.result, as_attachment=True)
+
+@bp.route('/jobs/<int:id>/retry', methods=['POST'])
+@admin_required
+def retry_job(id):
+    form = AdminActionForm()
+    if form.validate_on_submit():
+        job = db.get_or_404(Job, id)
+        if job.status == 'failed':
+            job.status, job.attempts, job.run_at, job.finished_at = 'queued', 0, datetime.utcnow(), None
+            db.session.commit()
+            flash(f'Job #{job.id} queued again.')
+    return redirect(url_for('admin.jobs_list'))
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import secrets
+from datetime import date, datetime
+import click
+from flask import Blueprint, Response, abort, current_app, g, request
+from flask.cli import with_appcontext
+from app import db
+from app.models import User, Request, Bid, RequestAttribute, CreditTransaction, ApiToken
+from app.categories import get_category_tree
+from app.pagination import encode_cursor, decode_cursor
+from app.usercache import user_cache
+
+# Read-only JSON API for integrations, versioned by URL prefix. Clients send
+# "Authorization: Bearer <token>" with a token from `flask create-api-token`;
+# only its SHA-256 digest is stored. Lists are keyset-paginated on
+# (timestamp, id), newest first, like the marketplace, and take:
+#
+#   fields=id,status,...  only these fields (sparse fieldsets)
+#   ids=1,2,3             these rows (up to API_MAX_IDS) instead of a page
+#   cursor=..., limit=n   the next page and its size (up to API_MAX_PAGE_SIZE)
+#   layout=rows           {"fields": [...], "rows": [[...], ...]} instead of
+#                         one object per row, for the smallest payload
+#
+# Handlers select just the requested columns and serialise the row tuples
+# as they come back, so no ORM object is built for a response.
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+REQUEST_FIELDS = {column.key: column for column in (
+    Request.id, Request.user_id, Request.category, Request.sub_category, Request.product_type, Request.spec,
+    Request.origin, Request.application, Request.quantity, Request.quantity_amount, Request.quantity_unit,
+    Request.product_status, Request.customs_status, Request.packaging, Request.deadline, Request.status,
+    Request.details, Request.timestamp, Request.updated_at, Request.bid_count, Request.price_min,
+    Request.price_max, Request.price_median, Request.last_bid_at)}
+# Loaded with one extra query per page, only when asked for
+REQUEST_EXTRA_FIELDS = ('attributes',)
+REQUEST_FILTERS = ('category', 'sub_category', 'origin', 'status')
+
+BID_FIELDS = {column.key: column for column in (
+    Bid.id, Bid.request_id, Bid.seller_id, Bid.price, Bid.price_amount, Bid.price_currency, Bid.price_unit,
+    Bid.price_normalized, Bid.status, Bid.details, Bid.timestamp)}
+BID_FIELDS['seller'] = User.username.label('seller')
+
+LEDGER_FIELDS = {column.key: column for column in (
+    CreditTransaction.id, CreditTransaction.amount, CreditTransaction.description, CreditTransaction.timestamp)}
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _json(payload, status=200):
+    def default(value):
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        raise TypeError(f'{type(value).__name__} is not JSON serializable')
+    return Response(json.dumps(payload, separators=(',', ':'), default=default), status,
+                    mimetype='application/json')
+
+def _error(status, message):
+    abort(_json({'error': message}, status))
+
+@bp.before_request
+def authenticate():
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    user = None
+    if scheme.lower() == 'bearer' and token.strip():
+        user_id = db.session.scalar(db.select(ApiToken.user_id).where(ApiToken.token_hash == hash_token(token.strip())))
+        user = user_cache.get(user_id) if user_id else None
+    if not user or user['is_blocked']:
+        response = _json({'error': 'A valid API token is required.'}, 401)
+        response.headers['WWW-Authenticate'] = 'Bearer'
+        return response
+    g.api_user = user
+
+def _field_names(available, default):
+    wanted = request.args.get('fields')
+    if not wanted:
+        return list(default)
+    names = list(dict.fromkeys(name.strip() for name in wanted.split(',') if name.strip()))
+    unknown = [name for name in names if name not in available]
+    if unknown or not names:
+        _error(400, f'Unknown fields: {", ".join(unknown)}' if unknown else 'No fields given.')
+    return names
+
+def _ids():
+    try:
+        ids = [int(id) for id in request.args['ids'].split(',') if id.strip()]
+    except ValueError:
+        _error(400, 'ids must be a comma-separated list of integers.')
+    if not ids or len(ids) > current_app.config['API_MAX_IDS']:
+        _error(400, f'Give between 1 and {current_app.config["API_MAX_IDS"]} ids.')
+    return list(dict.fromkeys(ids))
+
+def _listing(query, id_col, ts_col, columns, names, extra=None):
+    """Run `query` for a page, or for ?ids=, and build the response payload.
+
+    `query` selects id_col and ts_col first, then columns[name] for each of
+    `names` found in `columns`; the remaining names are looked up in `extra`,
+    {name: function(ids) -> {id: value}}.
+    """
+    selected = [name for name in names if name in columns]
+    if 'ids' in request.args:
+        ids = _ids()
+        found = {row[0]: row for row in db.session.execute(query.where(id_col.in_(ids)))}
+        rows = [found[id] for id in ids if id in found]
+        meta = {'missing': [id for id in ids if id not in found]}
+    else:
+        config = current_app.config
+        limit = request.args.get('limit', config['API_PAGE_SIZE'], type=int)
+        limit = min(max(limit, 1), config['API_MAX_PAGE_SIZE'])
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                ts, last_id = decode_cursor(cursor)
+            except ValueError:
+                _error(400, 'Invalid cursor.')
+            query = query.where(db.or_(ts_col < ts, db.and_(ts_col == ts, id_col < last_id)))
+        rows = db.session.execute(query.order_by(ts_col.desc(), id_col.desc()).limit(limit + 1)).all()
+        meta = {'next_cursor': None}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            meta['next_cursor'] = encode_cursor(rows[-1][1], rows[-1][0])
+
+    # Each field is either a position in the row tuple or a lookup by id
+    position = {name: i + 2 for i, name in enumerate(selected)}
+    looked_up = {name: extra[name]([row[0] for row in rows]) for name in names if name not in position}
+    def values(row):
+        return [row[position[name]] if name in position else looked_up[name].get(row[0]) for name in names]
+
+    if request.args.get('layout') == 'rows':
+        return {'fields': names, 'rows': [values(row) for row in rows], **meta}
+    return {'items': [dict(zip(names, values(row))) for row in rows], **meta}
+
+def _attributes(request_ids):
+    found = {id: {} for id in request_ids}
+    if request_ids:
+        rows = db.session.execute(db.select(RequestAttribute.request_id, RequestAttribute.name,
+                                            RequestAttribute.value_text)
+                                  .where(RequestAttribute.request_id.in_(request_ids)))
+        for request_id, name, value in rows:
+            found[request_id][name] = value
+    return found
+
+@bp.route('/requests')
+def requests():
+    names = _field_names((*REQUEST_FIELDS, *REQUEST_EXTRA_FIELDS), REQUEST_FIELDS)
+    query = db.select(Request.id, Request.timestamp, *(REQUEST_FIELDS[n] for n in names if n in REQUEST_FIELDS))
+    query = query.where(*(REQUEST_FIELDS[key] == request.args[key] for key in REQUEST_FILTERS if request.args.get(key)))
+    if request.args.get('mine') == '1':
+        query = query.where(Request.user_id == g.api_user['id'])
+    return _json(_listing(query, Request.id, Request.timestamp, REQUEST_FIELDS, names, {'attributes': _attributes}))
+
+@bp.route('/bids')
+def bids():
+    names = _field_names(BID_FIELDS, BID_FIELDS)
+    query = db.select(Bid.id, Bid.timestamp, *(BID_FIELDS[n] for n in names))
+    if 'seller' in names:
+        query = query.outerjoin(User, User.id == Bid.seller_id)
+    request_id = request.args.get('request_id', type=int)
+    if request_id:
+        query = query.where(Bid.request_id == request_id)
+    if request.args.get('mine') == '1':
+        query = query.where(Bid.seller_id == g.api_user['id'])
+    return _json(_listing(query, Bid.id, Bid.timestamp, BID_FIELDS, names))
+
+@bp.route('/categories')
+def categories():
+    return _json({'items': get_category_tree()})
+
+@bp.route('/ledger')
+def ledger():
+    # Only the caller's own transactions, along ix_credit_transaction_user_log
+    names = _field_names(LEDGER_FIELDS, LEDGER_FIELDS)
+    query = (db.select(CreditTransaction.id, CreditTransaction.timestamp, *(LEDGER_FIELDS[n] for n in names))
+             .where(CreditTransaction.user_id == g.api_user['id']))
+    payload = _listing(query, CreditTransaction.id, CreditTransaction.timestamp, LEDGER_FIELDS, names)
+    return _json({'balance': g.api_user['credits'], **payload})
+
+@click.command('create-api-token')
+@click.argument('username')
+@click.option('--name', help='What the token is for, e.g. "erp".')
+@with_appcontext
+def create_api_token_command(username, name):
+    """Create an API token for USERNAME and print it; it is not shown again."""
+    user_id = db.session.scalar(db.select(User.id).where(User.username == username))
+    if user_id is None:
+        raise click.ClickException(f'No user named {username}.')
+    token = secrets.token_urlsafe(32)
+    db.session.add(ApiToken(user_id=user_id, name=name, token_hash=hash_token(token)))
+    db.session.commit()
+    click.echo(token)
+
+@click.command('revoke-api-token')
+@click.argument('token')
+@with_appcontext
+def revoke_api_token_command(token):
+    """Revoke an API token."""
+    deleted = db.session.execute(db.delete(ApiToken).where(ApiToken.token_hash == hash_token(token))).rowcount
+    db.session.commit()
+    click.echo('Token revoked.' if deleted else 'No such token.')
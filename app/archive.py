@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db, jobs, search, httpcache
+from app.pagination import keyset_page
+from app.models import User, Request, Bid, Notification, RequestAttribute, ArchivedRequest, ArchivedBid, \
+    ArchivedRequestAttribute
+
+# Requests that are no longer open, and have had no activity for
+# ARCHIVE_AFTER_DAYS, move with their bids and attributes into the
+# archived_* tables so the live tables (and their indexes) only grow with
+# current business. Each batch is copied and deleted in one transaction,
+# keeping its ids, so nothing is lost or duplicated if the run stops half
+# way. Inbox notifications stay where they are and are pointed at the
+# archived request. Views that offer history read both the live and the
+# archive tables.
+
+def archivable(cutoff):
+    return db.and_(Request.status != 'Open', db.func.coalesce(Request.updated_at, Request.timestamp) < cutoff)
+
+def _reuses_ids(connection, table):
+    # Without AUTOINCREMENT SQLite gives a new row max(id) + 1, which would be
+    # the id of an archived row once the newest one is moved
+    if connection.dialect.name != 'sqlite':
+        return False
+    sql = connection.scalar(db.text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                            {'name': table.name})
+    return 'AUTOINCREMENT' not in (sql or '').upper()
+
+def _keep_newest(connection):
+    """Condition keeping the newest request and bid live in tables created before AUTOINCREMENT."""
+    keep = []
+    if _reuses_ids(connection, Request.__table__):
+        keep.append(Request.id < db.select(db.func.max(Request.id)).scalar_subquery())
+    if _reuses_ids(connection, Bid.__table__):
+        newest_bid = db.select(db.func.max(Bid.id)).scalar_subquery()
+        keep.append(Request.id.not_in(db.select(Bid.request_id).where(Bid.id == newest_bid)))
+    return db.and_(True, *keep)
+
+def _copy(source, target, where, now):
+    # Columns the archive has; the rest of the live row is dropped
+    names = [c.name for c in target.__table__.columns if c.name in source.__table__.columns]
+    select = db.select(*(source.__table__.c[name] for name in names), db.literal(now, db.DateTime)).where(where)
+    return db.insert(target).from_select(names + ['archived_at'], select)
+
+def archive_requests(cutoff=None, batch_size=None):
+    """Move archivable requests and their bids to the archive tables; returns how many requests moved."""
+    config = current_app.config
+    cutoff = cutoff or datetime.utcnow() - timedelta(days=config['ARCHIVE_AFTER_DAYS'])
+    batch_size = batch_size or config['ARCHIVE_BATCH_SIZE']
+    total = 0
+    keep = _keep_newest(db.session.connection())
+    while True:
+        ids = db.session.scalars(db.select(Request.id).where(archivable(cutoff), keep)
+                                 .order_by(Request.id).limit(batch_size)).all()
+        if not ids:
+            return total
+        now = datetime.utcnow()
+        db.session.execute(_copy(Request, ArchivedRequest, Request.id.in_(ids), now))
+        db.session.execute(_copy(Bid, ArchivedBid, Bid.request_id.in_(ids), now))
+        db.session.execute(_copy(RequestAttribute, ArchivedRequestAttribute, RequestAttribute.request_id.in_(ids), now))
+        # Delete only the bids just copied, so one placed meanwhile can never vanish unarchived
+        copied = db.select(ArchivedBid.id).where(ArchivedBid.request_id.in_(ids))
+        for statement in (db.update(Notification).where(Notification.request_id.in_(ids))
+                          .values(archived_request_id=Notification.request_id, request_id=None),
+                          db.delete(Bid).where(Bid.id.in_(copied)),
+                          db.delete(RequestAttribute).where(RequestAttribute.request_id.in_(ids)),
+                          db.delete(Request).where(Request.id.in_(ids))):
+            db.session.execute(statement.execution_options(synchronize_session=False))
+        connection = db.session.connection()
+        search.unindex(connection, ids)
+        httpcache.touch(connection)
+        db.session.commit()
+        total += len(ids)
+
+@jobs.handler('archive_requests')
+def archive_job(job):
+    moved = archive_requests()
+    # Once a day is plenty; the next run waits in the queue so the periodic sweep doesn't add another
+    jobs.enqueue('archive_requests', delay=current_app.config['ARCHIVE_INTERVAL'])
+    db.session.commit()
+    return f'Archived {moved} requests'
+
+# History views page through one UNION ALL of the live and archive tables,
+# newest first, with the same (timestamp, id) cursor as the marketplace, so
+# neither table is ever read whole. Rows are plain tuples carrying the live
+# columns plus archived_at (NULL for live rows).
+
+def _archived_at(model):
+    return model.archived_at if hasattr(model, 'archived_at') else db.cast(db.null(), db.DateTime).label('archived_at')
+
+def _request_select(model, *extra):
+    return db.select(*(model.__table__.c[c.name] for c in Request.__table__.columns), _archived_at(model), *extra)
+
+def _page(selects, cursor, limit):
+    rows = (db.union_all(*selects) if len(selects) > 1 else selects[0]).subquery()
+    return keyset_page(db.session.query(rows), rows.c.timestamp, rows.c.id, cursor=cursor, limit=limit)
+
+def requests_for_user(user_id, history=False, cursor=None, limit=20):
+    """(rows, next_cursor) of a user's requests, archived ones too with history.
+
+    Bid counts and prices come from the summary columns kept by app.bidding.
+    Raises ValueError for a bad cursor.
+    """
+    models = (Request, ArchivedRequest) if history else (Request,)
+    return _page([_request_select(m).where(m.user_id == user_id) for m in models], cursor, limit)
+
+def requests_for_admin(history=False, cursor=None, limit=100):
+    """(rows, next_cursor) of all requests with their author's name as author_name."""
+    models = (Request, ArchivedRequest) if history else (Request,)
+    return _page([_request_select(m, User.username.label('author_name')).outerjoin(User, User.id == m.user_id)
+                  for m in models], cursor, limit)
+
+def bids_for_seller(seller_id, history=False, cursor=None, limit=20):
+    """(rows, next_cursor) of a seller's bids with their request's product_type."""
+    pairs = ((Bid, Request), (ArchivedBid, ArchivedRequest)) if history else ((Bid, Request),)
+    return _page([db.select(*(model.__table__.c[c.name] for c in Bid.__table__.columns), _archived_at(model),
+                            request_model.product_type)
+                  .join(request_model, request_model.id == model.request_id).where(model.seller_id == seller_id)
+                  for model, request_model in pairs], cursor, limit)
+
+@click.command('archive-requests')
+@click.option('--days', type=int, help='Archive requests idle this many days (default ARCHIVE_AFTER_DAYS).')
+@click.option('--batch-size', type=int, help='Requests moved per transaction (default ARCHIVE_BATCH_SIZE).')
+@with_appcontext
+def archive_requests_command(days, batch_size):
+    """Move closed requests and their bids to the archive tables."""
+    cutoff = datetime.utcnow() - timedelta(days=days) if days is not None else None
+    click.echo(f'Archived {archive_requests(cutoff, batch_size)} requests.')
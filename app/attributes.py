@@ -0,0 +1,94 @@
+import math
+from app import db
+from app.models import Request, RequestAttribute
+
+# Category-defined request fields (Category.schema, parsed by
+# app.categories.parse_fields) are stored one row per value in
+# request_attribute, keyed by the field key. Number fields also keep the
+# parsed value in value_number, so a marketplace filter such as
+# "MFI between 2 and 5" is a range scan on ix_request_attribute_number
+# rather than parsing strings row by row. Fields whose key is already a
+# Request column (origin, spec, ...) keep using that column.
+
+FILTER_PREFIX = 'attr_'
+REQUEST_COLUMNS = ('product_type', 'spec', 'origin', 'application', 'quantity',
+                   'product_status', 'customs_status', 'packaging')
+
+def extra_fields(fields):
+    """The fields that are not plain Request columns."""
+    return [field for field in fields if field['key'] not in REQUEST_COLUMNS]
+
+def parse_number(value):
+    if isinstance(value, (int, float)):
+        number = float(value)
+    else:
+        text = str(value).strip().replace(' ', '')
+        # Decimal comma, as in "2,5"
+        if ',' in text and '.' not in text:
+            text = text.replace(',', '.')
+        number = float(text)
+    # float() also takes "nan" and "inf", which no range filter or sort can use
+    if not math.isfinite(number):
+        raise ValueError(f'{value!r} is not a finite number')
+    return number
+
+def clean(fields, values):
+    """{key: (value_text, value_number)} for the filled-in fields of {key: raw value}.
+
+    Raises ValueError naming the first field that doesn't fit its type.
+    """
+    cleaned = {}
+    for field in extra_fields(fields):
+        value = values.get(field['key'])
+        text = str(value).strip() if value is not None else ''
+        if not text:
+            continue
+        if len(text) > RequestAttribute.value_text.type.length:
+            raise ValueError(f'{field["name"]} is too long')
+        number = None
+        if field['type'] == 'number':
+            try:
+                number = parse_number(value)
+            except ValueError:
+                raise ValueError(f'{field["name"]} must be a number')
+        cleaned[field['key']] = (text, number)
+    return cleaned
+
+def rows(request_id, cleaned):
+    return [{'request_id': request_id, 'name': key, 'value_text': text, 'value_number': number}
+            for key, (text, number) in cleaned.items()]
+
+def save(all_rows):
+    """Insert attribute rows built by rows(); the caller commits."""
+    if all_rows:
+        db.session.execute(db.insert(RequestAttribute), all_rows)
+
+def filters_from(args):
+    """Request conditions for attr_<key>=text, attr_<key>_min=n and attr_<key>_max=n query args.
+
+    Returns (clauses, applied args). Raises ValueError for a bound that isn't a number.
+    """
+    wanted = {}
+    applied = {}
+    for arg, value in args.items():
+        if not arg.startswith(FILTER_PREFIX) or not value.strip():
+            continue
+        key = arg[len(FILTER_PREFIX):]
+        bound = key[-4:] if key.endswith(('_min', '_max')) else None
+        if bound:
+            key = key[:-4]
+            wanted.setdefault(key, {})[bound] = parse_number(value)
+        else:
+            wanted.setdefault(key, {})['text'] = value.strip()
+        applied[arg] = value
+    clauses = []
+    for key, conditions in wanted.items():
+        match = [RequestAttribute.name == key]
+        if 'text' in conditions:
+            match.append(RequestAttribute.value_text == conditions['text'])
+        if '_min' in conditions:
+            match.append(RequestAttribute.value_number >= conditions['_min'])
+        if '_max' in conditions:
+            match.append(RequestAttribute.value_number <= conditions['_max'])
+        clauses.append(Request.id.in_(db.select(RequestAttribute.request_id).where(*match)))
+    return clauses, applied
@@ -0,0 +1,138 @@
+import statistics
+from collections import defaultdict
+from datetime import datetime
+from flask import current_app
+from sqlalchemy.orm import Session
+from app import db, httpcache
+from app.models import Request, Bid, Notification, ArchivedRequest, ArchivedBid
+from app.pricing import fx_rates, normalize, normalized_price_expression, parse_price
+
+# Every request row carries a summary of its bids (bid_count, price_min,
+# price_max, price_median, last_bid_at) so the marketplace and dashboard
+# read it with the request instead of aggregating bids per row. A bid's
+# price is normalised to BASE_CURRENCY per ton once, at the FX rates of the
+# moment it is placed (Bid.price_normalized). A new bid moves the count,
+# bounds and last time in place with one UPDATE of its request; the median
+# is read off ix_bid_request_normalized with LIMIT/OFFSET into the sorted
+# prices of that one request.
+#
+# Awarding closes a request. A conditional UPDATE moves it from Open (or
+# Closed by its deadline) to Awarded, so of two concurrent awards only one
+# matches; the same transaction marks the winning and losing bids and puts
+# a note in every bidder's inbox.
+
+AWARDED = 'Awarded'
+LOST = 'Lost'
+AWARDABLE = ('Open', 'Closed')
+
+@db.event.listens_for(Session, 'before_flush')
+def _normalize_new_bids(session, flush_context, instances):
+    bids = [obj for obj in session.new if isinstance(obj, Bid) and obj.price_normalized is None]
+    if not bids:
+        return
+    rates = fx_rates(current_app.config['BASE_CURRENCY'])
+    for bid in bids:
+        if bid.price_amount is None:
+            bid.price_amount, bid.price_currency, bid.price_unit = parse_price(bid.price)
+        bid.price_normalized = normalize(bid, rates)
+
+@db.event.listens_for(Session, 'after_flush')
+def _summarize_new_bids(session, flush_context):
+    added = defaultdict(list)
+    for obj in session.new:
+        if isinstance(obj, Bid) and obj.request_id:
+            added[obj.request_id].append(obj)
+    for request_id, bids in added.items():
+        _add_bids(session.connection(), request_id, bids)
+
+def _median(connection, request_id):
+    priced = db.and_(Bid.request_id == request_id, Bid.price_normalized.isnot(None))
+    count = connection.scalar(db.select(db.func.count()).select_from(Bid).where(priced))
+    if not count:
+        return None
+    middle = connection.scalars(db.select(Bid.price_normalized).where(priced).order_by(Bid.price_normalized)
+                                .offset((count - 1) // 2).limit(2 - count % 2)).all()
+    return sum(middle) / len(middle)
+
+def _add_bids(connection, request_id, bids):
+    latest = max(bid.timestamp or datetime.utcnow() for bid in bids)
+    values = {
+        'bid_count': db.func.coalesce(Request.bid_count, 0) + len(bids),
+        'last_bid_at': db.case((db.or_(Request.last_bid_at.is_(None), Request.last_bid_at < latest), latest),
+                               else_=Request.last_bid_at),
+    }
+    prices = [bid.price_normalized for bid in bids if bid.price_normalized is not None]
+    if prices:
+        low, high = min(prices), max(prices)
+        values['price_min'] = db.case((db.or_(Request.price_min.is_(None), Request.price_min > low), low),
+                                      else_=Request.price_min)
+        values['price_max'] = db.case((db.or_(Request.price_max.is_(None), Request.price_max < high), high),
+                                      else_=Request.price_max)
+        values['price_median'] = _median(connection, request_id)
+    connection.execute(db.update(Request).where(Request.id == request_id).values(values))
+
+def summarize(connection, ids, model=Request, bid_model=Bid):
+    """Recompute the bid summary of the given requests (or archived requests) from their bids."""
+    found = {id: {'row_id': id, 'count': 0, 'low': None, 'high': None, 'median': None, 'last': None} for id in ids}
+    rows = connection.execute(db.select(bid_model.request_id, db.func.count(), db.func.max(bid_model.timestamp))
+                              .where(bid_model.request_id.in_(ids)).group_by(bid_model.request_id))
+    for request_id, count, last in rows:
+        found[request_id].update(count=count, last=last)
+    prices = defaultdict(list)
+    rows = connection.execute(db.select(bid_model.request_id, bid_model.price_normalized)
+                              .where(bid_model.request_id.in_(ids), bid_model.price_normalized.isnot(None))
+                              .order_by(bid_model.request_id, bid_model.price_normalized))
+    for request_id, price in rows:
+        prices[request_id].append(price)
+    for request_id, values in prices.items():
+        found[request_id].update(low=values[0], high=values[-1], median=statistics.median(values))
+    table = model.__table__
+    connection.execute(table.update().where(table.c.id == db.bindparam('row_id'))
+                       .values(bid_count=db.bindparam('count'), price_min=db.bindparam('low'),
+                               price_max=db.bindparam('high'), price_median=db.bindparam('median'),
+                               last_bid_at=db.bindparam('last')), list(found.values()))
+
+def backfill_summaries(batch_size=500):
+    """Normalise bid prices and summarise requests written before the summary columns existed."""
+    rates = fx_rates(current_app.config['BASE_CURRENCY'])
+    total = 0
+    for model, bid_model in ((Request, Bid), (ArchivedRequest, ArchivedBid)):
+        while True:
+            ids = db.session.scalars(db.select(model.id).where(model.bid_count.is_(None))
+                                     .order_by(model.id).limit(batch_size)).all()
+            if not ids:
+                break
+            db.session.execute(db.update(bid_model)
+                               .where(bid_model.request_id.in_(ids), bid_model.price_normalized.is_(None))
+                               .values(price_normalized=normalized_price_expression(rates, bid_model))
+                               .execution_options(synchronize_session=False))
+            connection = db.session.connection()
+            summarize(connection, ids, model, bid_model)
+            if model is Request:
+                httpcache.touch(connection, ids)
+            db.session.commit()
+            total += len(ids)
+    return total
+
+def award(req, bid):
+    """Award `bid`, close `req` and notify the bidders; False if the request can't be awarded.
+
+    The caller commits.
+    """
+    now = datetime.utcnow()
+    closed = db.session.execute(
+        db.update(Request).where(Request.id == req.id, Request.status.in_(AWARDABLE))
+        .values(status=AWARDED, updated_at=now).execution_options(synchronize_session=False)).rowcount
+    if not closed:
+        return False
+    db.session.execute(db.update(Bid).where(Bid.request_id == req.id)
+                       .values(status=db.case((Bid.id == bid.id, AWARDED), else_=LOST))
+                       .execution_options(synchronize_session=False))
+    db.session.add(Notification(user_id=bid.seller_id, request_id=req.id,
+                                message=f'Your offer on {req.product_type} was accepted.'))
+    losers = (db.select(Bid.seller_id, db.literal(req.id), db.literal(f'Another offer was chosen for {req.product_type}.'))
+              .where(Bid.request_id == req.id, Bid.seller_id != bid.seller_id).distinct())
+    db.session.execute(db.insert(Notification).from_select(['user_id', 'request_id', 'message'], losers))
+    httpcache.touch(db.session.connection())
+    db.session.expire(req)
+    return True
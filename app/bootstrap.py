@@ -0,0 +1,53 @@
+import time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db, pricing, bidding, stats
+from app.categories import invalidate as invalidate_categories
+from app.models import Category, User
+
+# Everything a fresh or upgraded deployment needs before serving, in one
+# process: create missing tables and columns (create_all also runs the
+# search, stats and category path backfills), parse legacy price text,
+# summarise the bids of older requests, seed the top-level categories and
+# create the admin account. Every step checks
+# first, so boot.sh runs it on each start.
+
+DEFAULT_CATEGORIES = ('Polymers', 'Chemicals', 'Technical', 'Scrap',
+                      'Packaging', 'Machines', 'Services', 'Logistics')
+
+def seed_categories():
+    """Add the default categories to an empty category table; returns how many were added."""
+    if db.session.scalar(db.select(Category.id).limit(1)) is not None:
+        return 0
+    db.session.add_all([Category(name=name) for name in DEFAULT_CATEGORIES])
+    invalidate_categories()
+    db.session.commit()
+    return len(DEFAULT_CATEGORIES)
+
+def ensure_admin(username, email, password):
+    """Create the admin account unless a user of that name exists; True if it was created."""
+    if db.session.scalar(db.select(User.id).where(User.username == username)) is not None:
+        return False
+    user = User(username=username, email=email, is_admin=True, is_seller=True)
+    user.set_password(password)
+    db.session.add(user)
+    stats.record(stats.SIGNUPS)
+    db.session.commit()
+    return True
+
+@click.command('bootstrap')
+@with_appcontext
+def bootstrap_command():
+    """Create or upgrade the schema, backfill, seed categories and create the admin user."""
+    config = current_app.config
+    started = time.perf_counter()
+    db.create_all()
+    bids, requests = pricing.backfill_all()
+    summarised = bidding.backfill_summaries()
+    seeded = seed_categories()
+    created = ensure_admin(config['ADMIN_USERNAME'], config['ADMIN_EMAIL'], config['ADMIN_PASSWORD'])
+    click.echo(f'Schema ready; parsed {bids} bid prices and {requests} request quantities; '
+               f'summarised the bids of {summarised} requests; '
+               f'seeded {seeded} categories; admin user {"created" if created else "already exists"} '
+               f'({time.perf_counter() - started:.2f}s).')
@@ -0,0 +1,149 @@
+import csv
+import io
+from datetime import datetime, date
+import click
+from flask.cli import with_appcontext
+from app import db, search, stats, ledger, jobs, httpcache, attributes
+from app.models import User, Request
+from app.categories import get_category_tree, walk, fields_for, field_key
+from app.pricing import parse_quantity
+
+# Bulk RFQ import: rows from a CSV or XLSX sheet are checked against the same
+# rules as RequestForm plus the category tree, the owner is debited once for
+# every valid row, and the rows go in through Core insert() in chunks rather
+# than one ORM object per row. Columns named after the category's extra
+# fields (e.g. "MFI") become request attributes.
+
+IMPORT_FIELDS = ('category', 'sub_category', 'product_type', 'spec', 'origin', 'application',
+                 'quantity', 'product_status', 'customs_status', 'packaging', 'deadline', 'details')
+REQUIRED_FIELDS = ('category', 'product_type', 'quantity', 'deadline')
+
+def read_rows(stream, filename):
+    """Yield one dict per data row of an uploaded .csv or .xlsx file."""
+    if filename.lower().endswith('.xlsx'):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ValueError('XLSX import needs openpyxl installed; upload a CSV instead.')
+        sheet = load_workbook(stream, read_only=True, data_only=True).active
+        rows = sheet.iter_rows(values_only=True)
+        header = [str(h or '').strip().lower() for h in next(rows, ())]
+        for values in rows:
+            if any(v not in (None, '') for v in values):
+                yield dict(zip(header, values))
+    else:
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        for row in csv.DictReader(text):
+            yield {(k or '').strip().lower(): v for k, v in row.items()}
+
+def _category_tree():
+    # {top-level name: set of every category name beneath it}
+    return {node['name']: {c['name'] for c in walk(node['children'])} for node in get_category_tree()}
+
+def _clean(raw, tree, max_lengths):
+    row = {}
+    for field in IMPORT_FIELDS:
+        value = raw.get(field)
+        if isinstance(value, str):
+            value = value.strip() or None
+        row[field] = value
+    missing = [f for f in REQUIRED_FIELDS if row[f] is None]
+    if missing:
+        raise ValueError(f'missing {", ".join(missing)}')
+    if row['category'] not in tree:
+        raise ValueError(f'unknown category "{row["category"]}"')
+    if row['sub_category'] and tree[row['category']] and row['sub_category'] not in tree[row['category']]:
+        raise ValueError(f'"{row["sub_category"]}" is not a sub category of {row["category"]}')
+
+    deadline = row['deadline']
+    if isinstance(deadline, datetime):
+        row['deadline'] = datetime.combine(deadline.date(), datetime.min.time())
+    elif isinstance(deadline, date):
+        row['deadline'] = datetime.combine(deadline, datetime.min.time())
+    else:
+        try:
+            # fromisoformat is several times cheaper than strptime per row
+            row['deadline'] = datetime.combine(date.fromisoformat(str(deadline)), datetime.min.time())
+        except ValueError:
+            raise ValueError(f'deadline "{deadline}" is not YYYY-MM-DD')
+
+    for field, length in max_lengths.items():
+        if row[field] is not None:
+            row[field] = str(row[field])
+            if len(row[field]) > length:
+                raise ValueError(f'{field} is longer than {length} characters')
+    return row
+
+def import_requests(user_id, rows, chunk_size=1000):
+    """Validate and insert request rows for one buyer.
+
+    Returns (created, errors) where errors is a list of (line number, message)
+    for skipped rows. Raises ledger.InsufficientCredits, inserting nothing, if
+    the buyer can't pay for every valid row. The caller commits.
+    """
+    tree = _category_tree()
+    max_lengths = {f: getattr(Request, f).type.length for f in IMPORT_FIELDS
+                   if getattr(getattr(Request, f).type, 'length', None)}
+    fields = {}
+    valid, values, errors = [], [], []
+    for line, raw in enumerate(rows, start=2):  # line 1 is the header
+        try:
+            row = _clean(raw, tree, max_lengths)
+            kind = (row['category'], row['sub_category'])
+            if kind not in fields:
+                fields[kind] = fields_for(*kind)
+            row_values = attributes.clean(fields[kind], {field_key(k): v for k, v in raw.items() if k})
+        except ValueError as e:
+            errors.append((line, str(e)))
+            continue
+        row['quantity_amount'], row['quantity_unit'] = parse_quantity(row['quantity'])
+        row.update(user_id=user_id, status='Open')
+        valid.append(row)
+        values.append(row_values)
+    if not valid:
+        return 0, errors
+
+    ledger.apply(user_id, -len(valid), f'Bulk import of {len(valid)} requests')
+    # Core insert on the table skips the ORM bulk machinery (and its mapper events)
+    connection = db.session.connection()
+    insert = Request.__table__.insert().returning(Request.__table__.c.id, sort_by_parameter_order=True)
+    for start in range(0, len(valid), chunk_size):
+        chunk = valid[start:start + chunk_size]
+        ids = connection.execute(insert, chunk).scalars().all()
+        search.index_rows(connection, [dict(row, id=id) for row, id in zip(chunk, ids)])
+        attributes.save([attribute for id, row_values in zip(ids, values[start:start + chunk_size])
+                         for attribute in attributes.rows(id, row_values)])
+        jobs.enqueue('notify_sellers', request_ids=ids)
+    httpcache.touch(connection)
+
+    stats.record(stats.REQUESTS, len(valid))
+    stats.record(stats.CREDITS_SPENT, len(valid))
+    per_category = {}
+    for row in valid:
+        per_category[row['category']] = per_category.get(row['category'], 0) + 1
+    for category, count in per_category.items():
+        stats.record(stats.CATEGORY_PREFIX + category, count)
+    return len(valid), errors
+
+@click.command('import-requests')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'username', required=True, help='Username that owns and pays for the requests.')
+@click.option('--chunk-size', default=1000, show_default=True)
+@with_appcontext
+def import_requests_command(path, username, chunk_size):
+    """Bulk-create requests from a CSV or XLSX file."""
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f'No user named {username}')
+    started = datetime.now()
+    with open(path, 'rb') as stream:
+        try:
+            created, errors = import_requests(user.id, read_rows(stream, path), chunk_size)
+        except (ValueError, ledger.InsufficientCredits) as e:
+            db.session.rollback()
+            raise click.ClickException(str(e))
+    db.session.commit()
+    for line, message in errors:
+        click.echo(f'line {line}: {message}', err=True)
+    elapsed = (datetime.now() - started).total_seconds()
+    click.echo(f'Created {created} requests, skipped {len(errors)} rows in {elapsed:.2f}s.')
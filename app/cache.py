@@ -0,0 +1,76 @@
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from flask import current_app
+from app import db
+from app.models import CacheVersion, SiteSetting, Ticker
+
+# Per-worker cache for data that is read on every page but written rarely
+# (site settings, tickers). Each key has a version counter in the
+# cache_version table; a worker trusts its copy for SITE_CACHE_TTL seconds,
+# then re-reads the counter (one primary-key lookup) and reloads only when
+# another worker has bumped it. Admin write paths call invalidate() so the
+# worker that made the change sees it immediately and the rest within the TTL.
+
+class VersionedCache:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        ttl = current_app.config['SITE_CACHE_TTL']
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry and now - entry['checked'] < ttl:
+            return entry['value']
+
+        version = _read_version(key)
+        if entry and entry['version'] == version:
+            entry['checked'] = now
+            return entry['value']
+
+        value = loader()
+        with self._lock:
+            self._entries[key] = {'value': value, 'version': version, 'checked': now}
+        return value
+
+    def invalidate(self, key, connection=None):
+        # Bumps the shared counter inside the caller's transaction; commit to publish it.
+        # Flush-time listeners pass their connection since they can't use the session.
+        connection = connection or db.session.connection()
+        now = datetime.utcnow()
+        bumped = connection.execute(
+            db.update(CacheVersion).where(CacheVersion.name == key)
+            .values(version=CacheVersion.version + 1, updated_at=now)).rowcount
+        if not bumped:
+            connection.execute(db.insert(CacheVersion).values(name=key, version=1, updated_at=now))
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def version(self, key):
+        """Version of the copy last returned by get(key), or None if there isn't one."""
+        entry = self._entries.get(key)
+        return entry['version'] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+def _read_version(key):
+    return db.session.scalar(db.select(CacheVersion.version).where(CacheVersion.name == key)) or 0
+
+def _snapshot(obj):
+    # Detached plain copy so cached values never touch a closed session
+    return SimpleNamespace(**{c.key: getattr(obj, c.key) for c in obj.__table__.columns})
+
+site_cache = VersionedCache()
+
+def get_site_setting():
+    def load():
+        setting = SiteSetting.query.first()
+        return _snapshot(setting) if setting else None
+    return site_cache.get('site_setting', load)
+
+def get_tickers():
+    return site_cache.get('tickers', lambda: [_snapshot(t) for t in Ticker.query.all()])
@@ -0,0 +1,158 @@
+import json
+import re
+from sqlalchemy.orm.attributes import set_committed_value
+from app import db
+from app.cache import site_cache
+from app.models import Category
+
+# The category tree is small and read by every request form, the marketplace
+# filters and the admin page, so it is built once from a single query ordered
+# by materialized path and kept in the per-worker site_cache. Admin writes
+# call invalidate() in their transaction.
+
+CACHE_KEY = 'categories'
+
+FIELD_TYPES = ('text', 'number')
+
+def parse_fields(text):
+    """Typed fields from Category.schema, e.g. "Grade, MFI:number" or the same as a JSON list.
+
+    JSON items may also be objects like {"name": "MFI", "type": "number"}. Each
+    field is a dict of name, key (the attribute name it is stored under) and type.
+    """
+    text = (text or '').strip()
+    if not text:
+        return []
+    items = json.loads(text) if text.startswith('[') else text.split(',')
+    fields = []
+    for item in items:
+        if isinstance(item, dict):
+            name, type = str(item.get('name', '')).strip(), item.get('type') or 'text'
+        else:
+            name, _, type = str(item).partition(':')
+            name, type = name.strip(), type.strip().lower() or 'text'
+        if field_key(name):
+            fields.append({'name': name, 'key': field_key(name),
+                           'type': type if type in FIELD_TYPES else 'text'})
+    return fields
+
+def field_key(name):
+    return re.sub(r'\W+', '_', name.strip().lower()).strip('_')
+
+def parse_schema(text):
+    """Field names from Category.schema."""
+    return [field['name'] for field in parse_fields(text)]
+
+def _build():
+    rows = db.session.execute(
+        db.select(Category.id, Category.name, Category.parent_id, Category.path,
+                  Category.depth, Category.schema).order_by(Category.path)).all()
+    nodes = {}
+    roots = []
+    for row in rows:
+        node = {'id': row.id, 'name': row.name, 'parent_id': row.parent_id, 'path': row.path,
+                'depth': row.depth, 'schema': parse_schema(row.schema), 'fields': parse_fields(row.schema),
+                'children': []}
+        nodes[row.id] = node
+        # Ordered by path, so a parent is always seen before its children
+        parent = nodes.get(row.parent_id)
+        (parent['children'] if parent else roots).append(node)
+    roots.sort(key=lambda n: n['name'])
+    for node in nodes.values():
+        node['children'].sort(key=lambda n: n['name'])
+    return roots
+
+def get_category_tree():
+    """The whole category tree as nested dicts (id, name, path, depth, schema, fields, children)."""
+    return site_cache.get(CACHE_KEY, _build)
+
+def walk(nodes=None):
+    """Depth-first iteration over the tree, parents before children."""
+    for node in get_category_tree() if nodes is None else nodes:
+        yield node
+        yield from walk(node['children'])
+
+def find(name, nodes=None):
+    for node in walk(nodes):
+        if node['name'] == name:
+            return node
+    return None
+
+def fields_for(category, sub_category=None):
+    """Fields a request in `category` must describe: the category's own plus those of the
+    sub category and its ancestors when it is part of the tree. Keys are unique, nearest wins."""
+    node = find(category)
+    if not node:
+        return []
+    chain = [node]
+    sub = find(sub_category, node['children']) if sub_category else None
+    if sub:
+        by_id = {n['id']: n for n in walk(node['children'])}
+        chain += [by_id[int(id)] for id in sub['path'].strip('/').split('/') if int(id) in by_id]
+    fields = {}
+    for n in chain:
+        for field in n['fields']:
+            fields.pop(field['key'], None)
+            fields[field['key']] = field
+    return list(fields.values())
+
+def sub_category_names(category):
+    node = find(category)
+    return [child['name'] for child in walk(node['children'])] if node else []
+
+def invalidate():
+    site_cache.invalidate(CACHE_KEY)
+
+def _path_for(connection, id, parent_id):
+    if parent_id is None:
+        return f'/{id}/', 0
+    parent = connection.execute(db.select(Category.path, Category.depth)
+                                .where(Category.id == parent_id)).first()
+    return f'{parent.path}{id}/', parent.depth + 1
+
+@db.event.listens_for(Category, 'after_insert')
+def _assign_path(mapper, connection, target):
+    path, depth = _path_for(connection, target.id, target.parent_id)
+    connection.execute(db.update(Category).where(Category.id == target.id).values(path=path, depth=depth))
+    set_committed_value(target, 'path', path)
+    set_committed_value(target, 'depth', depth)
+
+@db.event.listens_for(Category, 'after_update')
+def _move_subtree(mapper, connection, target):
+    if not db.inspect(target).attrs.parent_id.history.has_changes():
+        return
+    old_path, old_depth = target.path, target.depth
+    path, depth = _path_for(connection, target.id, target.parent_id)
+    # Rewrite the prefix of every descendant in one statement
+    connection.execute(
+        db.update(Category).where(Category.path.startswith(old_path))
+        .values(path=db.literal(path) + db.func.substr(Category.path, len(old_path) + 1),
+                depth=Category.depth + (depth - old_depth)))
+    set_committed_value(target, 'path', path)
+    set_committed_value(target, 'depth', depth)
+
+def rebuild_paths(connection):
+    rows = connection.execute(db.select(Category.id, Category.parent_id)).all()
+    parents = dict(rows)
+    paths = {}
+    def path_of(id):
+        if id not in paths:
+            parent = parents.get(id)
+            if parent in parents:
+                parent_path, parent_depth = path_of(parent)
+                paths[id] = (f'{parent_path}{id}/', parent_depth + 1)
+            else:
+                paths[id] = (f'/{id}/', 0)
+        return paths[id]
+    for id in parents:
+        path_of(id)
+    if paths:
+        connection.execute(db.update(Category).where(Category.id == db.bindparam('cid'))
+                           .values(path=db.bindparam('cpath'), depth=db.bindparam('cdepth')),
+                           [{'cid': id, 'cpath': p, 'cdepth': d} for id, (p, d) in paths.items()])
+
+@db.event.listens_for(db.metadata, 'after_create')
+def _backfill_paths(metadata, connection, **kw):
+    # Categories created before paths existed (see app.schema) get theirs here
+    if connection.scalar(db.select(db.func.count()).select_from(Category).where(Category.path.is_(None))):
+        rebuild_paths(connection)
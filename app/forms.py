@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, SelectField, DateField, IntegerField, TextAreaField
 from wtforms.validators import ValidationError, DataRequired, Email, EqualTo
 from app.models import User
@@ -27,7 +28,8 @@ class RegistrationForm(FlaskForm):
         user = User.query.filter_by(email=email.data).first()
         if user is not None:
             raise ValidationError('Please use a different email address.')
-from app.models import Category
+from app.categories import get_category_tree
+from app.attributes import extra_fields, clean
 
 class RequestForm(FlaskForm):
     category = SelectField('Category', validators=[DataRequired()])
@@ -35,11 +37,10 @@ class RequestForm(FlaskForm):
     
     def __init__(self, *args, **kwargs):
         super(RequestForm, self).__init__(*args, **kwargs)
-        # Populate choices from DB
+        # Populate choices from the cached category tree
         # Note: This requires application context when form is instantiated
         try:
-            cats = Category.query.filter(Category.parent_id == None).all()
-            self.category.choices = [(c.name, c.name) for c in cats]
+            self.category.choices = [(c['name'], c['name']) for c in get_category_tree()]
         except Exception:
             self.category.choices = []
     
@@ -54,6 +55,26 @@ class RequestForm(FlaskForm):
     deadline = DateField('Deadline', format='%Y-%m-%d', validators=[DataRequired()])
     submit = SubmitField('Submit Request')
 
+def request_form(fields, *args, **kwargs):
+    """A RequestForm with an input per extra category field (see app.attributes)."""
+    def check(field_def):
+        def validate(form, field):
+            try:
+                clean([field_def], {field_def['key']: field.data})
+            except ValueError as e:
+                raise ValidationError(str(e))
+        return validate
+
+    class CategoryRequestForm(RequestForm):
+        attribute_fields = []
+
+    for field in extra_fields(fields):
+        name = f'attr_{field["key"]}'
+        render_kw = {'inputmode': 'decimal'} if field['type'] == 'number' else None
+        setattr(CategoryRequestForm, name, StringField(field['name'], validators=[check(field)], render_kw=render_kw))
+        CategoryRequestForm.attribute_fields.append((field, name))
+    return CategoryRequestForm(*args, **kwargs)
+
 class BuyCreditsForm(FlaskForm):
     package = SelectField('Package', choices=[('10', '10 Credits ($100)'), ('20', '20 Credits ($170)'), ('50', '50 Credits ($350)')], validators=[DataRequired()])
     submit = SubmitField('Buy Now')
@@ -62,3 +83,24 @@ class BidForm(FlaskForm):
     price = StringField('Price (Fiyat)', validators=[DataRequired()])
     details = TextAreaField('Details / Notes')
     submit = SubmitField('Submit Offer')
+
+class SubscriptionForm(FlaskForm):
+    category = SelectField('Category')
+    sub_category = StringField('Sub Category')
+    origin = StringField('Origin')
+    submit = SubmitField('Subscribe')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.category.choices = [('', 'Any category')] + [(c['name'], c['name']) for c in get_category_tree()]
+
+    def validate_origin(self, origin):
+        if not (self.category.data or self.sub_category.data or origin.data):
+            raise ValidationError('Pick at least a category, sub category or origin.')
+
+class EmptyForm(FlaskForm):
+    submit = SubmitField('Submit')
+
+class ImportRequestsForm(FlaskForm):
+    file = FileField('CSV or Excel file', validators=[FileRequired(), FileAllowed(['csv', 'xlsx'], 'CSV or XLSX only')])
+    submit = SubmitField('Import')
@@ -0,0 +1,106 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from flask import request, session, make_response, render_template, current_app
+from flask_login import current_user
+from markupsafe import Markup
+from sqlalchemy.orm import Session
+from app import db
+from app.cache import site_cache
+from app.models import Request, Bid
+
+# Conditional GETs for the index, marketplace and request pages. Content is
+# versioned two ways: Request.updated_at moves whenever a request or one of
+# its bids changes, and the shared "marketplace" counter in cache_version is
+# bumped by any Request/Bid write. A view builds its ETag from the versions
+# it depends on plus the viewer (the navbar shows their credits) and answers
+# 304 before running its main queries when the browser's copy is current.
+# Pages are per user, so they are sent private and revalidated every time,
+# and only by ETag: they carry no Last-Modified, since a date alone can't
+# tell that the viewer's credits or the site chrome have changed.
+
+MARKETPLACE = 'marketplace'
+
+@db.event.listens_for(Request, 'before_insert')
+@db.event.listens_for(Request, 'before_update')
+def _stamp_request(mapper, connection, target):
+    target.updated_at = datetime.utcnow()
+
+@db.event.listens_for(Session, 'after_flush')
+def _bump_versions(session, flush_context):
+    changed = [obj for obj in (*session.new, *session.dirty, *session.deleted) if isinstance(obj, (Request, Bid))]
+    if not changed:
+        return
+    connection = session.connection()
+    request_ids = {obj.request_id for obj in changed if isinstance(obj, Bid) and obj.request_id}
+    if request_ids:
+        connection.execute(db.update(Request).where(Request.id.in_(request_ids))
+                           .values(updated_at=datetime.utcnow()))
+    site_cache.invalidate(MARKETPLACE, connection)
+
+def touch(connection, request_ids=None):
+    """Record writes made with Core statements, which skip the listeners above."""
+    if request_ids:
+        connection.execute(db.update(Request).where(Request.id.in_(request_ids))
+                           .values(updated_at=datetime.utcnow()))
+    site_cache.invalidate(MARKETPLACE, connection)
+
+def marketplace_version():
+    """Version of the request and bid data, as seen by this worker's cache."""
+    # get() is what re-reads the shared counter once SITE_CACHE_TTL has passed
+    site_cache.get(MARKETPLACE, lambda: None)
+    return site_cache.version(MARKETPLACE)
+
+def page_etag(*parts):
+    # Everything base.html shows besides the page body: site chrome and the viewer
+    viewer = ((current_user.id, current_user.credits, current_user.is_seller, current_user.is_admin)
+              if current_user.is_authenticated else None)
+    key = repr((parts, viewer, site_cache.version('site_setting'), site_cache.version('tickers')))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def not_modified(etag):
+    """A 304 response if the client's cached copy is still current, else None."""
+    # A pending flash message must be rendered, so never short-circuit then
+    if request.method != 'GET' or session.get('_flashes') or not request.if_none_match.contains(etag):
+        return None
+    return _with_validators(make_response('', 304), etag)
+
+def cacheable(body, etag):
+    return _with_validators(make_response(body), etag)
+
+def _with_validators(response, etag):
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+class FragmentCache:
+    """Bounded LRU of rendered template fragments, per worker."""
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        value = render()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > current_app.config['FRAGMENT_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+fragments = FragmentCache()
+
+def request_row(req):
+    """Rendered marketplace row for a request; reused until the request changes."""
+    key = ('request_row', req.id, req.updated_at or req.timestamp)
+    return fragments.get(key, lambda: Markup(render_template('_request_row.html', req=req)))
@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import signal
+import socket
+import time
+import traceback
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db, matching, httpcache
+from app.models import Job, Notification, Request
+
+# A small job queue kept in the database, so there is no broker to run.
+# enqueue() adds a Job to the caller's session and is committed with the
+# write that caused it. The `flask run-jobs` worker, started next to gunicorn
+# by boot.sh, claims due jobs with a conditional UPDATE (so two workers never
+# take the same one), runs the registered handler and retries failures with
+# exponential backoff until max_attempts. Jobs left "running" by a worker
+# that died are picked up again after JOB_LOCK_TIMEOUT, or marked failed if
+# that was their last attempt.
+
+logger = logging.getLogger(__name__)
+
+handlers = {}
+# Queued by every worker each DEADLINE_SWEEP_INTERVAL unless one is already pending
+PERIODIC = ('expire_requests', 'prune_rate_limits', 'archive_requests')
+
+def handler(kind):
+    """Register a function as the handler for jobs of `kind`: fn(job, **payload)."""
+    def register(fn):
+        handlers[kind] = fn
+        return fn
+    return register
+
+def enqueue(kind, delay=0, max_attempts=None, **payload):
+    """Queue a job; the caller commits."""
+    job = Job(kind=kind, payload=json.dumps(payload),
+              run_at=datetime.utcnow() + timedelta(seconds=delay),
+              max_attempts=max_attempts or current_app.config['JOB_MAX_ATTEMPTS'])
+    db.session.add(job)
+    return job
+
+def enqueue_once(kind, **payload):
+    """Queue a job unless one of the same kind is already waiting or running."""
+    pending = db.session.scalar(db.select(Job.id).where(Job.kind == kind, Job.status.in_(('queued', 'running')))
+                                .limit(1))
+    return None if pending else enqueue(kind, **payload)
+
+def _stale(now):
+    return db.and_(Job.status == 'running',
+                   Job.locked_at < now - timedelta(seconds=current_app.config['JOB_LOCK_TIMEOUT']))
+
+def _claimable(now):
+    return db.or_(db.and_(Job.status == 'queued', Job.run_at <= now),
+                  db.and_(_stale(now), Job.attempts < Job.max_attempts))
+
+def claim(worker_id):
+    """Take the oldest due job for this worker, or None if there is nothing to do."""
+    # A job whose worker died on its last attempt is not retried
+    now = datetime.utcnow()
+    abandoned = db.session.execute(
+        db.update(Job).where(_stale(now), Job.attempts >= Job.max_attempts)
+        .values(status='failed', finished_at=now, locked_by=None, locked_at=None,
+                last_error=db.func.coalesce(Job.last_error, 'Worker stopped during the last attempt.'))
+        .execution_options(synchronize_session=False)).rowcount
+    if abandoned:
+        logger.warning('Marked %s abandoned jobs as failed', abandoned)
+        db.session.commit()
+    while True:
+        now = datetime.utcnow()
+        job_id = db.session.scalar(db.select(Job.id).where(_claimable(now)).order_by(Job.run_at, Job.id).limit(1))
+        if job_id is None:
+            return None
+        claimed = db.session.execute(
+            db.update(Job).where(Job.id == job_id, _claimable(now))
+            .values(status='running', locked_by=worker_id, locked_at=now, attempts=Job.attempts + 1)
+            .execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+        # Another worker got there first; look again
+
+def run(job):
+    try:
+        fn = handlers[job.kind]
+        result = fn(job, **json.loads(job.payload or '{}'))
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc(limit=5)
+        logger.warning('Job %s (%s) failed, attempt %s of %s:\n%s',
+                       job.id, job.kind, job.attempts, job.max_attempts, error)
+        job.last_error = error
+        if job.attempts < job.max_attempts:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(
+                seconds=current_app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1))
+        else:
+            job.status, job.finished_at = 'failed', datetime.utcnow()
+    else:
+        job.status, job.finished_at = 'done', datetime.utcnow()
+        job.result = None if result is None else str(result)
+    job.locked_by = job.locked_at = None
+    db.session.commit()
+    return job.status
+
+def work(worker_id=None, once=False):
+    """Run jobs until stopped (SIGTERM/SIGINT), or until the queue is empty with once=True."""
+    worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+    config = current_app.config
+    stopping = []
+    if not once:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda *args: stopping.append(True))
+    next_sweep = 0
+    processed = 0
+    while not stopping:
+        if not once and time.monotonic() >= next_sweep:
+            for kind in PERIODIC:
+                enqueue_once(kind)
+            db.session.commit()
+            next_sweep = time.monotonic() + config['DEADLINE_SWEEP_INTERVAL']
+        job = claim(worker_id)
+        if job is None:
+            if once:
+                break
+            db.session.remove()
+            time.sleep(config['JOB_POLL_INTERVAL'])
+            continue
+        run(job)
+        processed += 1
+        db.session.remove()
+    return processed
+
+@click.command('run-jobs')
+@click.option('--once', is_flag=True, help='Exit when no job is due instead of polling.')
+@click.option('--worker-id', help='Name recorded on claimed jobs (default host:pid).')
+@with_appcontext
+def run_jobs_command(once, worker_id):
+    """Process background jobs."""
+    logging.basicConfig(level=logging.INFO)
+    processed = work(worker_id, once=once)
+    click.echo(f'Processed {processed} jobs.')
+
+@handler('expire_requests')
+def expire_requests(job, batch_size=500):
+    # Requests stay open through their deadline day. Batches walk
+    # ix_request_status_deadline and commit as they go, so a large backlog
+    # never holds the write lock for long.
+    cutoff = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    total = 0
+    while True:
+        ids = db.session.scalars(db.select(Request.id).where(Request.status == 'Open', Request.deadline < cutoff)
+                                 .limit(batch_size)).all()
+        if not ids:
+            return f'Closed {total} expired requests'
+        db.session.execute(db.update(Request).where(Request.id.in_(ids), Request.status == 'Open')
+                           .values(status='Closed').execution_options(synchronize_session=False))
+        httpcache.touch(db.session.connection(), ids)
+        db.session.commit()
+        total += len(ids)
+
+@handler('notify_sellers')
+def notify_sellers(job, request_ids):
+    """Put new requests in the inbox of every seller subscribed to them."""
+    requests = db.session.execute(
+        db.select(Request.id, Request.user_id, Request.category, Request.sub_category,
+                  Request.origin, Request.product_type)
+        .where(Request.id.in_(request_ids))).all()
+    matches = matching.match(requests)
+    rows = [{'user_id': seller_id, 'request_id': req.id,
+             'message': f'New {req.category} request: {req.product_type}'}
+            for req in requests for seller_id in matches[req.id]]
+    if rows:
+        db.session.execute(db.insert(Notification), rows)
+    db.session.commit()
+    return f'{len(rows)} notifications'
@@ -0,0 +1,31 @@
+from app import db
+from app.models import User, CreditTransaction
+from app.usercache import user_cache
+
+# All credit balance changes go through apply(): the balance moves with a
+# single conditional UPDATE evaluated by the database, never a Python
+# read-modify-write, and the matching CreditTransaction row is written in the
+# same transaction. Concurrent debits on one account therefore serialise in
+# the database and can never overdraw it or lose an update.
+
+class InsufficientCredits(Exception):
+    pass
+
+def apply(user_id, delta, description):
+    """Add `delta` credits (negative to debit) to a user and log it; the caller commits."""
+    balance = db.func.coalesce(User.credits, 0)
+    updated = db.session.execute(
+        db.update(User).where(User.id == user_id, balance + delta >= 0)
+        .values(credits=balance + delta)
+        .execution_options(synchronize_session='fetch')).rowcount
+    if not updated:
+        raise InsufficientCredits(f'User {user_id} cannot cover {delta} credits')
+    # Core UPDATEs skip the mapper events, so drop the cached balance here
+    user_cache.invalidate(user_id)
+    transaction = CreditTransaction(user_id=user_id, amount=delta, description=description)
+    db.session.add(transaction)
+    return transaction
+
+def ledger_total(user_id):
+    return db.session.scalar(db.select(db.func.coalesce(db.func.sum(CreditTransaction.amount), 0))
+                             .where(CreditTransaction.user_id == user_id))
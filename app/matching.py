@@ -0,0 +1,51 @@
+from itertools import product
+from app import db
+from app.models import Subscription, User
+
+# Seller subscriptions are stored as keys of (category, sub_category, origin)
+# with "*" for a field left open, e.g. "pvc|*|turkey". A request matches the
+# subscriptions under at most eight keys (each field either its own value or
+# "*"), so finding its sellers is one lookup on ix_subscription_key, costing
+# the number of matches rather than the number of users or subscriptions.
+
+FIELDS = ('category', 'sub_category', 'origin')
+ANY = '*'
+
+def _norm(value):
+    value = (value or '').strip().lower().replace('|', '/')
+    return value or ANY
+
+def subscription_key(category=None, sub_category=None, origin=None):
+    return '|'.join(_norm(v) for v in (category, sub_category, origin))
+
+def request_keys(category, sub_category, origin):
+    """Every subscription key a request with these fields matches."""
+    options = [{_norm(v), ANY} for v in (category, sub_category, origin)]
+    return {'|'.join(parts) for parts in product(*options)}
+
+def match(requests):
+    """{request id: [seller ids]} for rows with id, user_id, category, sub_category and origin."""
+    keys = {req.id: request_keys(req.category, req.sub_category, req.origin) for req in requests}
+    wanted = set().union(*keys.values()) if keys else set()
+    sellers = {}
+    if wanted:
+        rows = db.session.execute(
+            db.select(Subscription.key, Subscription.user_id)
+            .join(User, User.id == Subscription.user_id)
+            .where(Subscription.key.in_(wanted), User.is_seller.is_(True), User.is_blocked.isnot(True))).all()
+        for key, user_id in rows:
+            sellers.setdefault(key, set()).add(user_id)
+    return {req.id: sorted(set().union(*(sellers.get(k, ()) for k in keys[req.id])) - {req.user_id})
+            for req in requests}
+
+def subscribe(user_id, category=None, sub_category=None, origin=None):
+    """Add a subscription unless the user already has the same one; the caller commits."""
+    key = subscription_key(category, sub_category, origin)
+    existing = db.session.scalar(db.select(Subscription).where(Subscription.user_id == user_id,
+                                                               Subscription.key == key))
+    if existing:
+        return existing
+    subscription = Subscription(user_id=user_id, key=key, category=category or None,
+                                sub_category=sub_category or None, origin=origin or None)
+    db.session.add(subscription)
+    return subscription
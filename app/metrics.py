@@ -0,0 +1,174 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from flask import g, request, has_request_context, current_app, Response, abort
+from app import db
+
+# Opt-in (METRICS_ENABLED) request and SQL instrumentation. Every request
+# records its latency, query count and time spent in SQL per endpoint;
+# statements slower than SLOW_QUERY_THRESHOLD are logged with their query
+# plan. Figures live in this process only: with several gunicorn workers each
+# one reports its own, labelled with its pid.
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name, self.help, self.buckets = name, help, buckets
+        self.counts = defaultdict(lambda: [0] * (len(buckets) + 1))
+        self.sums = defaultdict(float)
+
+    def observe(self, labels, value):
+        counts = self.counts[labels]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.sums[labels] += value
+
+    def count(self, labels):
+        return sum(self.counts[labels])
+
+    def quantile(self, labels, q):
+        """Upper bound of the bucket holding the q-th observation."""
+        total, seen = self.count(labels), 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts[labels]):
+            seen += n
+            if total and seen >= q * total:
+                return bound
+        return None
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = Histogram('http_request_duration_seconds', 'Request latency by endpoint.', LATENCY_BUCKETS)
+        self.queries = Histogram('http_request_sql_queries', 'SQL statements per request.', QUERY_BUCKETS)
+        self.sql_time = Histogram('http_request_sql_seconds', 'Time spent in SQL per request.', LATENCY_BUCKETS)
+        self.slow_queries = deque(maxlen=50)
+        self.slow_total = 0
+
+    def record(self, labels, elapsed, query_count, sql_time):
+        with self.lock:
+            self.latency.observe(labels, elapsed)
+            self.queries.observe(labels, query_count)
+            self.sql_time.observe(labels, sql_time)
+
+    def summary(self):
+        # One row per endpoint for the admin page, slowest p95 first
+        with self.lock:
+            rows = []
+            for labels in list(self.latency.counts):
+                n = self.latency.count(labels)
+                rows.append({
+                    'endpoint': labels[0], 'method': labels[1], 'count': n,
+                    'avg_ms': self.latency.sums[labels] / n * 1000,
+                    'p50_ms': self.latency.quantile(labels, 0.5) * 1000,
+                    'p95_ms': self.latency.quantile(labels, 0.95) * 1000,
+                    'avg_queries': self.queries.sums[labels] / n,
+                    'avg_sql_ms': self.sql_time.sums[labels] / n * 1000,
+                })
+        return sorted(rows, key=lambda r: r['p95_ms'], reverse=True)
+
+    def render(self, pid):
+        lines = []
+        with self.lock:
+            for hist in (self.latency, self.queries, self.sql_time):
+                lines += [f'# HELP {hist.name} {hist.help}', f'# TYPE {hist.name} histogram']
+                for (endpoint, method), counts in sorted(hist.counts.items()):
+                    labels = f'endpoint="{endpoint}",method="{method}",pid="{pid}"'
+                    cumulative = 0
+                    for bound, n in zip(hist.buckets + ('+Inf',), counts):
+                        cumulative += n
+                        lines.append(f'{hist.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{hist.name}_sum{{{labels}}} {hist.sums[(endpoint, method)]}')
+                    lines.append(f'{hist.name}_count{{{labels}}} {cumulative}')
+            lines += ['# HELP sql_slow_queries_total Statements over SLOW_QUERY_THRESHOLD.',
+                      '# TYPE sql_slow_queries_total counter',
+                      f'sql_slow_queries_total{{pid="{pid}"}} {self.slow_total}']
+        return '\n'.join(lines) + '\n'
+
+def get_metrics():
+    return current_app.extensions.get('metrics')
+
+def _explain(conn, cursor, statement, parameters, dialect):
+    # Runs on a fresh DBAPI cursor inside a savepoint, so a failed EXPLAIN
+    # can't abort the caller's transaction on PostgreSQL
+    if not statement.lstrip().upper().startswith('SELECT'):
+        return None
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+    conn.info['explaining'] = True
+    try:
+        savepoint = conn.begin_nested()
+        try:
+            explain = cursor.connection.cursor()
+            explain.execute(prefix + statement, parameters)
+            plan = '\n'.join(' '.join(str(c) for c in row) for row in explain.fetchall())
+            explain.close()
+            return plan
+        finally:
+            savepoint.rollback()
+    except Exception as e:
+        return f'(no plan: {e})'
+    finally:
+        del conn.info['explaining']
+
+def init_app(app):
+    if not app.config.get('METRICS_ENABLED'):
+        return
+    metrics = app.extensions['metrics'] = Metrics()
+    threshold = app.config['SLOW_QUERY_THRESHOLD']
+    with app.app_context():
+        engine = db.engine
+
+    @db.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # The savepoint around an EXPLAIN is not the request's own SQL
+        if conn.info.get('explaining'):
+            return
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @db.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if conn.info.get('explaining'):
+            return
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        if has_request_context():
+            g.sql_count = g.get('sql_count', 0) + 1
+            g.sql_time = g.get('sql_time', 0.0) + elapsed
+        if elapsed >= threshold:
+            plan = _explain(conn, cursor, statement, parameters, engine.dialect.name)
+            logger.warning('Slow query (%.1f ms): %s\nPlan:\n%s', elapsed * 1000, statement, plan)
+            with metrics.lock:
+                metrics.slow_total += 1
+                metrics.slow_queries.appendleft({'ms': elapsed * 1000, 'statement': statement, 'plan': plan,
+                                                 'endpoint': request.endpoint if has_request_context() else None})
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        # Streaming responses are timed up to their first byte
+        if 'request_started' in g and request.endpoint != 'metrics':
+            metrics.record((request.endpoint or 'unknown', request.method),
+                           time.perf_counter() - g.request_started,
+                           g.get('sql_count', 0), g.get('sql_time', 0.0))
+        return response
+
+    @app.route('/metrics', endpoint='metrics')
+    def metrics_endpoint():
+        # Not served at all until a token is set
+        token = app.config.get('METRICS_TOKEN')
+        if not token:
+            abort(404)
+        if request.headers.get('Authorization') != f'Bearer {token}':
+            abort(401)
+        return Response(metrics.render(os.getpid()), mimetype='text/plain; version=0.0.4')
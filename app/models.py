@@ -1,13 +1,20 @@
 from datetime import datetime
+from functools import lru_cache
 from werkzeug.security import generate_password_hash, check_password_hash
+from flask import current_app
 from flask_login import UserMixin
-from app import db, login
+from app import db
+
+@lru_cache(maxsize=None)
+def _hash_prefix(method):
+    # Werkzeug fills in defaults, so "scrypt" makes hashes starting "scrypt:32768:8:1$"
+    return generate_password_hash('', method=method).split('$', 1)[0]
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
-    password_hash = db.Column(db.String(128))
+    password_hash = db.Column(db.String(256))
     credits = db.Column(db.Integer, default=0)
     is_seller = db.Column(db.Boolean, default=False)
     is_buyer = db.Column(db.Boolean, default=True)
@@ -22,18 +29,18 @@ class User(UserMixin, db.Model):
     bids = db.relationship('Bid', backref='bidder', lazy='dynamic')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'])
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def password_needs_rehash(self):
+        # The hash starts with the method and cost it was made with, e.g. "scrypt:16384:8:1$"
+        return (self.password_hash or '').split('$', 1)[0] != _hash_prefix(current_app.config['PASSWORD_HASH_METHOD'])
+
     def __repr__(self):
         return f'<User {self.username}>'
 
-@login.user_loader
-def load_user(id):
-    return db.session.get(User, int(id))
-
 class Request(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -46,6 +53,8 @@ class Request(db.Model):
     origin = db.Column(db.String(100))       # Menşei
     application = db.Column(db.String(100))  # Uygulama Alanı
     quantity = db.Column(db.String(50))      # Miktar
+    quantity_amount = db.Column(db.Float)    # Parsed from quantity by app.pricing
+    quantity_unit = db.Column(db.String(20))
     product_status = db.Column(db.String(50)) # Ürün Durumu
     customs_status = db.Column(db.String(50)) # Gümrükleme Statüsü
     packaging = db.Column(db.String(50))      # Ambalaj Türü
@@ -54,17 +63,167 @@ class Request(db.Model):
     status = db.Column(db.String(20), default='Open')
     details = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    # Last change to the request or its bids, kept by app.httpcache
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Summary of the bids kept by app.bidding; prices normalised to BASE_CURRENCY per ton
+    bid_count = db.Column(db.Integer, default=0)
+    price_min = db.Column(db.Float)
+    price_max = db.Column(db.Float)
+    price_median = db.Column(db.Float)
+    last_bid_at = db.Column(db.DateTime)
     
     bids = db.relationship('Bid', backref='request', lazy='dynamic')
+    attributes = db.relationship('RequestAttribute', cascade='all, delete-orphan')
+
+    # Composite indexes backing the keyset-paginated marketplace feed:
+    # every filter combination ends in (timestamp, id) so the cursor is a range scan.
+    __table_args__ = (
+        db.Index('ix_request_feed', 'timestamp', 'id'),
+        db.Index('ix_request_category_feed', 'category', 'sub_category', 'timestamp', 'id'),
+        db.Index('ix_request_origin_feed', 'origin', 'timestamp', 'id'),
+        db.Index('ix_request_status_feed', 'status', 'timestamp', 'id'),
+        db.Index('ix_request_status_deadline', 'status', 'deadline'),
+        # Archived rows keep their ids, so SQLite must never hand out a deleted one again
+        {'sqlite_autoincrement': True},
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'category': self.category,
+            'sub_category': self.sub_category,
+            'product_type': self.product_type,
+            'spec': self.spec,
+            'origin': self.origin,
+            'application': self.application,
+            'quantity': self.quantity,
+            'quantity_amount': self.quantity_amount,
+            'quantity_unit': self.quantity_unit,
+            'status': self.status,
+            'deadline': self.deadline.isoformat() if self.deadline else None,
+            'timestamp': self.timestamp.isoformat() if self.timestamp else None,
+            'bid_count': self.bid_count,
+            'price_min': self.price_min,
+            'price_max': self.price_max,
+            'price_median': self.price_median,
+            'last_bid_at': self.last_bid_at.isoformat() if self.last_bid_at else None,
+        }
+
+class RequestAttribute(db.Model):
+    # Values of the category-defined fields of a request (see app.attributes).
+    # Numbers go in value_number so range filters are index range scans.
+    request_id = db.Column(db.Integer, db.ForeignKey('request.id'), primary_key=True)
+    name = db.Column(db.String(100), primary_key=True)
+    value_text = db.Column(db.String(255))
+    value_number = db.Column(db.Float)
+
+    __table_args__ = (
+        db.Index('ix_request_attribute_number', 'name', 'value_number', 'request_id'),
+        db.Index('ix_request_attribute_text', 'name', 'value_text', 'request_id'),
+    )
 
 class Bid(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    request_id = db.Column(db.Integer, db.ForeignKey('request.id'))
-    seller_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    request_id = db.Column(db.Integer, db.ForeignKey('request.id'), index=True)
+    seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     price = db.Column(db.String(50)) # Store as string to include currency or formatted "1100 USD"
+    # Parsed from price by app.pricing so offers can be compared in SQL
+    price_amount = db.Column(db.Float)
+    price_currency = db.Column(db.String(3))
+    price_unit = db.Column(db.String(20))
+    # BASE_CURRENCY per ton at the FX rates of the moment the bid was placed (app.bidding)
+    price_normalized = db.Column(db.Float)
+    status = db.Column(db.String(20))  # Awarded or Lost once the request is awarded
     details = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
+    # Bids of one request in price order without touching other requests' rows
+    __table_args__ = (
+        db.Index('ix_bid_request_price', 'request_id', 'price_currency', 'price_unit', 'price_amount'),
+        db.Index('ix_bid_request_normalized', 'request_id', 'price_normalized'),
+        {'sqlite_autoincrement': True},
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'request_id': self.request_id,
+            'seller_id': self.seller_id,
+            'seller': self.bidder.username if self.bidder else None,
+            'price': self.price,
+            'price_amount': self.price_amount,
+            'price_currency': self.price_currency,
+            'price_unit': self.price_unit,
+            'price_normalized': self.price_normalized,
+            'status': self.status,
+            'details': self.details,
+            'timestamp': self.timestamp.isoformat() if self.timestamp else None,
+        }
+
+class ArchivedRequest(db.Model):
+    # Closed requests moved out of `request` by app.archive, same columns plus archived_at
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    category = db.Column(db.String(100))
+    sub_category = db.Column(db.String(100))
+    product_type = db.Column(db.String(100))
+    spec = db.Column(db.String(100))
+    origin = db.Column(db.String(100))
+    application = db.Column(db.String(100))
+    quantity = db.Column(db.String(50))
+    quantity_amount = db.Column(db.Float)
+    quantity_unit = db.Column(db.String(20))
+    product_status = db.Column(db.String(50))
+    customs_status = db.Column(db.String(50))
+    packaging = db.Column(db.String(50))
+    deadline = db.Column(db.DateTime)
+    status = db.Column(db.String(20))
+    details = db.Column(db.Text)
+    timestamp = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    bid_count = db.Column(db.Integer)
+    price_min = db.Column(db.Float)
+    price_max = db.Column(db.Float)
+    price_median = db.Column(db.Float)
+    last_bid_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    author = db.relationship('User')
+    bids = db.relationship('ArchivedBid', back_populates='request', lazy='dynamic')
+
+    __table_args__ = (
+        db.Index('ix_archived_request_user', 'user_id', 'timestamp'),
+        db.Index('ix_archived_request_feed', 'timestamp', 'id'),
+    )
+
+class ArchivedBid(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    request_id = db.Column(db.Integer, db.ForeignKey('archived_request.id'), index=True)
+    seller_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    price = db.Column(db.String(50))
+    price_amount = db.Column(db.Float)
+    price_currency = db.Column(db.String(3))
+    price_unit = db.Column(db.String(20))
+    price_normalized = db.Column(db.Float)
+    status = db.Column(db.String(20))
+    details = db.Column(db.Text)
+    timestamp = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    request = db.relationship('ArchivedRequest', back_populates='bids')
+
+    __table_args__ = (
+        db.Index('ix_archived_bid_seller', 'seller_id', 'timestamp'),
+    )
+
+class ArchivedRequestAttribute(db.Model):
+    request_id = db.Column(db.Integer, db.ForeignKey('archived_request.id'), primary_key=True)
+    name = db.Column(db.String(100), primary_key=True)
+    value_text = db.Column(db.String(255))
+    value_number = db.Column(db.Float)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 class CreditTransaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -72,12 +231,23 @@ class CreditTransaction(db.Model):
     description = db.Column(db.String(200))
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    user = db.relationship('User')
+
+    # Keyset pagination of the admin transaction log, overall and per user
+    __table_args__ = (
+        db.Index('ix_credit_transaction_log', 'timestamp', 'id'),
+        db.Index('ix_credit_transaction_user_log', 'user_id', 'timestamp', 'id'),
+    )
+
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True)
     parent_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
     # Storing schema as simple string/JSON for dynamic fields e.g., "Origin,MFI"
     schema = db.Column(db.Text) 
+    # Materialized path of ids from the root, e.g. "/1/5/", kept by app.categories
+    path = db.Column(db.String(255), index=True)
+    depth = db.Column(db.Integer)
     
     sub_categories = db.relationship('Category', backref=db.backref('parent', remote_side=[id]), lazy='dynamic')
 
@@ -91,5 +261,105 @@ class SiteSetting(db.Model):
 class Ticker(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50)) # e.g. USD/TRY or PVC Price
+    # Latest price and its change since the previous day's close, kept by app.ticker_history
     value = db.Column(db.String(50))
     change_rate = db.Column(db.String(20)) # e.g. "+0.5%"
+
+class TickerPrice(db.Model):
+    # Append-only price history; the primary key doubles as the time index
+    ticker_id = db.Column(db.Integer, db.ForeignKey('ticker.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime, primary_key=True)
+    value = db.Column(db.Float, nullable=False)
+
+class TickerRollup(db.Model):
+    # OHLC bars per hour ("h") and day ("d") built from ticker_price by app.ticker_history
+    ticker_id = db.Column(db.Integer, db.ForeignKey('ticker.id'), primary_key=True)
+    resolution = db.Column(db.String(1), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    open = db.Column(db.Float, nullable=False)
+    high = db.Column(db.Float, nullable=False)
+    low = db.Column(db.Float, nullable=False)
+    close = db.Column(db.Float, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+
+class CacheVersion(db.Model):
+    # Shared invalidation counters for the per-worker caches in app.cache
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+
+class DailyStat(db.Model):
+    # Per-day rollup counters maintained by the write paths (see app.stats)
+    day = db.Column(db.Date, primary_key=True)
+    metric = db.Column(db.String(120), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class RateLimit(db.Model):
+    # Token bucket state for app.ratelimit; updated_at is a Unix timestamp
+    key = db.Column(db.String(200), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False, index=True)
+
+class Job(db.Model):
+    # Background work picked up by the `flask run-jobs` worker (see app.jobs)
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text)               # JSON keyword arguments for the handler
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    result = db.Column(db.Text)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    # The worker polls for the oldest due job of a status
+    __table_args__ = (
+        db.Index('ix_job_queue', 'status', 'run_at'),
+    )
+
+class Subscription(db.Model):
+    # A seller's interest in new requests; any of the fields may be left open.
+    # `key` is the normalized lookup key built by app.matching.
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    category = db.Column(db.String(100))
+    sub_category = db.Column(db.String(100))
+    origin = db.Column(db.String(100))
+    key = db.Column(db.String(310), nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Inverted index: subscription key -> subscribed sellers
+    __table_args__ = (
+        db.Index('ix_subscription_key', 'key', 'user_id', unique=True),
+    )
+
+class Notification(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    request_id = db.Column(db.Integer, db.ForeignKey('request.id'))
+    # Set instead of request_id once app.archive has moved the request
+    archived_request_id = db.Column(db.Integer, db.ForeignKey('archived_request.id'))
+    message = db.Column(db.String(255))
+    is_read = db.Column(db.Boolean, nullable=False, default=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    request = db.relationship('Request')
+    archived_request = db.relationship('ArchivedRequest')
+
+    __table_args__ = (
+        db.Index('ix_notification_inbox', 'user_id', 'id'),
+    )
+
+class ApiToken(db.Model):
+    # Bearer tokens for /api/v1 (app.api); only the SHA-256 digest is stored
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    name = db.Column(db.String(64))
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    user = db.relationship('User')
@@ -0,0 +1,34 @@
+import base64
+from datetime import datetime
+from app import db
+
+# Keyset (cursor) pagination over a (timestamp, id) ordering, newest first.
+# The cursor is the position of the last row of the previous page, so the
+# next page is a range scan on the matching index instead of an OFFSET.
+
+def encode_cursor(timestamp, id):
+    raw = f'{timestamp.isoformat()}~{id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    # Raises ValueError on anything that is not a cursor we produced
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        ts, id = raw.rsplit('~', 1)
+        return datetime.fromisoformat(ts), int(id)
+    except (TypeError, UnicodeDecodeError, base64.binascii.Error) as e:
+        raise ValueError('invalid cursor') from e
+
+def keyset_page(query, ts_col, id_col, cursor=None, limit=20):
+    """Return (rows, next_cursor) for one page of `query` ordered by ts_col, id_col desc."""
+    if cursor:
+        ts, last_id = decode_cursor(cursor)
+        query = query.filter(db.or_(ts_col < ts, db.and_(ts_col == ts, id_col < last_id)))
+    rows = query.order_by(ts_col.desc(), id_col.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, ts_col.key), getattr(last, id_col.key))
+    return rows, next_cursor
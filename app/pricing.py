@@ -0,0 +1,150 @@
+import re
+import click
+from flask.cli import with_appcontext
+from app import db
+from app.cache import get_tickers
+from app.models import Bid, Request
+
+# Prices and quantities are typed as free text ("1.100 USD / Ton + KDV",
+# "100 Ton"). The parsers here pull out a number, a currency and a unit,
+# which are stored next to the original text so offers can be compared and
+# sorted in SQL. FX conversion uses the admin-maintained tickers.
+
+CURRENCIES = {
+    'USD': ('USD', '$', 'DOLAR', 'DOLLAR'),
+    'EUR': ('EUR', '€', 'EURO', 'AVRO'),
+    'TRY': ('TRY', 'TL', '₺'),
+    'GBP': ('GBP', '£'),
+    'CNY': ('CNY', 'RMB', 'YUAN'),
+}
+UNITS = {
+    'ton': ('TON', 'TONS', 'TONNE', 'MT', 'T'),
+    'kg': ('KG', 'KGS', 'KILO'),
+    'lb': ('LB', 'LBS'),
+    'lt': ('LT', 'L', 'LITRE', 'LITER'),
+    'piece': ('PCS', 'PIECE', 'ADET'),
+}
+# Price per unit multiplied by this gives price per ton. A price with no unit
+# is taken as per ton; litres and pieces can't be converted, so offers priced
+# in them have no normalised price and sort last.
+PER_TON = {'ton': 1.0, 'kg': 1000.0, 'lb': 2204.62, None: 1.0}
+
+CURRENCY_ALIASES = {alias: code for code, aliases in CURRENCIES.items() for alias in aliases}
+UNIT_ALIASES = {alias: unit for unit, aliases in UNITS.items() for alias in aliases}
+NUMBER_RE = re.compile(r'\d+(?:[.,\s]\d+)*')
+TOKEN_RE = re.compile(r'[^\W\d_]+|[$€₺£]')
+
+def parse_number(text):
+    """Read "1100", "1.100,50", "1,100.50" or "32.5"; None if there is no number."""
+    match = NUMBER_RE.search(text or '')
+    if not match:
+        return None
+    number = re.sub(r'\s', '', match.group())
+    separators = [c for c in number if c in '.,']
+    if separators:
+        decimal = separators[-1]
+        head, _, tail = number.rpartition(decimal)
+        # A lone separator followed by exactly three digits is a thousands mark
+        if len(separators) == 1 and len(tail) == 3:
+            number = head + tail
+        else:
+            number = head.replace('.', '').replace(',', '') + '.' + tail
+    return float(number)
+
+def _tokens(text):
+    return [t.upper() for t in TOKEN_RE.findall(text or '')]
+
+def parse_unit(text):
+    # Prefer whatever follows a slash ("USD / Ton"), else the first unit word
+    _, slash, after = (text or '').partition('/')
+    for part in ([after] if slash else []) + [text]:
+        for token in _tokens(part):
+            if token in UNIT_ALIASES:
+                return UNIT_ALIASES[token]
+    return None
+
+def parse_price(text):
+    """Split a bid price into (amount, currency, unit); parts not found are None."""
+    currency = next((CURRENCY_ALIASES[t] for t in _tokens(text) if t in CURRENCY_ALIASES), None)
+    return parse_number(text), currency, parse_unit(text)
+
+def parse_quantity(text):
+    return parse_number(text), parse_unit(text)
+
+def fx_rates(base):
+    """{currency: value of one unit in `base`} derived from "AAA/BBB" tickers."""
+    pairs = []
+    for ticker in get_tickers():
+        names = (ticker.name or '').upper().replace(' ', '').split('/')
+        value = parse_number(ticker.value)
+        if len(names) == 2 and value:
+            pairs.append((names[0], names[1], value))
+    rates = {base: 1.0}
+    changed = True
+    while changed:
+        changed = False
+        for left, right, value in pairs:
+            if right in rates and left not in rates:
+                rates[left] = value * rates[right]
+                changed = True
+            elif left in rates and right not in rates:
+                rates[right] = rates[left] / value
+                changed = True
+    return rates
+
+def normalized_price_expression(rates, model=Bid):
+    """SQL for a bid's price per ton in the base currency; NULL if unknown."""
+    fx = db.case(rates, value=model.price_currency, else_=None)
+    unit = db.case((model.price_unit.is_(None), PER_TON[None]),
+                   *((model.price_unit == name, factor) for name, factor in PER_TON.items() if name),
+                   else_=None)
+    return model.price_amount * fx * unit
+
+def normalize(bid, rates):
+    if bid.price_amount is None or bid.price_currency not in rates or bid.price_unit not in PER_TON:
+        return None
+    return bid.price_amount * rates[bid.price_currency] * PER_TON[bid.price_unit]
+
+@db.event.listens_for(Bid, 'before_insert')
+@db.event.listens_for(Bid, 'before_update')
+def _parse_bid(mapper, connection, target):
+    if target.price_amount is None or db.inspect(target).attrs.price.history.has_changes():
+        target.price_amount, target.price_currency, target.price_unit = parse_price(target.price)
+
+@db.event.listens_for(Request, 'before_insert')
+@db.event.listens_for(Request, 'before_update')
+def _parse_quantity(mapper, connection, target):
+    if target.quantity_amount is None or db.inspect(target).attrs.quantity.history.has_changes():
+        target.quantity_amount, target.quantity_unit = parse_quantity(target.quantity)
+
+def backfill(model, source, parse, targets, batch_size=1000):
+    """Fill parsed columns for rows written before they existed, one committed batch at a time."""
+    table = model.__table__
+    last_id, total = 0, 0
+    while True:
+        rows = db.session.execute(
+            db.select(table.c.id, table.c[source])
+            .where(table.c.id > last_id, table.c[source].isnot(None), table.c[targets[0]].is_(None))
+            .order_by(table.c.id).limit(batch_size)).all()
+        if not rows:
+            return total
+        updates = [dict(zip(['new_' + t for t in targets], parse(value)), row_id=id) for id, value in rows]
+        db.session.connection().execute(
+            table.update().where(table.c.id == db.bindparam('row_id'))
+            .values({t: db.bindparam('new_' + t) for t in targets}), updates)
+        db.session.commit()
+        last_id = rows[-1].id
+        total += len(rows)
+
+def backfill_all(batch_size=1000):
+    """(bid prices, request quantities) parsed by backfill()."""
+    return (backfill(Bid, 'price', parse_price, ['price_amount', 'price_currency', 'price_unit'], batch_size),
+            backfill(Request, 'quantity', parse_quantity, ['quantity_amount', 'quantity_unit'], batch_size))
+
+@click.command('backfill-prices')
+@click.option('--batch-size', default=1000, show_default=True)
+@with_appcontext
+def backfill_prices_command(batch_size):
+    """Parse price and quantity text of rows written before the numeric columns existed."""
+    bids, requests = backfill_all(batch_size)
+    click.echo(f'Parsed {bids} bid prices and {requests} request quantities.')
@@ -0,0 +1,59 @@
+import time
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from app import db, jobs
+from app.models import RateLimit
+
+# Token buckets kept in the database so every gunicorn worker draws from the
+# same bucket. A bucket holds up to `burst` tokens and refills at `per_minute`
+# tokens a minute; each attempt takes one. The refill and the take happen in
+# one conditional UPDATE, so concurrent attempts can't overspend a bucket.
+# Buckets are written on their own connection and committed straight away:
+# a rejected attempt must count even though the request's own transaction
+# is never committed.
+
+def _refilled(burst, per_second, now):
+    level = RateLimit.tokens + (now - RateLimit.updated_at) * per_second
+    return db.case((level > burst, float(burst)), else_=level)
+
+def take(key, burst, per_minute, now=None):
+    """Take a token from `key`'s bucket. Returns (allowed, seconds until one is available)."""
+    now = time.time() if now is None else now
+    per_second = per_minute / 60.0
+    level = _refilled(burst, per_second, now)
+    while True:
+        try:
+            with db.engine.begin() as connection:
+                taken = connection.execute(
+                    db.update(RateLimit).where(RateLimit.key == key, level >= 1)
+                    .values(tokens=level - 1, updated_at=now)).rowcount
+                if taken:
+                    return True, 0
+                tokens = connection.scalar(db.select(level).where(RateLimit.key == key))
+                if tokens is not None:
+                    return False, (1 - tokens) / per_second if per_second else 3600.0
+                connection.execute(db.insert(RateLimit).values(key=key, tokens=burst - 1.0, updated_at=now))
+                return True, 0
+        except IntegrityError:
+            # Another worker created the bucket first; take from that one
+            continue
+
+def check_login(ip, username):
+    """Rate limit a login attempt per client address and per account; (allowed, retry_after)."""
+    config = current_app.config
+    if not config['LOGIN_RATE_LIMIT']:
+        return True, 0
+    allowed, retry_after = take(f'login:ip:{ip}', config['LOGIN_IP_BURST'], config['LOGIN_IP_PER_MINUTE'])
+    if allowed and username:
+        # Per account as well, so spreading a guessing run over many addresses doesn't help.
+        # The account limit is generous enough that it can't lock a real user out for long.
+        allowed, retry_after = take(f'login:user:{username.strip().lower()}',
+                                    config['LOGIN_USER_BURST'], config['LOGIN_USER_PER_MINUTE'])
+    return allowed, retry_after
+
+@jobs.handler('prune_rate_limits')
+def prune(job=None, max_age=3600):
+    """Drop buckets idle long enough to be full again; they are recreated on demand."""
+    pruned = db.session.execute(db.delete(RateLimit).where(RateLimit.updated_at < time.time() - max_age)).rowcount
+    db.session.commit()
+    return f'Pruned {pruned} rate limit buckets'
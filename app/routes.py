@@ -1,10 +1,20 @@
+import math
 from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request, g
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, abort, Response, stream_with_context, \
+    make_response
 from flask_login import login_user, logout_user, current_user, login_required
 from urllib.parse import urlsplit
 from app import db
-from app.forms import LoginForm, RegistrationForm, RequestForm, BuyCreditsForm, BidForm
-from app.models import User, Request, Bid, CreditTransaction, SiteSetting, Ticker
+from app.forms import LoginForm, RegistrationForm, request_form, BuyCreditsForm, BidForm, ImportRequestsForm, \
+    SubscriptionForm, EmptyForm
+from app.models import User, Request, Bid, Subscription, Notification
+from app.pagination import keyset_page
+from app.cache import site_cache, get_site_setting, get_tickers
+from app.search import search_requests
+from app.streams import bid_notifier, bid_events
+from app import stats, ledger, jobs, matching, httpcache, ratelimit, archive, attributes, ticker_history, bidding
+from app.bulk import import_requests, read_rows, IMPORT_FIELDS
+from app.categories import get_category_tree, fields_for, CACHE_KEY as CATEGORIES_CACHE_KEY
 from flask import current_app as app
 
 # We need to register routes. Since I didn't use blueprints, I will define a function or just import app?
@@ -21,13 +31,15 @@ bp = Blueprint('main', __name__)
 
 @bp.before_request
 def before_request():
-    g.site_setting = SiteSetting.query.first()
-    g.tickers = Ticker.query.all()
+    g.site_setting = get_site_setting()
+    g.tickers = get_tickers()
 
 @bp.route('/')
 @bp.route('/index')
 def index():
-    return render_template('index.html', title='Home')
+    etag = httpcache.page_etag('index')
+    return httpcache.not_modified(etag) or \
+        httpcache.cacheable(render_template('index.html', title='Home'), etag)
 
 @bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -35,10 +47,24 @@ def login():
         return redirect(url_for('main.index'))
     form = LoginForm()
     if form.validate_on_submit():
+        # Rate limit before hashing, which is what an attack would make us spend CPU on
+        allowed, retry_after = ratelimit.check_login(request.remote_addr, form.username.data)
+        if not allowed:
+            flash(f'Too many login attempts. Try again in {math.ceil(retry_after)} seconds.')
+            response = make_response(render_template('login.html', title='Sign In', form=form), 429)
+            response.headers['Retry-After'] = str(math.ceil(retry_after))
+            return response
         user = db.session.scalar(db.select(User).where(User.username == form.username.data))
         if user is None or not user.check_password(form.password.data):
             flash('Invalid username or password')
             return redirect(url_for('main.login'))
+        if user.is_blocked:
+            flash('This account has been blocked.')
+            return redirect(url_for('main.login'))
+        if user.password_needs_rehash():
+            # Moves old hashes to the configured method and cost as users log in
+            user.set_password(form.password.data)
+            db.session.commit()
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '':
@@ -62,6 +88,7 @@ def register():
                     tax_id=form.tax_id.data) # Default everyone is buyer
         user.set_password(form.password.data)
         db.session.add(user)
+        stats.record(stats.SIGNUPS)
         db.session.commit()
         flash('Congratulations, you are now a registered user!')
         return redirect(url_for('main.login'))
@@ -86,9 +113,8 @@ def buy_credits():
             cost = 350
         
         if credits_to_add > 0:
-            current_user.credits += credits_to_add
-            transaction = CreditTransaction(user_id=current_user.id, amount=credits_to_add, description=f"Bought {package} credits package")
-            db.session.add(transaction)
+            ledger.apply(current_user.id, credits_to_add, f"Bought {package} credits package")
+            stats.record(stats.CREDITS_PURCHASED, credits_to_add)
             db.session.commit()
             flash(f'Successfully purchased {credits_to_add} credits!')
             return redirect(url_for('main.dashboard'))
@@ -98,9 +124,70 @@ def buy_credits():
 @bp.route('/dashboard')
 @login_required
 def dashboard():
-    my_requests = current_user.requests.order_by(Request.timestamp.desc()).all()
-    my_bids = current_user.bids.order_by(Bid.timestamp.desc()).all()
-    return render_template('dashboard.html', title='Dashboard', my_requests=my_requests, my_bids=my_bids)
+    # Bid summaries are columns of the request rows and bids come back with
+    # their requests, so the template never aggregates or lazy-loads per row
+    history = request.args.get('history') == '1'
+    size = app.config['DASHBOARD_PAGE_SIZE']
+    my_bids, bids_cursor = [], None
+    try:
+        my_requests, requests_cursor = archive.requests_for_user(
+            current_user.id, history, request.args.get('requests_cursor'), size)
+        if current_user.is_seller:
+            my_bids, bids_cursor = archive.bids_for_seller(current_user.id, history, request.args.get('bids_cursor'), size)
+    except ValueError:
+        abort(400)
+    return render_template('dashboard.html', title='Dashboard', my_requests=my_requests, my_bids=my_bids,
+                           requests_cursor=requests_cursor, bids_cursor=bids_cursor, history=history)
+
+@bp.route('/subscriptions', methods=['GET', 'POST'])
+@login_required
+def subscriptions():
+    if not current_user.is_seller:
+        flash('Only sellers can subscribe to requests.')
+        return redirect(url_for('main.dashboard'))
+    form = SubscriptionForm()
+    if form.validate_on_submit():
+        matching.subscribe(current_user.id, form.category.data, form.sub_category.data.strip(),
+                           form.origin.data.strip())
+        db.session.commit()
+        flash('Subscribed. Matching new requests will appear in your inbox.')
+        return redirect(url_for('main.subscriptions'))
+    mine = Subscription.query.filter_by(user_id=current_user.id).order_by(Subscription.id).all()
+    return render_template('subscriptions.html', title='Subscriptions', form=form,
+                           subscriptions=mine, delete_form=EmptyForm())
+
+@bp.route('/subscriptions/<int:id>/delete', methods=['POST'])
+@login_required
+def delete_subscription(id):
+    if EmptyForm().validate_on_submit():
+        Subscription.query.filter_by(id=id, user_id=current_user.id).delete()
+        db.session.commit()
+    return redirect(url_for('main.subscriptions'))
+
+@bp.route('/inbox')
+@login_required
+def inbox():
+    # Newest first along ix_notification_inbox; ?before=<id> pages back
+    query = (db.select(Notification).options(db.joinedload(Notification.request),
+                                             db.joinedload(Notification.archived_request))
+             .where(Notification.user_id == current_user.id)
+             .order_by(Notification.id.desc()).limit(app.config['INBOX_PAGE_SIZE']))
+    before = request.args.get('before', type=int)
+    if before:
+        query = query.where(Notification.id < before)
+    items = db.session.scalars(query).all()
+    next_before = items[-1].id if len(items) == app.config['INBOX_PAGE_SIZE'] else None
+    return render_template('inbox.html', title='Inbox', items=items, next_before=next_before, form=EmptyForm())
+
+@bp.route('/inbox/read', methods=['POST'])
+@login_required
+def mark_inbox_read():
+    if EmptyForm().validate_on_submit():
+        db.session.execute(db.update(Notification)
+                           .where(Notification.user_id == current_user.id, Notification.is_read.is_(False))
+                           .values(is_read=True))
+        db.session.commit()
+    return redirect(url_for('main.inbox'))
 
 @bp.route('/create_request', methods=['GET', 'POST'])
 @login_required
@@ -109,7 +196,14 @@ def create_request():
         flash('You need at least 1 credit to create a request.')
         return redirect(url_for('main.buy_credits'))
         
-    form = RequestForm()
+    # The chosen category (posted, or picked on the page and reloaded) decides the extra fields
+    tree = get_category_tree()
+    category = request.values.get('category') or (tree[0]['name'] if tree else None)
+    fields = fields_for(category, request.values.get('sub_category'))
+    form = request_form(fields)
+    if request.method == 'GET':
+        form.category.data = category
+        form.sub_category.data = request.args.get('sub_category')
     if form.validate_on_submit():
         req = Request(
             user_id=current_user.id,
@@ -126,20 +220,136 @@ def create_request():
             deadline=datetime.combine(form.deadline.data, datetime.min.time()) if form.deadline.data else None,
             status='Open'
         )
-        current_user.credits -= 1
         db.session.add(req)
+        db.session.flush()
+        attributes.save(attributes.rows(req.id, attributes.clean(
+            fields, {field['key']: form[name].data for field, name in form.attribute_fields})))
+        try:
+            ledger.apply(current_user.id, -1, f"Request #{req.id} created")
+        except ledger.InsufficientCredits:
+            # Another request spent the last credit since the check above
+            db.session.rollback()
+            flash('You need at least 1 credit to create a request.')
+            return redirect(url_for('main.buy_credits'))
+        stats.record_request(req.category)
+        stats.record(stats.CREDITS_SPENT)
+        jobs.enqueue('notify_sellers', request_ids=[req.id])
         db.session.commit()
         flash('Request created successfully! 1 Credit deducted.')
         return redirect(url_for('main.dashboard'))
         
     return render_template('create_request.html', title='Create Request', form=form)
 
+MARKETPLACE_FILTERS = ('category', 'sub_category', 'origin', 'status')
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        abort(400)
+
+def marketplace_page():
+    # Shared by the HTML feed and its JSON variant; returns (requests, next_cursor, filters)
+    filters = {k: request.args.get(k) for k in MARKETPLACE_FILTERS if request.args.get(k)}
+    query = Request.query.filter(Request.user_id != current_user.id).filter_by(**filters)
+
+    try:
+        clauses, applied = attributes.filters_from(request.args)
+    except ValueError:
+        abort(400)
+    query = query.filter(*clauses)
+    filters.update(applied)
+
+    deadline_from = _parse_date(request.args.get('deadline_from'))
+    deadline_to = _parse_date(request.args.get('deadline_to'))
+    if deadline_from:
+        query = query.filter(Request.deadline >= deadline_from)
+        filters['deadline_from'] = request.args['deadline_from']
+    if deadline_to:
+        query = query.filter(Request.deadline <= deadline_to)
+        filters['deadline_to'] = request.args['deadline_to']
+
+    try:
+        requests, next_cursor = keyset_page(query, Request.timestamp, Request.id,
+                                            cursor=request.args.get('cursor'),
+                                            limit=app.config['MARKETPLACE_PAGE_SIZE'])
+    except ValueError:
+        abort(400)
+    return requests, next_cursor, filters
+
+@bp.route('/create_request/import', methods=['GET', 'POST'])
+@login_required
+def import_requests_view():
+    form = ImportRequestsForm()
+    errors = []
+    if form.validate_on_submit():
+        upload = form.file.data
+        try:
+            created, errors = import_requests(current_user.id, read_rows(upload.stream, upload.filename))
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e))
+            return redirect(url_for('main.import_requests_view'))
+        except ledger.InsufficientCredits:
+            db.session.rollback()
+            flash('Not enough credits: every imported request costs 1 credit.')
+            return redirect(url_for('main.buy_credits'))
+        db.session.commit()
+        flash(f'{created} requests created, {created} credits deducted.')
+        if not errors:
+            return redirect(url_for('main.dashboard'))
+    return render_template('import_requests.html', title='Import Requests', form=form,
+                           errors=errors, columns=IMPORT_FIELDS)
+
 @bp.route('/marketplace')
 @login_required
 def marketplace():
-    # Show all requests not by current user
-    requests = Request.query.filter(Request.user_id != current_user.id).order_by(Request.timestamp.desc()).all()
-    return render_template('marketplace.html', title='Marketplace', requests=requests)
+    # Show requests not by current user, one keyset page at a time
+    category_tree = get_category_tree()
+    etag = httpcache.page_etag('marketplace', request.full_path, httpcache.marketplace_version(),
+                               site_cache.version(CATEGORIES_CACHE_KEY))
+    cached = httpcache.not_modified(etag)
+    if cached:
+        return cached
+    requests, next_cursor, filters = marketplace_page()
+    fields = attributes.extra_fields(fields_for(filters['category'], filters.get('sub_category'))) \
+        if 'category' in filters else []
+    return httpcache.cacheable(render_template('marketplace.html', title='Marketplace', requests=requests,
+                                               next_cursor=next_cursor, filters=filters,
+                                               category_tree=category_tree, fields=fields), etag)
+
+@bp.route('/marketplace.json')
+@login_required
+def marketplace_json():
+    requests, next_cursor, filters = marketplace_page()
+    return jsonify(items=[r.to_dict() for r in requests], next_cursor=next_cursor)
+
+@bp.route('/categories.json')
+def categories_json():
+    return jsonify(get_category_tree())
+
+@bp.route('/tickers/<int:id>/chart.json')
+def ticker_chart(id):
+    # Precomputed OHLC bars: [bucket, open, high, low, close], oldest first
+    resolution = request.args.get('resolution', 'd')
+    if resolution not in ticker_history.RESOLUTIONS:
+        abort(400)
+    days = min(max(request.args.get('days', 30 if resolution == 'd' else 2, type=int), 1), 366)
+    bars = ticker_history.chart(id, resolution, days)
+    response = jsonify(ticker=id, resolution=resolution,
+                       bars=[[bucket.isoformat(), o, h, l, c] for bucket, o, h, l, c in bars])
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
+
+@bp.route('/search')
+@login_required
+def search():
+    q = request.args.get('q', '').strip()
+    results = search_requests(q, limit=app.config['SEARCH_RESULTS_LIMIT']) if q else []
+    if request.args.get('format') == 'json':
+        return jsonify(items=[r.to_dict() for r in results])
+    return render_template('search.html', title='Search', q=q, results=results)
 
 @bp.route('/request/<int:id>', methods=['GET', 'POST'])
 @login_required
@@ -154,14 +364,83 @@ def request_detail(id):
         if not current_user.is_seller:
             flash('Only sellers can submit bids.')
             return redirect(url_for('main.request_detail', id=id))
+        if req.status != 'Open':
+            flash('This request is no longer accepting offers.')
+            return redirect(url_for('main.request_detail', id=id))
             
         price = request.form.get('price')
         details = request.form.get('details') # e.g. "1100 USD / Ton + KDV"
         
         bid = Bid(request_id=id, seller_id=current_user.id, price=price, details=details)
         db.session.add(bid)
+        stats.record(stats.BIDS)
         db.session.commit()
+        bid_notifier.notify()
         flash('Bid submitted successfully.')
         return redirect(url_for('main.request_detail', id=id))
         
-    return render_template('request_detail.html', title='Request Detail', req=req)
+    # Price order follows the price each offer was normalised to when it was
+    # placed (ix_bid_request_normalized); offers we couldn't parse go last
+    sort = 'price' if request.args.get('sort') == 'price' else 'newest'
+    # Only categories with extra fields have attribute rows to load
+    fields = attributes.extra_fields(fields_for(req.category, req.sub_category))
+    # The owner's award forms carry a CSRF token that expires with its session,
+    # so their copy of the page is never served again from a validator
+    awardable = req.user_id == current_user.id and req.status in bidding.AWARDABLE
+    if not awardable:
+        etag = httpcache.page_etag('request', req.id, req.updated_at or req.timestamp, sort,
+                                   app.config['BASE_CURRENCY'], site_cache.version(CATEGORIES_CACHE_KEY))
+        cached = httpcache.not_modified(etag)
+        if cached:
+            return cached
+    query = req.bids.options(db.joinedload(Bid.bidder))
+    if sort == 'price':
+        query = query.order_by(Bid.price_normalized.asc().nulls_last(), Bid.id)
+    else:
+        query = query.order_by(Bid.timestamp.desc())
+    bids = query.all()
+    values = {a.name: a.value_text for a in req.attributes} if fields else {}
+    details = [(field['name'], values[field['key']]) for field in fields if field['key'] in values]
+    body = render_template('request_detail.html', title='Request Detail', req=req, bids=bids,
+                           attributes=details, sort=sort, awardable=awardable,
+                           form=EmptyForm() if awardable else None,
+                           base_currency=app.config['BASE_CURRENCY'])
+    if awardable:
+        response = make_response(body)
+        response.cache_control.no_store = True
+        return response
+    return httpcache.cacheable(body, etag)
+
+@bp.route('/request/<int:id>/award/<int:bid_id>', methods=['POST'])
+@login_required
+def award_bid(id, bid_id):
+    req = db.session.get(Request, id)
+    bid = db.session.get(Bid, bid_id)
+    if not req or not bid or bid.request_id != id:
+        abort(404)
+    if req.user_id != current_user.id:
+        abort(403)
+    if not EmptyForm().validate_on_submit():
+        abort(400)
+    seller = bid.bidder.username
+    if bidding.award(req, bid):
+        db.session.commit()
+        flash(f'Offer from {seller} accepted. The request is closed and the other bidders have been notified.')
+    else:
+        db.session.rollback()
+        flash('This request has already been awarded.')
+    return redirect(url_for('main.request_detail', id=id))
+
+@bp.route('/request/<int:id>/bids/stream')
+@login_required
+def bid_stream(id):
+    req = db.session.get(Request, id)
+    if not req:
+        abort(404)
+    if req.user_id != current_user.id and not current_user.is_admin:
+        abort(403)
+    # EventSource sends Last-Event-ID on reconnect; the first connect passes ?after=
+    last_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('after', 0, type=int)
+    db.session.remove()
+    return Response(stream_with_context(bid_events(id, last_id)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,25 @@
+from sqlalchemy.schema import CreateColumn
+from app import db
+
+# db.create_all() only creates missing tables, so columns and indexes added
+# to an existing model never reach a database created by an older release.
+# This runs first on every create_all (boot.sh calls it on each start) and
+# adds whatever is missing to the tables that already existed. New columns
+# must be nullable or carry a server default; backfills belong to the
+# feature that owns the column.
+
+def upgrade(metadata, connection, tables=(), **kw):
+    inspector = db.inspect(connection)
+    quote = connection.dialect.identifier_preparer.format_table
+    for table in metadata.sorted_tables:
+        if table in tables:
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=connection.dialect)
+                connection.execute(db.text(f'ALTER TABLE {quote(table)} ADD COLUMN {ddl}'))
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+db.event.listen(db.metadata, 'after_create', upgrade, insert=True)
@@ -0,0 +1,144 @@
+import re
+from app import db
+from app.models import Request
+
+# Full-text search over requests. SQLite gets an FTS5 virtual table keyed by
+# request id, PostgreSQL a tsvector table with a GIN index. Both are kept in
+# sync from the Request mapper events below, inside the same flush, and are
+# created (and backfilled if new) whenever db.create_all() runs.
+
+SEARCH_FIELDS = ('product_type', 'spec', 'origin', 'application', 'details')
+
+# Fold Turkish letters to their ASCII base so "PLASTİK", "plastik" and
+# "plastık" all match; str.lower() alone would turn "İ" into "i̇".
+TURKISH_FOLD = str.maketrans({
+    'İ': 'i', 'I': 'i', 'ı': 'i',
+    'Ş': 's', 'ş': 's', 'Ğ': 'g', 'ğ': 'g',
+    'Ü': 'u', 'ü': 'u', 'Ö': 'o', 'ö': 'o', 'Ç': 'c', 'ç': 'c',
+})
+TOKEN_RE = re.compile(r'\w+')
+
+def fold(text):
+    return (text or '').translate(TURKISH_FOLD).lower()
+
+def tokenize(text):
+    return TOKEN_RE.findall(fold(text))
+
+def _document(row):
+    return {f: fold(getattr(row, f)) for f in SEARCH_FIELDS}
+
+def _index_exists(connection):
+    if connection.dialect.name == 'postgresql':
+        return connection.scalar(db.text("SELECT to_regclass('request_search') IS NOT NULL"))
+    return connection.scalar(db.text(
+        "SELECT count(*) FROM sqlite_master WHERE name = 'request_fts'")) > 0
+
+def _create_index(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(db.text(
+            'CREATE TABLE request_search ('
+            ' request_id INTEGER PRIMARY KEY REFERENCES request(id) ON DELETE CASCADE,'
+            ' document tsvector NOT NULL)'))
+        connection.execute(db.text(
+            'CREATE INDEX ix_request_search_document ON request_search USING GIN (document)'))
+    else:
+        connection.execute(db.text(
+            'CREATE VIRTUAL TABLE request_fts USING fts5('
+            'product_type, spec, origin, application, details, '
+            "tokenize = 'unicode61 remove_diacritics 2')"))
+
+def _upsert(connection, id, doc):
+    _upsert_many(connection, [dict(doc, id=id)])
+
+def _upsert_many(connection, docs):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(db.text(
+            'INSERT INTO request_search (request_id, document) VALUES (:id, '
+            "setweight(to_tsvector('simple', :product_type), 'A') || "
+            "setweight(to_tsvector('simple', :spec), 'B') || "
+            "setweight(to_tsvector('simple', :origin || ' ' || :application), 'C') || "
+            "setweight(to_tsvector('simple', :details), 'D')) "
+            'ON CONFLICT (request_id) DO UPDATE SET document = EXCLUDED.document'),
+            docs)
+    else:
+        connection.execute(db.text(
+            'INSERT OR REPLACE INTO request_fts (rowid, product_type, spec, origin, application, details) '
+            'VALUES (:id, :product_type, :spec, :origin, :application, :details)'),
+            docs)
+
+def _delete(connection, id):
+    table, key = ('request_search', 'request_id') if connection.dialect.name == 'postgresql' \
+        else ('request_fts', 'rowid')
+    connection.execute(db.text(f'DELETE FROM {table} WHERE {key} = :id'), {'id': id})
+
+def unindex(connection, ids):
+    """Drop requests removed with Core delete(); PostgreSQL's index rows cascade on their own."""
+    if connection.dialect.name == 'sqlite' and ids:
+        connection.execute(db.text('DELETE FROM request_fts WHERE rowid IN :ids')
+                           .bindparams(db.bindparam('ids', expanding=True)), {'ids': list(ids)})
+
+def rebuild_index(connection, batch_size=1000):
+    columns = [Request.id] + [getattr(Request, f) for f in SEARCH_FIELDS]
+    result = connection.execution_options(yield_per=batch_size).execute(db.select(*columns))
+    for rows in result.partitions():
+        _upsert_many(connection, [dict(_document(row), id=row.id) for row in rows])
+
+def index_rows(connection, rows):
+    """Index requests inserted with Core insert(), which skips the mapper events below."""
+    if connection.dialect.name in ('sqlite', 'postgresql') and rows:
+        _upsert_many(connection, [{'id': row['id'], **{f: fold(row.get(f)) for f in SEARCH_FIELDS}}
+                                  for row in rows])
+
+@db.event.listens_for(db.metadata, 'after_create')
+def _ensure_index(metadata, connection, **kw):
+    if connection.dialect.name not in ('sqlite', 'postgresql') or _index_exists(connection):
+        return
+    _create_index(connection)
+    rebuild_index(connection)
+
+@db.event.listens_for(db.metadata, 'before_drop')
+def _drop_index(metadata, connection, **kw):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(db.text('DROP TABLE IF EXISTS request_search'))
+    elif connection.dialect.name == 'sqlite':
+        connection.execute(db.text('DROP TABLE IF EXISTS request_fts'))
+
+@db.event.listens_for(Request, 'after_insert')
+def _request_inserted(mapper, connection, target):
+    _upsert(connection, target.id, _document(target))
+
+@db.event.listens_for(Request, 'after_update')
+def _request_updated(mapper, connection, target):
+    state = db.inspect(target)
+    if any(state.attrs[f].history.has_changes() for f in SEARCH_FIELDS):
+        _upsert(connection, target.id, _document(target))
+
+@db.event.listens_for(Request, 'after_delete')
+def _request_deleted(mapper, connection, target):
+    _delete(connection, target.id)
+
+def search_request_ids(q, limit=50):
+    """Return request ids matching every word of `q`, best match first."""
+    tokens = tokenize(q)
+    if not tokens:
+        return []
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        # Last word is a prefix so results narrow while the user is typing
+        tsquery = ' & '.join(tokens[:-1] + [tokens[-1] + ':*'])
+        sql = ("SELECT request_id FROM request_search, to_tsquery('simple', :q) query "
+               'WHERE document @@ query ORDER BY ts_rank(document, query) DESC LIMIT :limit')
+        params = {'q': tsquery, 'limit': limit}
+    else:
+        match = ' '.join(f'"{t}"' for t in tokens[:-1]) + f' "{tokens[-1]}"*'
+        sql = ('SELECT rowid FROM request_fts WHERE request_fts MATCH :q '
+               'ORDER BY bm25(request_fts, 10.0, 5.0, 2.0, 2.0, 1.0) LIMIT :limit')
+        params = {'q': match.strip(), 'limit': limit}
+    return [row[0] for row in db.session.execute(db.text(sql), params)]
+
+def search_requests(q, limit=50):
+    ids = search_request_ids(q, limit)
+    if not ids:
+        return []
+    by_id = {r.id: r for r in Request.query.filter(Request.id.in_(ids))}
+    return [by_id[i] for i in ids if i in by_id]
@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from app.models import DailyStat, User, Request, Bid, CreditTransaction, ArchivedRequest, ArchivedBid
+
+# Admin dashboard figures come from daily_stat, one row per (day, metric),
+# bumped by the write paths inside their own transaction. Reading a range is
+# O(days) rows instead of scanning user/request/credit_transaction.
+
+SIGNUPS = 'signups'
+REQUESTS = 'requests'
+BIDS = 'bids'
+CREDITS_PURCHASED = 'credits_purchased'
+CREDITS_GRANTED = 'credits_granted'
+CREDITS_SPENT = 'credits_spent'
+CATEGORY_PREFIX = 'requests:'
+
+def record(metric, amount=1, day=None):
+    """Add `amount` to today's counter for `metric` in the current transaction."""
+    day = day or datetime.utcnow().date()
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        stmt = insert(DailyStat).values(day=day, metric=metric, value=amount)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['day', 'metric'], set_={'value': DailyStat.value + stmt.excluded.value}))
+        return
+    updated = db.session.execute(
+        db.update(DailyStat).where(DailyStat.day == day, DailyStat.metric == metric)
+        .values(value=DailyStat.value + amount)).rowcount
+    if not updated:
+        db.session.add(DailyStat(day=day, metric=metric, value=amount))
+
+def record_request(category):
+    record(REQUESTS)
+    if category:
+        record(CATEGORY_PREFIX + category)
+
+def totals(metrics=None):
+    query = db.select(DailyStat.metric, db.func.sum(DailyStat.value)).group_by(DailyStat.metric)
+    if metrics:
+        query = query.where(DailyStat.metric.in_(metrics))
+    return {metric: value for metric, value in db.session.execute(query)}
+
+def series(days, metrics):
+    """Return (labels, {metric: [value per day]}) for the last `days` days, zero-filled."""
+    start = datetime.utcnow().date() - timedelta(days=days - 1)
+    labels = [start + timedelta(days=i) for i in range(days)]
+    data = {m: [0] * days for m in metrics}
+    rows = db.session.execute(db.select(DailyStat.day, DailyStat.metric, DailyStat.value)
+                              .where(DailyStat.day >= start, DailyStat.metric.in_(metrics)))
+    for day, metric, value in rows:
+        data[metric][(day - start).days] = value
+    return labels, data
+
+def category_totals(days):
+    start = datetime.utcnow().date() - timedelta(days=days - 1)
+    rows = db.session.execute(
+        db.select(DailyStat.metric, db.func.sum(DailyStat.value))
+        .where(DailyStat.day >= start, DailyStat.metric.startswith(CATEGORY_PREFIX))
+        .group_by(DailyStat.metric).order_by(db.func.sum(DailyStat.value).desc()))
+    return [(metric[len(CATEGORY_PREFIX):], value) for metric, value in rows]
+
+def _day(column, dialect):
+    # CAST(... AS DATE) has numeric affinity on SQLite, so use date() there
+    return db.func.date(column) if dialect == 'sqlite' else db.cast(column, db.Date)
+
+def _counts(day, metric, where=None, value=None, group_by=()):
+    query = db.select(day.label('day'), metric.label('metric'),
+                      value if value is not None else db.func.count().label('value'))
+    if where is not None:
+        query = query.where(where)
+    return query.group_by(day, *group_by)
+
+def rebuild(connection):
+    """Recompute daily_stat from the base tables (used when the table is first created)."""
+    dialect = connection.dialect.name
+    connection.execute(db.delete(DailyStat))
+    today = datetime.utcnow().date()
+    lit = db.literal
+
+    # Archived requests and bids still count on the day they were made
+    requests = db.union_all(db.select(Request.timestamp, Request.category),
+                            db.select(ArchivedRequest.timestamp, ArchivedRequest.category)).subquery()
+    bids = db.union_all(db.select(Bid.timestamp), db.select(ArchivedBid.timestamp)).subquery()
+
+    # Users carry no signup date, so existing accounts are counted on the backfill day
+    selects = [
+        db.select(lit(today, db.Date), lit(SIGNUPS), db.func.count()).select_from(User)
+        .having(db.func.count() > 0),
+        _counts(_day(requests.c.timestamp, dialect), lit(REQUESTS)),
+        _counts(_day(requests.c.timestamp, dialect), lit(CATEGORY_PREFIX) + requests.c.category,
+                where=requests.c.category.isnot(None), group_by=[requests.c.category]),
+        _counts(_day(bids.c.timestamp, dialect), lit(BIDS)),
+        _counts(_day(CreditTransaction.timestamp, dialect), lit(CREDITS_PURCHASED),
+                where=db.and_(CreditTransaction.amount > 0, CreditTransaction.description.like('Bought%')),
+                value=db.func.sum(CreditTransaction.amount)),
+        _counts(_day(CreditTransaction.timestamp, dialect), lit(CREDITS_GRANTED),
+                where=db.and_(CreditTransaction.amount > 0,
+                              db.not_(CreditTransaction.description.like('Bought%'))),
+                value=db.func.sum(CreditTransaction.amount)),
+        _counts(_day(CreditTransaction.timestamp, dialect), lit(CREDITS_SPENT),
+                where=CreditTransaction.amount < 0, value=-db.func.sum(CreditTransaction.amount)),
+    ]
+    for select in selects:
+        connection.execute(db.insert(DailyStat).from_select(['day', 'metric', 'value'], select))
+
+@db.event.listens_for(db.metadata, 'after_create')
+def _backfill(metadata, connection, tables=(), **kw):
+    # Metadata-level so the source tables exist even on a fresh database
+    if DailyStat.__table__ in tables:
+        rebuild(connection)
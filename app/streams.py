@@ -0,0 +1,59 @@
+import json
+import threading
+import time
+from flask import current_app
+from app import db
+from app.models import Bid
+
+# Server-Sent Events feed of new bids on a request. The bid table itself is
+# the event log: a stream remembers the last bid id it sent and asks for
+# newer rows through the request_id index. Bids committed in this worker
+# wake waiting streams immediately through bid_notifier; bids committed by
+# another gunicorn worker are picked up on the next BID_STREAM_POLL tick.
+# Streams end after BID_STREAM_TIMEOUT seconds and the browser reconnects
+# with Last-Event-ID, so a connection never pins a worker thread for long.
+
+class BidNotifier:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.seq = 0
+
+    def notify(self):
+        with self._cond:
+            self.seq += 1
+            self._cond.notify_all()
+
+    def wait(self, seq, timeout):
+        # Block until a bid is committed in this process or timeout passes
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq != seq, timeout)
+            return self.seq
+
+bid_notifier = BidNotifier()
+
+def format_event(bid):
+    return f'id: {bid.id}\nevent: bid\ndata: {json.dumps(bid.to_dict())}\n\n'
+
+def bid_events(request_id, last_id):
+    poll = current_app.config['BID_STREAM_POLL']
+    ends_at = time.monotonic() + current_app.config['BID_STREAM_TIMEOUT']
+    keepalive_at = time.monotonic() + 15
+    seq = bid_notifier.seq
+    yield 'retry: 2000\n\n'
+    while True:
+        bids = (Bid.query.options(db.joinedload(Bid.bidder))
+                .filter(Bid.request_id == request_id, Bid.id > last_id)
+                .order_by(Bid.id).all())
+        for bid in bids:
+            yield format_event(bid)
+            last_id = bid.id
+        # Hand the connection back between polls instead of holding it open
+        db.session.remove()
+
+        now = time.monotonic()
+        if now >= ends_at:
+            return
+        if now >= keepalive_at:
+            yield ': keepalive\n\n'
+            keepalive_at = now + 15
+        seq = bid_notifier.wait(seq, min(poll, ends_at - now))
@@ -0,0 +1,152 @@
+import csv
+import io
+from datetime import datetime, timedelta, timezone
+import click
+from flask.cli import with_appcontext
+from sqlalchemy.dialects import postgresql
+from app import db
+from app.cache import site_cache
+from app.models import Ticker, TickerPrice, TickerRollup
+
+# Ticker prices are appended to ticker_price (one row per ticker and
+# timestamp; re-sending a point is a no-op) and rolled up into hourly and
+# daily OHLC bars in ticker_rollup. After each ingest only the bars from the
+# first new point onwards are rebuilt, and the Ticker row gets the latest
+# price and its change since the previous day's close, so the header strip
+# keeps reading one small row per ticker and charts read a few bars.
+
+RESOLUTIONS = {
+    'h': lambda ts: ts.replace(minute=0, second=0, microsecond=0),
+    'd': lambda ts: ts.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+CSV_COLUMNS = ('ticker', 'timestamp', 'value')
+
+def parse_timestamp(value):
+    # Stored timestamps are naive UTC; points with an offset are converted to it
+    if not isinstance(value, datetime):
+        text = str(value).strip()
+        try:
+            return datetime.fromtimestamp(float(text), timezone.utc).replace(tzinfo=None)
+        except ValueError:
+            value = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def read_points(stream):
+    """Yield (ticker, timestamp, value) from a binary CSV stream with ticker,timestamp,value columns."""
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    missing = [c for c in CSV_COLUMNS if c not in (reader.fieldnames or ())]
+    if missing:
+        raise ValueError(f'missing column {", ".join(missing)}')
+    for line, row in enumerate(reader, start=2):
+        try:
+            yield row['ticker'].strip(), parse_timestamp(row['timestamp']), float(row['value'])
+        except (ValueError, AttributeError):
+            raise ValueError(f'line {line}: expected ticker, ISO or Unix timestamp, and a number')
+
+def _insert_new(connection):
+    if connection.dialect.name == 'postgresql':
+        return postgresql.insert(TickerPrice).on_conflict_do_nothing()
+    return db.insert(TickerPrice).prefix_with('OR IGNORE', dialect='sqlite')
+
+def _ticker_ids(names):
+    ids = dict(db.session.execute(db.select(Ticker.name, Ticker.id).where(Ticker.name.in_(names))).all())
+    for name in names:
+        if name not in ids:
+            ticker = Ticker(name=name)
+            db.session.add(ticker)
+            db.session.flush()
+            ids[name] = ticker.id
+    return ids
+
+def ingest(points):
+    """Record (ticker name, timestamp, value) points and refresh the rollups; the caller commits.
+
+    Unknown tickers are created. Returns the number of points read.
+    """
+    by_name = {}
+    for name, timestamp, value in points:
+        by_name.setdefault(name, []).append({'timestamp': timestamp, 'value': value})
+    if not by_name:
+        return 0
+    ids = _ticker_ids(list(by_name))
+    connection = db.session.connection()
+    insert = _insert_new(connection)
+    for name, rows in by_name.items():
+        for row in rows:
+            row['ticker_id'] = ids[name]
+        connection.execute(insert, rows)
+        rollup(ids[name], min(row['timestamp'] for row in rows))
+        refresh(ids[name])
+    site_cache.invalidate('tickers')
+    return sum(len(rows) for rows in by_name.values())
+
+def rollup(ticker_id, since):
+    """Rebuild a ticker's bars from the day of `since` onwards."""
+    start = RESOLUTIONS['d'](since)
+    bars = {resolution: {} for resolution in RESOLUTIONS}
+    prices = db.session.execute(
+        db.select(TickerPrice.timestamp, TickerPrice.value)
+        .where(TickerPrice.ticker_id == ticker_id, TickerPrice.timestamp >= start)
+        .order_by(TickerPrice.timestamp).execution_options(yield_per=5000))
+    for timestamp, value in prices:
+        for resolution, floor in RESOLUTIONS.items():
+            bar = bars[resolution].get(floor(timestamp))
+            if bar is None:
+                bars[resolution][floor(timestamp)] = {'open': value, 'high': value, 'low': value,
+                                                      'close': value, 'count': 1}
+            else:
+                bar['high'], bar['low'] = max(bar['high'], value), min(bar['low'], value)
+                bar['close'] = value
+                bar['count'] += 1
+    db.session.execute(db.delete(TickerRollup).where(TickerRollup.ticker_id == ticker_id,
+                                                     TickerRollup.bucket >= start))
+    rows = [dict(bar, ticker_id=ticker_id, resolution=resolution, bucket=bucket)
+            for resolution, buckets in bars.items() for bucket, bar in buckets.items()]
+    if rows:
+        db.session.execute(db.insert(TickerRollup), rows)
+
+def _format(value):
+    return ('%.4f' % value).rstrip('0').rstrip('.')
+
+def refresh(ticker_id):
+    """Set the ticker's shown value and change rate from its latest daily bars."""
+    days = db.session.scalars(
+        db.select(TickerRollup).where(TickerRollup.ticker_id == ticker_id, TickerRollup.resolution == 'd')
+        .order_by(TickerRollup.bucket.desc()).limit(2)).all()
+    if not days:
+        return
+    latest, previous = days[0], days[1] if len(days) > 1 else None
+    # Against yesterday's close, or today's open for a ticker with one day of history
+    reference = previous.close if previous else latest.open
+    change = (latest.close - reference) / reference * 100 if reference else 0.0
+    db.session.execute(db.update(Ticker).where(Ticker.id == ticker_id)
+                       .values(value=_format(latest.close), change_rate=f'{change:+.2f}%'))
+
+def chart(ticker_id, resolution='d', days=30):
+    """[(bucket, open, high, low, close)] for the last `days` days, oldest first."""
+    since = RESOLUTIONS['d'](datetime.utcnow()) - timedelta(days=days - 1)
+    return db.session.execute(
+        db.select(TickerRollup.bucket, TickerRollup.open, TickerRollup.high, TickerRollup.low, TickerRollup.close)
+        .where(TickerRollup.ticker_id == ticker_id, TickerRollup.resolution == resolution,
+               TickerRollup.bucket >= since)
+        .order_by(TickerRollup.bucket)).all()
+
+def delete_history(ticker_id):
+    for model in (TickerRollup, TickerPrice):
+        db.session.execute(db.delete(model).where(model.ticker_id == ticker_id))
+
+@click.command('ingest-prices')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def ingest_prices_command(path):
+    """Append ticker prices from a CSV file with ticker,timestamp,value columns."""
+    with open(path, 'rb') as stream:
+        try:
+            count = ingest(read_points(stream))
+        except ValueError as e:
+            db.session.rollback()
+            raise click.ClickException(str(e))
+    db.session.commit()
+    click.echo(f'Ingested {count} price points.')
@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, has_app_context
+from flask_login import UserMixin
+from sqlalchemy.orm import Session
+from app import db, login
+from app.models import User
+
+# Flask-Login reloads the user on every request. Instead of a query each
+# time, every worker keeps a small LRU of user snapshots (the columns the
+# templates and permission checks read) and trusts one for USER_CACHE_TTL
+# seconds. Writes that touch a user -- ORM updates such as blocking or
+# verifying, and ledger credit changes -- drop that user's snapshot here at
+# once and again after commit; other workers pick the change up when their
+# copy expires, so a block takes effect everywhere within the TTL.
+
+SNAPSHOT_FIELDS = ('id', 'username', 'email', 'credits', 'is_seller', 'is_buyer',
+                   'is_admin', 'is_blocked', 'is_verified', 'tax_id')
+
+class CachedUser(UserMixin):
+    """current_user stand-in built from a snapshot; anything else is read from the real row."""
+
+    def __init__(self, snapshot):
+        self.__dict__.update(snapshot)
+
+    @property
+    def is_active(self):
+        return not self.is_blocked
+
+    def __getattr__(self, name):
+        # Only reached for attributes outside the snapshot (relationships, methods)
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(db.session.get(User, self.id), name)
+
+    def __repr__(self):
+        return f'<CachedUser {self.username}>'
+
+class UserCache:
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and now - entry[1] < current_app.config['USER_CACHE_TTL']:
+                self._entries.move_to_end(user_id)
+                return entry[0]
+        row = db.session.execute(db.select(*(getattr(User, f) for f in SNAPSHOT_FIELDS))
+                                 .where(User.id == user_id)).first()
+        snapshot = dict(row._mapping) if row else None
+        with self._lock:
+            self._entries[user_id] = (snapshot, now)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > current_app.config['USER_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id, session=None):
+        """Forget a user now and once more when `session` (default db.session) commits."""
+        self._pop(user_id)
+        (session or db.session()).info.setdefault('stale_users', set()).add(user_id)
+        # The rest of this request should see the change too
+        if has_app_context() and getattr(g.get('_login_user'), 'id', None) == user_id:
+            g.pop('_login_user')
+
+    def _pop(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+user_cache = UserCache()
+
+@login.user_loader
+def load_user(id):
+    snapshot = user_cache.get(int(id))
+    # Blocked users are logged out on their next request
+    if snapshot is None or snapshot['is_blocked']:
+        return None
+    return CachedUser(snapshot)
+
+@db.event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    user_cache.invalidate(target.id, db.inspect(target).session)
+
+@db.event.listens_for(Session, 'after_commit')
+def _drop_stale(session):
+    # A request that reloaded the user between the write and the commit cached the old row
+    for user_id in session.info.pop('stale_users', ()):
+        user_cache._pop(user_id)
@@ -0,0 +1,418 @@
+"""Load test of the main marketplace flows.
+
+`seed` fills a database with synthetic categories, users, requests and bids
+(bulk Core inserts, so 100k requests / 1M bids take minutes, not hours).
+`run` then drives each scenario from several processes x threads, either
+through Flask's test client (no network, isolates the app) or over HTTP
+against gunicorn, and prints p50/p95/p99 latency and throughput. The api_*
+scenarios fetch the same data as marketplace and request_detail from
+/api/v1, with the token the seed creates for the admin account:
+
+    python benchmarks/load_test.py seed --db sqlite:////tmp/bench.db --requests 100000 --bids 1000000
+    python benchmarks/load_test.py run --db sqlite:////tmp/bench.db --driver client
+    python benchmarks/load_test.py run --db sqlite:////tmp/bench.db --driver http --gunicorn 4
+
+Without --db, `run` seeds a small temporary SQLite database first. Results
+can be saved with --save-baseline, together with the parameters they were
+measured with, and compared on later runs with --baseline; a scenario whose
+p95 or throughput is worse than the baseline by more than --tolerance makes
+the command exit with status 1. benchmarks/baseline.json holds the
+test-client figures of the default run:
+
+    python benchmarks/load_test.py run --driver client --save-baseline
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from config import Config, engine_options
+
+PASSWORD = 'bench'
+API_TOKEN = 'bench-api-token'
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+CATEGORIES = {
+    'PVC': ['Suspension', 'Emulsion', 'Compound'],
+    'PE': ['HDPE', 'LDPE', 'LLDPE'],
+    'PP': ['Homopolymer', 'Random Copolymer', 'Block Copolymer'],
+    'PET': ['Bottle Grade', 'Fiber Grade'],
+    'PS': ['GPPS', 'HIPS'],
+}
+ORIGINS = ['Turkey', 'Germany', 'China', 'Korea', 'Saudi Arabia', 'USA', 'Iran']
+PRICES = ['1100 USD / Ton', '1.050 EUR / Ton', '1,15 USD/kg', '36.500 TL / ton', '980 USD', 'negotiable']
+
+def make_config(url):
+    # Every simulated user logs in from one address, so the login limiter is off
+    return type('BenchConfig', (Config,), {
+        'SQLALCHEMY_DATABASE_URI': url,
+        'SQLALCHEMY_ENGINE_OPTIONS': engine_options(url),
+        'LOGIN_RATE_LIMIT': False,
+    })
+
+# Seeding
+
+def _chunks(rows, size=5000):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+def seed(url, users, requests, bids, rng, hash_method=None):
+    from werkzeug.security import generate_password_hash
+    from app import create_app, db, search, stats, bidding
+    from app.models import User, Request, Bid, CreditTransaction, Category, ApiToken
+    from app.api import hash_token
+    from app.pricing import parse_price, parse_quantity
+
+    app = create_app(make_config(url))
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        # Few categories: the ORM path keeps their materialized paths right
+        for name, subs in CATEGORIES.items():
+            parent = Category(name=name)
+            db.session.add(parent)
+            db.session.flush()
+            db.session.add_all([Category(name=sub, parent_id=parent.id) for sub in subs])
+        db.session.commit()
+
+        # Hashing is deliberately slow; every account shares one hash
+        password_hash = generate_password_hash(PASSWORD, method=hash_method or app.config['PASSWORD_HASH_METHOD'])
+        connection = db.session.connection()
+        user_rows = [{'id': 1, 'username': 'admin', 'email': 'admin@bench.local', 'password_hash': password_hash,
+                      'credits': 1000, 'is_admin': True, 'is_seller': True, 'is_buyer': True,
+                      'is_blocked': False, 'is_verified': True}]
+        user_rows += [{'id': i, 'username': f'user{i}', 'email': f'user{i}@bench.local',
+                       'password_hash': password_hash, 'credits': 100, 'is_admin': False,
+                       'is_seller': i % 2 == 0, 'is_buyer': True, 'is_blocked': False, 'is_verified': True}
+                      for i in range(2, users + 1)]
+        for chunk in _chunks(user_rows):
+            connection.execute(User.__table__.insert(), chunk)
+        connection.execute(ApiToken.__table__.insert(), {'user_id': 1, 'name': 'bench',
+                                                         'token_hash': hash_token(API_TOKEN)})
+        for chunk in _chunks([{'user_id': row['id'], 'amount': row['credits'], 'description': 'Seed',
+                               'timestamp': datetime.utcnow()} for row in user_rows]):
+            connection.execute(CreditTransaction.__table__.insert(), chunk)
+
+        # Core inserts skip the pricing, search and bid summary events, so parse
+        # here and rebuild the search index, daily rollup and summaries at the end
+        now = datetime.utcnow()
+        parsed_prices = {price: parse_price(price) for price in PRICES}
+        request_ids = []
+        for start in range(0, requests, 5000):
+            rows = []
+            for i in range(start, min(start + 5000, requests)):
+                category = rng.choice(list(CATEGORIES))
+                quantity = f'{rng.randint(1, 500)} Ton'
+                amount, unit = parse_quantity(quantity)
+                created = now - timedelta(minutes=rng.randint(0, 90 * 24 * 60))
+                rows.append({'id': i + 1, 'user_id': rng.randint(1, users), 'category': category,
+                             'sub_category': rng.choice(CATEGORIES[category]),
+                             'product_type': f'{category} grade {rng.randint(1, 99)}', 'spec': f'K{rng.randint(50, 80)}',
+                             'origin': rng.choice(ORIGINS), 'quantity': quantity,
+                             'quantity_amount': amount, 'quantity_unit': unit,
+                             'deadline': created + timedelta(days=rng.randint(1, 60)),
+                             'status': 'Open' if rng.random() < 0.8 else 'Closed', 'timestamp': created,
+                             'bid_count': None})
+            connection.execute(Request.__table__.insert(), rows)
+            request_ids.extend(row['id'] for row in rows)
+        for start in range(0, bids, 5000):
+            rows = []
+            for _ in range(start, min(start + 5000, bids)):
+                price = rng.choice(PRICES)
+                amount, currency, unit = parsed_prices[price]
+                rows.append({'request_id': rng.choice(request_ids), 'seller_id': rng.randrange(2, users + 1, 2) if users > 1 else 1,
+                             'price': price, 'price_amount': amount, 'price_currency': currency,
+                             'price_unit': unit, 'timestamp': now - timedelta(minutes=rng.randint(0, 60 * 24))})
+            connection.execute(Bid.__table__.insert(), rows)
+        search.rebuild_index(connection)
+        stats.rebuild(connection)
+        db.session.commit()
+        bidding.backfill_summaries(batch_size=5000)
+
+def dataset_size(url):
+    from sqlalchemy import create_engine, text
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        size = {'users': connection.scalar(text('SELECT max(id) FROM "user"')),
+                'requests': connection.scalar(text('SELECT max(id) FROM request'))}
+    engine.dispose()
+    return size
+
+# Drivers: both return (status, body) and keep the session cookie
+
+class ClientSession:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, headers=None):
+        response = self.client.open(path, method=method, data=data, headers=headers)
+        return response.status_code, response.get_data(as_text=True)
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+class HTTPSession:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(), _NoRedirect())
+
+    def request(self, method, path, data=None, headers=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers or {})
+        try:
+            with self.opener.open(req, timeout=60) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode()
+
+def log_in(session, username, password=PASSWORD):
+    _, page = session.request('GET', '/login')
+    match = CSRF_RE.search(page)
+    data = {'username': username, 'password': password}
+    if match:
+        data['csrf_token'] = match.group(1)
+    status, body = session.request('POST', '/login', data)
+    # A rejected login also redirects, back to the form
+    if status == 302 and 'login' in body:
+        status = 401
+    return status, body
+
+# Scenarios: (username to log in as beforehand or None, step)
+
+def seller_name(size, rng):
+    return f'user{rng.randrange(2, size["users"] + 1, 2)}' if size['users'] > 1 else 'admin'
+
+ADMIN_PAGES = ['/admin/', '/admin/requests', '/admin/users', '/admin/transactions']
+
+def api_get(session, path):
+    return session.request('GET', path, headers={'Authorization': f'Bearer {API_TOKEN}'})
+
+SCENARIOS = {
+    'login': (None, lambda s, size, rng: log_in(s, seller_name(size, rng))),
+    'marketplace': ('seller', lambda s, size, rng: s.request(
+        'GET', '/marketplace' if rng.random() < 0.5 else f'/marketplace?category={rng.choice(list(CATEGORIES))}')),
+    'request_detail': ('seller', lambda s, size, rng: s.request(
+        'GET', f'/request/{rng.randint(1, size["requests"])}' + ('?sort=price' if rng.random() < 0.5 else ''))),
+    'bid': ('seller', lambda s, size, rng: s.request(
+        'POST', f'/request/{rng.randint(1, size["requests"])}', {'price': rng.choice(PRICES), 'details': 'load test'})),
+    'admin': ('admin', lambda s, size, rng: s.request('GET', rng.choice(ADMIN_PAGES))),
+    # The marketplace page's data (20 requests) and a request page's offers, as JSON
+    'api_requests': (None, lambda s, size, rng: api_get(
+        s, '/api/v1/requests?limit=20' if rng.random() < 0.5 else
+        f'/api/v1/requests?limit=20&category={rng.choice(list(CATEGORIES))}')),
+    'api_bids': (None, lambda s, size, rng: api_get(
+        s, f'/api/v1/bids?request_id={rng.randint(1, size["requests"])}')),
+}
+
+def worker(args):
+    driver, target, scenario, threads, iterations, size, seed_value = args
+    user, step = SCENARIOS[scenario]
+    if driver == 'client':
+        from app import create_app
+        app = create_app(make_config(target))
+        new_session = lambda: ClientSession(app)
+    else:
+        new_session = lambda: HTTPSession(target)
+
+    barrier = threading.Barrier(threads)
+    results, failed = [], []
+    def run_thread(index):
+        rng = random.Random(f'{seed_value}-{os.getpid()}-{index}')
+        session = new_session()
+        logged_in = not user or log_in(session, 'admin' if user == 'admin' else seller_name(size, rng))[0] < 400
+        barrier.wait()
+        if not logged_in:
+            failed.append(user)
+            return
+        latencies, errors = [], 0
+        started = time.time()
+        for _ in range(iterations):
+            if scenario == 'login':
+                session = new_session()
+            t = time.perf_counter()
+            try:
+                status, _ = step(session, size, rng)
+            except Exception:
+                status = 599
+            latencies.append(time.perf_counter() - t)
+            errors += status >= 400
+        results.append((latencies, errors, started, time.time()))
+
+    pool = [threading.Thread(target=run_thread, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    if failed:
+        raise SystemExit(f'{scenario}: could not log in as {failed[0]}')
+    return results
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0.0
+
+def run_scenario(driver, target, scenario, processes, threads, iterations, size, seed_value):
+    args = [(driver, target, scenario, threads, iterations, size, f'{seed_value}-{i}') for i in range(processes)]
+    if processes == 1:
+        results = worker(args[0])
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = [r for chunk in pool.map(worker, args) for r in chunk]
+    latencies = sorted(l for r in results for l in r[0])
+    elapsed = max(r[3] for r in results) - min(r[2] for r in results)
+    return {'requests': len(latencies), 'errors': sum(r[1] for r in results),
+            'rps': len(latencies) / elapsed if elapsed else 0.0,
+            'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99)}
+
+def start_gunicorn(url, workers, env=None):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen(
+        # Production settings from gunicorn.conf.py, with our worker count and port
+        ['gunicorn', '-c', 'gunicorn.conf.py', '-w', str(workers), '-b', f'127.0.0.1:{port}'],
+        cwd=ROOT, env={**os.environ, 'DATABASE_URL': url, 'LOGIN_RATE_LIMIT': 'off', **(env or {})},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base_url + '/login', timeout=1).close()
+            return server, base_url
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit('gunicorn did not start within 30 seconds')
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for scenario, current in results.items():
+        previous = baseline.get(scenario)
+        if not previous:
+            continue
+        if current['p95'] > previous['p95'] * (1 + tolerance):
+            regressions.append(f'{scenario}: p95 {previous["p95"]:.1f} -> {current["p95"]:.1f} ms')
+        if current['rps'] < previous['rps'] * (1 - tolerance):
+            regressions.append(f'{scenario}: throughput {previous["rps"]:.1f} -> {current["rps"]:.1f} req/s')
+    return regressions
+
+def parameters(args, size):
+    """What a baseline was measured with, so later runs can tell whether they compare."""
+    return {'dataset': 'temporary SQLite' if args.db is None else args.db.split(':', 1)[0],
+            'size': size, 'bids': args.bids if args.db is None else None,
+            'processes': args.processes, 'threads': args.threads, 'iterations': args.iterations,
+            'gunicorn': args.gunicorn if args.driver == 'http' and not args.base_url else None,
+            'seed': args.seed, 'python': platform.python_version(), 'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+
+def run(args):
+    tmp = None
+    url = args.db
+    if url is None:
+        tmp = tempfile.TemporaryDirectory()
+        url = f'sqlite:///{os.path.join(tmp.name, "bench.db")}'
+        print(f'Seeding {args.users} users, {args.requests} requests, {args.bids} bids...')
+        seed(url, args.users, args.requests, args.bids, random.Random(args.seed))
+    size = dataset_size(url)
+
+    server = None
+    target = url
+    if args.driver == 'http':
+        if args.base_url:
+            target = args.base_url
+        else:
+            server, target = start_gunicorn(url, args.gunicorn)
+    try:
+        print(f'{"scenario":<16} {"requests":>9} {"errors":>7} {"req/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+        results = {}
+        for scenario in args.scenarios:
+            r = results[scenario] = run_scenario(args.driver, target, scenario, args.processes,
+                                                 args.threads, args.iterations, size, args.seed)
+            print(f'{scenario:<16} {r["requests"]:>9} {r["errors"]:>7} {r["rps"]:>9.1f} '
+                  f'{r["p50"]:>8.1f} {r["p95"]:>8.1f} {r["p99"]:>8.1f}')
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        if tmp:
+            tmp.cleanup()
+
+    # Baselines are keyed by driver: test-client and HTTP numbers aren't comparable
+    stored = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+    used = parameters(args, size)
+    if args.save_baseline:
+        stored[args.driver] = {'parameters': used, 'scenarios': results}
+        with open(args.baseline, 'w') as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+        print(f'Baseline saved to {args.baseline}')
+    elif args.driver in stored:
+        baseline = stored[args.driver]
+        differing = sorted(k for k, v in baseline['parameters'].items() if used.get(k) != v)
+        if differing:
+            print(f'Note: the baseline was measured with different {", ".join(differing)}')
+        regressions = compare(results, baseline['scenarios'], args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions against {args.baseline} (tolerance {args.tolerance:.0%})')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_scale(p):
+        p.add_argument('--users', type=int, default=200)
+        p.add_argument('--requests', type=int, default=5000)
+        p.add_argument('--bids', type=int, default=50000)
+        p.add_argument('--seed', type=int, default=42, help='random seed, for reproducible data and traffic')
+
+    p = commands.add_parser('seed', help='fill a database with synthetic data (drops existing tables)')
+    p.add_argument('--db', required=True, help='database URL')
+    add_scale(p)
+
+    p = commands.add_parser('run', help='run the scenarios and report latency and throughput')
+    p.add_argument('--db', help='seeded database URL; a small temporary SQLite database if omitted')
+    add_scale(p)
+    p.add_argument('--driver', choices=['client', 'http'], default='client')
+    p.add_argument('--base-url', help='already running server for --driver http (must use --db)')
+    p.add_argument('--gunicorn', type=int, default=4, metavar='WORKERS',
+                   help='gunicorn workers to start for --driver http without --base-url')
+    p.add_argument('--processes', type=int, default=2)
+    p.add_argument('--threads', type=int, default=4)
+    p.add_argument('--iterations', type=int, default=50, help='requests per thread and scenario')
+    p.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    p.add_argument('--baseline', default=DEFAULT_BASELINE)
+    p.add_argument('--save-baseline', action='store_true')
+    p.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown before failing (0.25 = 25%%)')
+
+    args = parser.parse_args()
+    if args.command == 'seed':
+        seed(args.db, args.users, args.requests, args.bids, random.Random(args.seed))
+        print(f'Seeded {args.db}: {dataset_size(args.db)}')
+    else:
+        run(args)
+
+if __name__ == '__main__':
+    main()
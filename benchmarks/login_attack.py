@@ -0,0 +1,97 @@
+"""Login throughput under a credential-stuffing burst.
+
+Starts gunicorn on a small seeded SQLite database and floods POST /login with
+wrong passwords from several processes, while a probe measures how long an
+ordinary page (GET /login) takes to come back. It runs once with the login
+rate limiter off and once with it on, for each password hash method given,
+and also prints what one password check costs with each method.
+
+    python benchmarks/login_attack.py --seconds 10
+    python benchmarks/login_attack.py --hash-method scrypt:32768:8:1 --hash-method scrypt:16384:8:1
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from werkzeug.security import generate_password_hash, check_password_hash
+from load_test import seed, start_gunicorn, HTTPSession, log_in, percentile
+
+def attacker(args):
+    base_url, seconds, index = args
+    rng = random.Random(index)
+    session = HTTPSession(base_url)
+    statuses = {}
+    ends_at = time.monotonic() + seconds
+    while time.monotonic() < ends_at:
+        # Real account names, wrong passwords
+        status, _ = log_in(session, f'user{rng.randint(2, 50)}', password=f'guess{rng.random()}')
+        statuses[status] = statuses.get(status, 0) + 1
+    return statuses
+
+def probe(base_url, seconds):
+    session = HTTPSession(base_url)
+    latencies = []
+    ends_at = time.monotonic() + seconds
+    while time.monotonic() < ends_at:
+        started = time.perf_counter()
+        session.request('GET', '/login')
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.05)
+    return sorted(latencies)
+
+def run(label, url, env, args):
+    server, base_url = start_gunicorn(url, args.workers, env)
+    try:
+        with multiprocessing.Pool(args.attackers) as pool:
+            pending = pool.map_async(attacker, [(base_url, args.seconds, i) for i in range(args.attackers)])
+            latencies = probe(base_url, args.seconds)
+            results = pending.get()
+    finally:
+        server.terminate()
+        server.wait()
+    statuses = {}
+    for result in results:
+        for status, count in result.items():
+            statuses[status] = statuses.get(status, 0) + count
+    attempts = sum(statuses.values())
+    rejected = statuses.get(429, 0)
+    print(f'{label:<40} {attempts / args.seconds:>10.1f} {(attempts - rejected) / args.seconds:>9.1f} '
+          f'{rejected / attempts if attempts else 0:>9.0%} {percentile(latencies, 0.5):>8.1f} '
+          f'{percentile(latencies, 0.95):>8.1f}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hash-method', action='append', help='werkzeug hash method (repeatable)')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--attackers', type=int, default=8, help='attacking processes')
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+    methods = args.hash_method or [os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:16384:8:1']
+
+    print(f'{"method":<24} {"ms per check":>12}')
+    for method in methods:
+        hashed = generate_password_hash('secret', method=method)
+        started = time.perf_counter()
+        for _ in range(10):
+            check_password_hash(hashed, 'wrong')
+        print(f'{method:<24} {(time.perf_counter() - started) * 100:>12.1f}')
+    print()
+
+    print(f'{"run":<40} {"attempts/s":>10} {"hashed/s":>9} {"rejected":>9} {"p50 ms":>8} {"p95 ms":>8}')
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f'sqlite:///{os.path.join(tmp, "attack.db")}'
+        for method in methods:
+            # Stored hashes decide what a check costs, so seed them with the method under test
+            seed(url, users=50, requests=100, bids=100, rng=random.Random(1), hash_method=method)
+            for limited in (False, True):
+                env = {'PASSWORD_HASH_METHOD': method, 'LOGIN_RATE_LIMIT': 'on' if limited else 'off'}
+                run(f'{method}, limiter {"on" if limited else "off"}', url, env, args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Boot time and time to first request.
+
+Measures the two halves of a container start on a fresh SQLite database:
+
+  * bootstrap: the old boot.sh ran three interpreters (create_all, the
+    category seed and the admin script), each importing the app and calling
+    create_app(); `flask bootstrap` does all of it in one process.
+  * serving: gunicorn from start until GET /login answers, then the slowest
+    of a few more requests (a worker's first render compiles its templates),
+    building the app in each worker versus once in a --preload master with
+    templates precompiled (wsgi.py). Memory is the
+    proportional set size (PSS) of master and workers, so pages shared
+    copy-on-write are counted once.
+
+    python benchmarks/startup.py --workers 4 --repeat 3
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What the three interpreters of the old boot.sh did
+LEGACY_STEPS = (
+    'from app import create_app, db; app = create_app(); app.app_context().push(); db.create_all()',
+    'from app import create_app; from app.bootstrap import seed_categories; '
+    'app = create_app(); app.app_context().push(); seed_categories()',
+    'from app import create_app; from app.bootstrap import ensure_admin; '
+    'app = create_app(); app.app_context().push(); ensure_admin("admin", "admin@example.com", "admin")',
+)
+
+SERVERS = {
+    'per-worker app': ['-c', '/dev/null', '-k', 'gthread', '--threads', '8', 'app:create_app()'],
+    'preload + precompiled': ['-c', 'gunicorn.conf.py'],
+}
+
+def timed(commands, env):
+    started = time.perf_counter()
+    for command in commands:
+        subprocess.run(command, cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def pss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('Pss:'))
+    except (OSError, StopIteration):
+        return 0
+
+def children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+def get(url):
+    started = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=5) as response:
+        response.read()
+    return time.perf_counter() - started
+
+def serve(args, workers, env):
+    """(seconds to first response, slowest of the next requests, total PSS in MB)."""
+    port = free_port()
+    url = f'http://127.0.0.1:{port}/login'
+    started = time.perf_counter()
+    server = subprocess.Popen(['gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', *args], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if time.perf_counter() - started > 60:
+                raise SystemExit('gunicorn did not answer within 60 seconds')
+            try:
+                get(url)
+                break
+            except OSError:
+                time.sleep(0.02)
+        first = time.perf_counter() - started
+        # New connections land on whichever worker accepts first, so a few per
+        # worker reach the cold ones, which compile templates on first render
+        slowest = max(get(url) for _ in range(workers * 4))
+        memory = (pss_kb(server.pid) + sum(pss_kb(pid) for pid in children(server.pid))) / 1024
+    finally:
+        server.terminate()
+        server.wait()
+    return first, slowest, memory
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"bootstrap":<24} {"seconds":>8}')
+    legacy, single = [], []
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {**os.environ, 'DATABASE_URL': f'sqlite:///{os.path.join(tmp, "a.db")}'}
+            legacy.append(timed([[sys.executable, '-c', step] for step in LEGACY_STEPS], env))
+            env['DATABASE_URL'] = f'sqlite:///{os.path.join(tmp, "b.db")}'
+            single.append(timed([['flask', '--app', 'app', 'bootstrap']], env))
+    print(f'{"three interpreters":<24} {statistics.median(legacy):>8.2f}')
+    print(f'{"flask bootstrap":<24} {statistics.median(single):>8.2f}')
+    print()
+
+    print(f'{"gunicorn":<24} {"first req s":>11} {"slowest next ms":>15} {"PSS MB":>8}')
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, 'DATABASE_URL': f'sqlite:///{os.path.join(tmp, "serve.db")}'}
+        timed([['flask', '--app', 'app', 'bootstrap']], env)
+        for label, server_args in SERVERS.items():
+            runs = [serve(server_args, args.workers, env) for _ in range(args.repeat)]
+            first, slowest, memory = (statistics.median(r[i] for r in runs) for i in range(3))
+            print(f'{label:<24} {first:>11.2f} {slowest * 1000:>15.1f} {memory:>8.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Concurrent write throughput per database backend.
+
+Each worker process builds its own app (like a gunicorn worker) and submits
+bids in a loop, one transaction per bid, for a fixed time. SQLite is run
+twice, with and without the SQLITE_PRAGMAS from config.py, so the effect of
+WAL/busy_timeout is visible; pass --url for a PostgreSQL database to compare.
+
+    python benchmarks/write_throughput.py --workers 4 --seconds 10
+    python benchmarks/write_throughput.py --url postgresql://user:pw@localhost/bench
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.exc import OperationalError
+from config import Config, engine_options
+
+def make_config(url, tuned):
+    options = {
+        'SQLALCHEMY_DATABASE_URI': url,
+        'SQLALCHEMY_ENGINE_OPTIONS': engine_options(url),
+    }
+    if not tuned:
+        options['SQLITE_PRAGMAS'] = {}
+    return type('BenchConfig', (Config,), options)
+
+def setup(config):
+    from app import create_app, db
+    from app.models import User, Request
+    app = create_app(config)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='bench', email='bench@example.com', is_seller=True)
+        req = Request(author=user, product_type='PVC', quantity='1 Ton')
+        db.session.add_all([user, req])
+        db.session.commit()
+        return user.id, req.id
+
+def worker(args):
+    url, tuned, user_id, request_id, seconds = args
+    from app import create_app, db, stats
+    from app.models import Bid
+    app = create_app(make_config(url, tuned))
+    latencies, errors = [], 0
+    with app.app_context():
+        ends_at = time.monotonic() + seconds
+        while time.monotonic() < ends_at:
+            started = time.monotonic()
+            try:
+                db.session.add(Bid(request_id=request_id, seller_id=user_id, price='1000 USD / Ton'))
+                stats.record(stats.BIDS)
+                db.session.commit()
+                latencies.append(time.monotonic() - started)
+            except OperationalError:
+                db.session.rollback()
+                errors += 1
+    return latencies, errors
+
+def run(label, url, tuned, workers, seconds):
+    user_id, request_id = setup(make_config(url, tuned))
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.map(worker, [(url, tuned, user_id, request_id, seconds)] * workers)
+    latencies = sorted(l for result in results for l in result[0])
+    errors = sum(result[1] for result in results)
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+    print(f'{label:<28} {len(latencies) / seconds:>10.1f} {pct(0.5):>8.2f} {pct(0.99):>8.2f} {errors:>7}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', action='append', default=[], help='extra database URL to compare (repeatable)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print(f'{"backend":<28} {"writes/s":>10} {"p50 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for tuned in (False, True):
+            url = f'sqlite:///{os.path.join(tmp, f"bench-{tuned}.db")}'
+            run('sqlite ' + ('WAL + busy_timeout' if tuned else 'defaults'), url, tuned,
+                args.workers, args.seconds)
+    for url in args.url:
+        run(url.split('://')[0], url, True, args.workers, args.seconds)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,10 @@
 #!/bin/bash
-# Initialize database
-python -c "from app import create_app, db; app = create_app(); app.app_context().push(); db.create_all()"
-# Seed categories if needed
-python seed_categories.py
-# Create admin if needed
-python create_admin.py
+# Create/upgrade the schema, backfill, seed categories and the admin user
+flask --app app bootstrap
 
-# Run Gunicorn
-exec gunicorn -w 4 -b 0.0.0.0:5000 "app:create_app()"
+# Background job worker (deadline expiry, seller notifications, exports);
+# restarted if it ever exits
+(while true; do flask --app app run-jobs; sleep 5; done) &
+
+# Gunicorn settings (preloaded app, threaded workers) are in gunicorn.conf.py
+exec gunicorn -c gunicorn.conf.py
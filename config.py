@@ -1,6 +1,77 @@
 import os
 
+def database_url():
+    url = os.environ.get('DATABASE_URL') or 'sqlite:///app.db'
+    # SQLAlchemy only accepts the postgresql:// spelling
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def engine_options(url):
+    if url.startswith('postgresql'):
+        # One pool per gunicorn worker: keep pool_size * workers under max_connections
+        return {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE') or 5),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW') or 10),
+            'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT') or 10),
+            'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE') or 1800),
+            'pool_pre_ping': True,
+        }
+    return {}
+
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///app.db'
+    SQLALCHEMY_DATABASE_URI = database_url()
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Applied to every new SQLite connection: WAL lets readers run alongside the
+    # single writer, busy_timeout makes writers queue instead of failing with
+    # "database is locked", and NORMAL sync is safe under WAL.
+    SQLITE_PRAGMAS = {
+        'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE') or 'WAL',
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000),
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL',
+    }
+    # Werkzeug hash method and cost for new and rehashed passwords. Each login
+    # pays this cost in CPU on a web worker, so keep it to tens of milliseconds.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:16384:8:1'
+    # Account created by `flask bootstrap` when no user has this name yet
+    ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME') or 'admin'
+    ADMIN_EMAIL = os.environ.get('ADMIN_EMAIL') or 'admin@example.com'
+    ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD') or 'admin'
+    # Token buckets checked before a password is hashed: burst size and refill per minute
+    LOGIN_RATE_LIMIT = (os.environ.get('LOGIN_RATE_LIMIT') or 'on').lower() not in ('0', 'off', 'false', 'no')
+    LOGIN_IP_BURST = int(os.environ.get('LOGIN_IP_BURST') or 20)
+    LOGIN_IP_PER_MINUTE = float(os.environ.get('LOGIN_IP_PER_MINUTE') or 10)
+    LOGIN_USER_BURST = int(os.environ.get('LOGIN_USER_BURST') or 10)
+    LOGIN_USER_PER_MINUTE = float(os.environ.get('LOGIN_USER_PER_MINUTE') or 2)
+    MARKETPLACE_PAGE_SIZE = int(os.environ.get('MARKETPLACE_PAGE_SIZE') or 20)
+    INBOX_PAGE_SIZE = int(os.environ.get('INBOX_PAGE_SIZE') or 50)
+    DASHBOARD_PAGE_SIZE = int(os.environ.get('DASHBOARD_PAGE_SIZE') or 20)
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 5000)
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL') or 5)
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+    SITE_CACHE_TTL = float(os.environ.get('SITE_CACHE_TTL') or 5)
+    SEARCH_RESULTS_LIMIT = int(os.environ.get('SEARCH_RESULTS_LIMIT') or 50)
+    # /api/v1 (app.api): default and largest page, and most ids per lookup
+    API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE') or 50)
+    API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE') or 500)
+    API_MAX_IDS = int(os.environ.get('API_MAX_IDS') or 100)
+    BID_STREAM_POLL = float(os.environ.get('BID_STREAM_POLL') or 2)
+    BID_STREAM_TIMEOUT = float(os.environ.get('BID_STREAM_TIMEOUT') or 55)
+    BASE_CURRENCY = os.environ.get('BASE_CURRENCY') or 'USD'
+    # Background jobs (app.jobs): seconds between polls of an idle worker, before
+    # a crashed worker's job is retried, and the base of the retry backoff
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL') or 1)
+    JOB_LOCK_TIMEOUT = int(os.environ.get('JOB_LOCK_TIMEOUT') or 600)
+    JOB_RETRY_DELAY = int(os.environ.get('JOB_RETRY_DELAY') or 30)
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS') or 5)
+    DEADLINE_SWEEP_INTERVAL = int(os.environ.get('DEADLINE_SWEEP_INTERVAL') or 300)
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS') or 180)
+    ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE') or 500)
+    ARCHIVE_INTERVAL = int(os.environ.get('ARCHIVE_INTERVAL') or 86400)
+    EXPORT_DIR = os.environ.get('EXPORT_DIR')  # defaults to <instance>/exports
+    # Per-request latency / SQL instrumentation, served at /metrics and /admin/metrics
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD') or 0.1)
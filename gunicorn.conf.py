@@ -0,0 +1,19 @@
+# Read by gunicorn from the working directory (boot.sh runs `gunicorn -c gunicorn.conf.py`)
+import os
+
+wsgi_app = 'wsgi:app'
+bind = os.environ.get('BIND') or '0.0.0.0:5000'
+workers = int(os.environ.get('WEB_CONCURRENCY') or 4)
+# Threaded workers so open bid streams don't tie up a whole process
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS') or 8)
+# Import the code and build the app once in the master; workers fork from it
+# and share those pages copy-on-write instead of each importing everything
+preload_app = True
+
+def post_fork(server, worker):
+    # Never share a pooled database connection across processes. Building the
+    # app opens none, but drop anything the master may have left in the pool.
+    from app import db
+    with server.app.wsgi().app_context():
+        db.engine.dispose(close=False)
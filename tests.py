@@ -1,11 +1,32 @@
+import html
+import io
+import json
+import os
+import re
+import tempfile
+import threading
 import unittest
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from flask import g
+from werkzeug.security import generate_password_hash
 from app import create_app, db
-from app.models import User, Request
+from app.models import User, Request, Bid, CreditTransaction, Category, Ticker, Job, Notification, \
+    Subscription, ArchivedRequest, ArchivedBid, RequestAttribute, TickerPrice, TickerRollup
+from app.cache import site_cache, get_tickers
+from app.search import search_request_ids
+from app import stats, ledger, categories, pricing, jobs, matching, httpcache, ratelimit, archive, \
+    ticker_history, bootstrap, bidding
+from app.usercache import user_cache
+from app.bulk import import_requests
 from config import Config
 
 class TestConfig(Config):
     TESTING = True
+    WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    MARKETPLACE_PAGE_SIZE = 2
+    BID_STREAM_TIMEOUT = 0
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
@@ -43,5 +64,1080 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(req.author.username, 'john')
         self.assertEqual(u.requests.count(), 1)
 
+class ViewCase(unittest.TestCase):
+    config = TestConfig
+
+    def setUp(self):
+        self.app = create_app(self.config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        site_cache.clear()
+        user_cache.clear()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, user):
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
+        # Requests share the test's app context, so drop Flask-Login's cached user
+        g.pop('_login_user', None)
+
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            # A fresh app context gives the view its own session and g, so objects
+            # already loaded by the test can't hide queries
+            with self.app.app_context():
+                yield statements
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertLessEqual(len(statements), budget,
+                             f'{len(statements)} queries over budget of {budget}:\n' + '\n'.join(statements))
+
+class MarketplaceCase(ViewCase):
+    def setUp(self):
+        super().setUp()
+        self.buyer = User(username='buyer', email='buyer@example.com')
+        self.seller = User(username='seller', email='seller@example.com', is_seller=True)
+        db.session.add_all([self.buyer, self.seller])
+        db.session.commit()
+        now = datetime(2024, 1, 1)
+        for i in range(5):
+            db.session.add(Request(author=self.buyer, product_type=f'PVC {i}', quantity='1 Ton',
+                                   category='Polymers' if i % 2 else 'Chemicals',
+                                   deadline=now + timedelta(days=i), timestamp=now))
+        db.session.commit()
+        self.login(self.seller)
+
+    def test_cursor_walks_every_request_once(self):
+        seen, cursor = [], None
+        while True:
+            data = self.client.get('/marketplace.json', query_string={'cursor': cursor} if cursor else {}).get_json()
+            seen += [item['id'] for item in data['items']]
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(seen, [5, 4, 3, 2, 1])
+
+    def test_filters(self):
+        data = self.client.get('/marketplace.json?category=Polymers').get_json()
+        self.assertEqual([item['id'] for item in data['items']], [4, 2])
+        data = self.client.get('/marketplace.json?deadline_from=2024-01-04').get_json()
+        self.assertEqual([item['id'] for item in data['items']], [5, 4])
+        self.assertEqual(self.client.get('/marketplace.json?cursor=bogus').status_code, 400)
+
+    def test_own_requests_hidden(self):
+        self.login(self.buyer)
+        data = self.client.get('/marketplace.json').get_json()
+        self.assertEqual(data['items'], [])
+
+class SiteCacheCase(ViewCase):
+    def test_admin_write_invalidates_tickers(self):
+        admin = User(username='admin', email='admin@example.com', is_admin=True)
+        db.session.add(admin)
+        db.session.commit()
+        self.assertEqual(get_tickers(), [])
+
+        # A write that bypasses invalidate() stays hidden until the TTL expires
+        db.session.add(Ticker(name='USD/TRY', value='32.5', change_rate='+0.1%'))
+        db.session.commit()
+        self.assertEqual(get_tickers(), [])
+
+        self.login(admin)
+        self.client.post('/admin/tickers', data={'name': 'EUR/TRY', 'value': '35', 'change': '-0.2%'})
+        self.assertEqual(sorted(t.name for t in get_tickers()), ['EUR/TRY', 'USD/TRY'])
+
+class SearchCase(ViewCase):
+    def test_index_follows_request_writes(self):
+        u = User(username='john', email='john@example.com')
+        pvc = Request(author=u, product_type='PVC', spec='K70', origin='Macaristan', quantity='1 Ton')
+        pe = Request(author=u, product_type='PE Film', application='Ambalaj Şişirme', quantity='1 Ton')
+        db.session.add_all([u, pvc, pe])
+        db.session.commit()
+
+        self.assertEqual(search_request_ids('pvc k7'), [pvc.id])
+        # Turkish letters fold both ways
+        self.assertEqual(search_request_ids('SISIRME'), [pe.id])
+        self.assertEqual(search_request_ids('macarıstan'), [pvc.id])
+
+        pvc.spec = 'K67'
+        db.session.commit()
+        self.assertEqual(search_request_ids('k70'), [])
+        self.assertEqual(search_request_ids('k67'), [pvc.id])
+
+        db.session.delete(pe)
+        db.session.commit()
+        self.assertEqual(search_request_ids('film'), [])
+        self.assertEqual(search_request_ids('"*)(-'), [])
+
+class QueryBudgetCase(ViewCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = User(username='admin', email='admin@example.com', is_admin=True, is_seller=True)
+        db.session.add(self.admin)
+        for i in range(10):
+            u = User(username=f'user{i}', email=f'user{i}@example.com', is_seller=True)
+            req = Request(author=self.admin, product_type=f'PVC {i}', quantity='1 Ton')
+            db.session.add_all([u, req])
+            db.session.flush()
+            db.session.add(CreditTransaction(user_id=u.id, amount=5))
+            db.session.add_all([Bid(request=req, bidder=u, price='100 USD') for _ in range(3)])
+            db.session.add(Bid(request=req, bidder=self.admin, price='90 USD'))
+        db.session.commit()
+        self.login(self.admin)
+        # Warm the site chrome and category tree caches
+        self.client.get('/')
+        self.client.get('/marketplace')
+
+    def test_views_stay_within_budget(self):
+        budgets = {
+            '/request/1': 3,
+            '/dashboard': 3,
+            '/marketplace': 2,
+            '/admin/': 4,
+            '/admin/requests': 2,
+            '/admin/users': 2,
+            '/admin/transactions': 2,
+        }
+        for url, budget in budgets.items():
+            with self.subTest(url=url), self.assertMaxQueries(budget):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+class BidStreamCase(ViewCase):
+    def test_stream_replays_bids_after_last_event(self):
+        buyer = User(username='buyer', email='buyer@example.com')
+        seller = User(username='seller', email='seller@example.com', is_seller=True)
+        req = Request(author=buyer, product_type='PVC', quantity='1 Ton')
+        db.session.add_all([buyer, seller, req])
+        db.session.commit()
+
+        self.login(seller)
+        self.client.post(f'/request/{req.id}', data={'price': '1100 USD', 'details': 'CIF'})
+        self.client.post(f'/request/{req.id}', data={'price': '1050 USD', 'details': 'FOB'})
+        self.assertEqual(self.client.get(f'/request/{req.id}/bids/stream').status_code, 403)
+
+        self.login(buyer)
+        body = self.client.get(f'/request/{req.id}/bids/stream', headers={'Last-Event-ID': '1'}).get_data(as_text=True)
+        self.assertNotIn('id: 1\n', body)
+        self.assertIn('id: 2\nevent: bid\n', body)
+        self.assertIn('"price": "1050 USD"', body)
+        self.assertIn('"seller": "seller"', body)
+
+class DailyStatCase(ViewCase):
+    def test_write_paths_match_rebuild(self):
+        db.session.add(Category(name='Polymers'))
+        db.session.commit()
+        self.client.post('/register', data={'username': 'ali', 'email': 'ali@example.com',
+                                            'password': 'x', 'password_2': 'x', 'is_seller': 'y'})
+        ali = User.query.filter_by(username='ali').one()
+        self.login(ali)
+        self.client.post('/buy_credits', data={'package': '10'})
+        self.client.post('/create_request', data={'category': 'Polymers', 'product_type': 'PVC',
+                                                  'quantity': '1 Ton', 'deadline': '2030-01-01'})
+        self.assertEqual(Request.query.count(), 1)
+
+        incremental = stats.totals()
+        self.assertEqual(incremental[stats.SIGNUPS], 1)
+        self.assertEqual(incremental[stats.CREDITS_PURCHASED], 10)
+        self.assertEqual(incremental[stats.CREDITS_SPENT], 1)
+        self.assertEqual(incremental['requests:Polymers'], 1)
+
+        with db.engine.begin() as connection:
+            stats.rebuild(connection)
+        db.session.expire_all()
+        self.assertEqual(stats.totals(), incremental)
+        self.assertEqual(self.client.get('/admin/').status_code, 403)
+
+class LedgerStressCase(unittest.TestCase):
+    # Needs a real file: an in-memory SQLite database is one shared connection
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        config = type('FileConfig', (TestConfig,), {'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.path}'})
+        self.app = create_app(config)
+        with self.app.app_context():
+            db.create_all()
+            user = User(username='busy', email='busy@example.com')
+            db.session.add(user)
+            db.session.flush()
+            ledger.apply(user.id, 150, 'Opening balance')
+            db.session.commit()
+            self.user_id = user.id
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.engine.dispose()
+        os.remove(self.path)
+
+    def test_parallel_debits_never_overdraw(self):
+        results = []
+        def debit(n):
+            with self.app.app_context():
+                for _ in range(n):
+                    try:
+                        ledger.apply(self.user_id, -1, 'Stress debit')
+                        db.session.commit()
+                        results.append(True)
+                    except ledger.InsufficientCredits:
+                        db.session.rollback()
+                        results.append(False)
+        threads = [threading.Thread(target=debit, args=(25,)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        with self.app.app_context():
+            user = db.session.get(User, self.user_id)
+            self.assertEqual(results.count(True), 150)
+            self.assertEqual(user.credits, 0)
+            self.assertEqual(ledger.ledger_total(self.user_id), user.credits)
+
+class TransactionLogCase(ViewCase):
+    def setUp(self):
+        super().setUp()
+        admin = User(username='admin', email='admin@example.com', is_admin=True)
+        ali = User(username='ali', email='ali@example.com')
+        db.session.add_all([admin, ali])
+        db.session.flush()
+        for amount in (10, -1, -1, 20):
+            ledger.apply(ali.id, amount, 'Test')
+        ledger.apply(admin.id, 5, 'Test')
+        db.session.commit()
+        self.login(admin)
+
+    def test_filters_and_export(self):
+        page = self.client.get('/admin/transactions?user=ali&sign=debit').get_data(as_text=True)
+        self.assertEqual(page.count('<td>-1</td>'), 2)
+        self.assertNotIn('<td>20</td>', page)
+
+        csv_body = self.client.get('/admin/transactions/export?format=csv&user=ali').get_data(as_text=True)
+        lines = csv_body.strip().splitlines()
+        self.assertEqual(lines[0], 'id,user_id,username,amount,description,timestamp')
+        self.assertEqual([line.split(',')[3] for line in lines[1:]], ['10', '-1', '-1', '20'])
+
+        ndjson = self.client.get('/admin/transactions/export?format=ndjson&sign=credit').get_data(as_text=True)
+        self.assertEqual(sorted(json.loads(line)['amount'] for line in ndjson.splitlines()), [5, 10, 20])
+        self.assertEqual(self.client.get('/admin/transactions?date_from=nope').status_code, 400)
+
+class BulkImportCase(ViewCase):
+    def setUp(self):
+        super().setUp()
+        polymers = Category(name='Polymers')
+        db.session.add_all([polymers, Category(name='PVC', parent=polymers)])
+        self.buyer = User(username='buyer', email='buyer@example.com')
+        db.session.add(self.buyer)
+        db.session.flush()
+        ledger.apply(self.buyer.id, 3, 'Test')
+        db.session.commit()
+        self.login(self.buyer)
+
+    def upload(self, text):
+        return self.client.post('/create_request/import', data={
+            'file': (io.BytesIO(text.encode()), 'rfqs.csv')}, content_type='multipart/form-data')
+
+    def test_valid_rows_inserted_and_charged_once(self):
+        body = self.upload('category,sub_category,product_type,quantity,deadline,origin\n'
+                           'Polymers,PVC,PVC K70,100 Ton,2030-01-01,Macaristan\n'
+                           'Polymers,,PE,5 Ton,2030-01-02,\n'
+                           'Scrap,,Metal,1 Ton,2030-01-01,\n'
+                           'Polymers,PET,PET,1 Ton,2030-01-01,\n'
+                           'Polymers,,PP,,01/01/2030,\n').get_data(as_text=True)
+        self.assertIn('unknown category', body)
+        self.assertIn('not a sub category', body)
+        self.assertIn('missing quantity', body)
+        self.assertEqual(Request.query.count(), 2)
+        db.session.refresh(self.buyer)
+        self.assertEqual(self.buyer.credits, 1)
+        self.assertEqual(ledger.ledger_total(self.buyer.id), 1)
+        self.assertEqual(len(search_request_ids('macaristan')), 1)
+
+    def test_batch_larger_than_balance_inserts_nothing(self):
+        rows = ''.join(f'Polymers,PVC {i},1 Ton,2030-01-01\n' for i in range(4))
+        self.upload('category,product_type,quantity,deadline\n' + rows)
+        self.assertEqual(Request.query.count(), 0)
+        db.session.refresh(self.buyer)
+        self.assertEqual(self.buyer.credits, 3)
+
+class CategoryTreeCase(ViewCase):
+    def test_paths_and_cached_tree(self):
+        polymers = Category(name='Polymers', schema='Origin, MFI')
+        pvc = Category(name='PVC', parent=polymers)
+        db.session.add_all([polymers, pvc, Category(name='Suspension', parent=pvc)])
+        db.session.commit()
+        self.assertEqual((pvc.path, pvc.depth), (f'/{polymers.id}/{pvc.id}/', 1))
+
+        tree = categories.get_category_tree()
+        self.assertEqual(tree[0]['schema'], ['Origin', 'MFI'])
+        self.assertEqual(categories.sub_category_names('Polymers'), ['PVC', 'Suspension'])
+
+        # Moving a subtree rewrites every descendant path in one go
+        chemicals = Category(name='Chemicals')
+        db.session.add(chemicals)
+        db.session.commit()
+        pvc.parent_id = chemicals.id
+        categories.invalidate()
+        db.session.commit()
+        suspension = Category.query.filter_by(name='Suspension').one()
+        self.assertEqual(suspension.path, f'/{chemicals.id}/{pvc.id}/{suspension.id}/')
+        self.assertEqual(suspension.depth, 2)
+        self.assertEqual(categories.sub_category_names('Chemicals'), ['PVC', 'Suspension'])
+
+    def test_missing_paths_backfilled_on_create_all(self):
+        db.session.add_all([Category(name='Polymers'), Category(name='PVC', parent_id=1)])
+        db.session.commit()
+        db.session.execute(db.update(Category).values(path=None, depth=None))
+        db.session.commit()
+        db.create_all()
+        self.assertEqual([c.path for c in Category.query.order_by(Category.id)], ['/1/', '/1/2/'])
+
+class PricingCase(ViewCase):
+    def test_parse_price(self):
+        self.assertEqual(pricing.parse_price('1100 USD / Ton + KDV'), (1100.0, 'USD', 'ton'))
+        self.assertEqual(pricing.parse_price('1.100,50 € / kg'), (1100.5, 'EUR', 'kg'))
+        self.assertEqual(pricing.parse_price('$1,250.75/MT'), (1250.75, 'USD', 'ton'))
+        self.assertEqual(pricing.parse_price('32.50 TL'), (32.5, 'TRY', None))
+        self.assertEqual(pricing.parse_price('call me'), (None, None, None))
+        self.assertEqual(pricing.parse_quantity('100 Ton'), (100.0, 'ton'))
+
+    def test_bids_sorted_by_normalized_price(self):
+        buyer = User(username='buyer', email='buyer@example.com')
+        req = Request(author=buyer, product_type='PVC', quantity='100 Ton')
+        db.session.add_all([Ticker(name='USD/TRY', value='30', change_rate='+0.1%'),
+                            Ticker(name='EUR/TRY', value='33', change_rate='+0.1%')])
+        db.session.commit()
+        db.session.add_all([buyer, req])
+        for price in ('1000 EUR / Ton', '1050 USD / Ton', 'negotiable', '1.05 USD/kg', '30.000 TL / ton',
+                      '2 USD / piece'):
+            db.session.add(Bid(request=req, bidder=buyer, price=price))
+        db.session.commit()
+        self.assertEqual(req.quantity_amount, 100.0)
+
+        self.login(buyer)
+        page = self.client.get(f'/request/{req.id}?sort=price').get_data(as_text=True)
+        order = [page.index(p) for p in ('30.000 TL', '1050 USD', '1.05 USD/kg', '1000 EUR')]
+        self.assertEqual(order, sorted(order))
+        # Pieces don't convert to tons, so that offer goes last with the unparsed one
+        self.assertGreater(min(page.index('2 USD / piece'), page.index('negotiable')), order[-1])
+        rates = pricing.fx_rates('USD')
+        self.assertEqual(db.session.scalars(db.select(pricing.normalized_price_expression(rates))
+                                            .where(Bid.price.in_(('2 USD / piece', '1.05 USD/kg')))
+                                            .order_by(Bid.id)).all(), [1050.0, None])
+
+    def test_backfill(self):
+        u = User(username='u', email='u@example.com')
+        db.session.add_all([u, Bid(bidder=u, price='900 USD/ton')])
+        db.session.commit()
+        db.session.execute(db.update(Bid).values(price_amount=None, price_currency=None, price_unit=None))
+        db.session.commit()
+        self.assertEqual(pricing.backfill(Bid, 'price', pricing.parse_price,
+                                          ['price_amount', 'price_currency', 'price_unit'], batch_size=1), 1)
+        bid = Bid.query.one()
+        self.assertEqual((bid.price_amount, bid.price_currency, bid.price_unit), (900.0, 'USD', 'ton'))
+
+class MetricsCase(ViewCase):
+    config = type('MetricsConfig', (TestConfig,), {'METRICS_ENABLED': True, 'SLOW_QUERY_THRESHOLD': 0})
+
+    def test_requests_and_queries_are_recorded(self):
+        admin = User(username='admin', email='admin@example.com', is_admin=True)
+        db.session.add_all([admin, Request(author=admin, product_type='PVC', quantity='1 Ton')])
+        db.session.commit()
+        self.login(admin)
+        self.assertEqual(self.client.get('/marketplace').status_code, 200)
+
+        metrics = self.app.extensions['metrics']
+        row = next(r for r in metrics.summary() if r['endpoint'] == 'main.marketplace')
+        self.assertEqual(row['count'], 1)
+        self.assertGreater(row['avg_queries'], 0)
+        # Threshold 0 makes every statement slow; SELECTs carry their plan
+        plans = [q['plan'] for q in metrics.slow_queries if q['statement'].lstrip().startswith('SELECT')]
+        self.assertTrue(plans)
+        self.assertFalse([plan for plan in plans if not plan or plan.startswith('(no plan')])
+
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        body = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'}).get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_count{endpoint="main.marketplace",method="GET"', body)
+        self.assertIn('http_request_sql_queries_bucket{endpoint="main.marketplace"', body)
+        self.assertIn('Slow Queries', self.client.get('/admin/metrics').get_data(as_text=True))
+
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+
+class JobQueueCase(ViewCase):
+    def test_failed_job_is_retried_then_given_up(self):
+        calls = []
+        @jobs.handler('flaky')
+        def flaky(job):
+            calls.append(job.attempts)
+            raise RuntimeError('boom')
+        self.addCleanup(jobs.handlers.pop, 'flaky')
+        job = jobs.enqueue('flaky', max_attempts=2)
+        db.session.commit()
+        job_id = job.id
+
+        # The worker removes its session after each job, so reload what the test looks at
+        self.assertEqual(jobs.work(once=True), 1)
+        job = db.session.get(Job, job_id)
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertIn('boom', job.last_error)
+        # Backoff: not due again until JOB_RETRY_DELAY has passed
+        self.assertEqual(jobs.work(once=True), 0)
+        db.session.execute(db.update(Job).values(run_at=datetime.utcnow()))
+        db.session.commit()
+        jobs.work(once=True)
+        self.assertEqual((db.session.get(Job, job_id).status, calls), ('failed', [1, 2]))
+
+    def test_claimed_job_is_not_taken_twice(self):
+        job = jobs.enqueue('expire_requests')
+        db.session.commit()
+        self.assertEqual(jobs.claim('a').id, job.id)
+        self.assertIsNone(jobs.claim('b'))
+
+    def test_stale_job_on_last_attempt_is_failed(self):
+        job = jobs.enqueue('expire_requests', max_attempts=1)
+        db.session.commit()
+        job_id = job.id
+        self.assertEqual(jobs.claim('a').id, job_id)
+        # Worker "a" dies mid-job
+        db.session.execute(db.update(Job).values(locked_at=datetime.utcnow() - timedelta(days=1)))
+        db.session.commit()
+        self.assertIsNone(jobs.claim('b'))
+        job = db.session.get(Job, job_id)
+        self.assertEqual((job.status, job.attempts, job.locked_by), ('failed', 1, None))
+        self.assertIsNotNone(job.finished_at)
+
+    def test_expire_requests(self):
+        u = User(username='buyer', email='buyer@example.com')
+        past = Request(author=u, product_type='PVC', quantity='1 Ton', status='Open',
+                       deadline=datetime.utcnow() - timedelta(days=2))
+        today = Request(author=u, product_type='PE', quantity='1 Ton', status='Open',
+                        deadline=datetime.combine(datetime.utcnow().date(), datetime.min.time()))
+        db.session.add_all([u, past, today])
+        jobs.enqueue('expire_requests', batch_size=1)
+        db.session.commit()
+        ids = (past.id, today.id)
+        jobs.work(once=True)
+        self.assertEqual([db.session.get(Request, id).status for id in ids], ['Closed', 'Open'])
+
+    def test_background_export(self):
+        admin = User(username='admin', email='admin@example.com', is_admin=True)
+        db.session.add(admin)
+        db.session.flush()
+        ledger.apply(admin.id, 5, 'Grant')
+        db.session.commit()
+        self.app.config['EXPORT_DIR'] = tempfile.mkdtemp()
+        admin_id = admin.id
+        self.login(admin)
+        self.client.post('/admin/transactions/export/background', data={'format': 'csv', 'sign': 'credit'})
+        jobs.work(once=True)
+        self.login(db.session.get(User, admin_id))
+        job = Job.query.one()
+        self.assertEqual(job.status, 'done')
+        body = self.client.get(f'/admin/jobs/{job.id}/download').get_data(as_text=True)
+        self.assertIn('Grant', body)
+
+class MatchingCase(ViewCase):
+    def test_request_keys(self):
+        self.assertEqual(len(matching.request_keys('PVC', 'Suspension', 'Turkey')), 8)
+        self.assertIn(matching.subscription_key(origin=' turkey '), matching.request_keys('PVC', None, 'Turkey'))
+        self.assertNotIn(matching.subscription_key('PE'), matching.request_keys('PVC', None, 'Turkey'))
+
+    def test_new_request_reaches_subscribed_sellers_inbox(self):
+        buyer = User(username='buyer', email='buyer@example.com', credits=1, is_seller=True)
+        pvc = User(username='pvc', email='pvc@example.com', is_seller=True)
+        turkish = User(username='turkish', email='turkish@example.com', is_seller=True)
+        pe = User(username='pe', email='pe@example.com', is_seller=True)
+        db.session.add_all([buyer, pvc, turkish, pe, Category(name='PVC')])
+        db.session.flush()
+        matching.subscribe(pvc.id, 'PVC')
+        matching.subscribe(pvc.id, 'PVC', origin='Turkey')
+        matching.subscribe(turkish.id, origin='Turkey')
+        matching.subscribe(pe.id, 'PE')
+        matching.subscribe(buyer.id, 'PVC')
+        db.session.commit()
+        ids = {u.username: u.id for u in (buyer, pvc, turkish, pe)}
+
+        self.login(buyer)
+        self.client.post('/create_request', data={'category': 'PVC', 'product_type': 'S65', 'origin': 'Turkey',
+                                                  'quantity': '10 Ton', 'deadline': '2030-01-01'})
+        jobs.work(once=True)
+        # One notification per seller however many of their subscriptions match; not the author
+        self.assertEqual(sorted(n.user_id for n in Notification.query), [ids['pvc'], ids['turkish']])
+
+        self.login(db.session.get(User, ids['turkish']))
+        with self.assertMaxQueries(3):
+            page = self.client.get('/inbox').get_data(as_text=True)
+        self.assertIn('New PVC request: S65', page)
+
+    def test_subscription_form(self):
+        seller = User(username='seller', email='seller@example.com', is_seller=True)
+        db.session.add_all([seller, Category(name='PVC')])
+        db.session.commit()
+        self.login(seller)
+        self.client.post('/subscriptions', data={'category': 'PVC', 'sub_category': '', 'origin': ''})
+        self.client.post('/subscriptions', data={'category': 'PVC', 'sub_category': '', 'origin': ''})
+        self.assertIn('Pick at least', self.client.post('/subscriptions', data={'category': ''}).get_data(as_text=True))
+        self.assertEqual([s.key for s in Subscription.query], ['pvc|*|*'])
+
+class ConditionalGetCase(ViewCase):
+    def setUp(self):
+        super().setUp()
+        httpcache.fragments.clear()
+        self.buyer = User(username='buyer', email='buyer@example.com')
+        self.seller = User(username='seller', email='seller@example.com', is_seller=True)
+        self.req = Request(author=self.buyer, product_type='PVC', quantity='1 Ton', status='Open')
+        db.session.add_all([self.buyer, self.seller, self.req])
+        db.session.commit()
+        self.req_id = self.req.id
+        self.login(self.seller)
+
+    def revalidate(self, url, response):
+        return self.client.get(url, headers={'If-None-Match': response.headers['ETag']})
+
+    def test_marketplace_not_modified_until_a_write(self):
+        first = self.client.get('/marketplace')
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('private', first.headers['Cache-Control'])
+        with self.assertMaxQueries(1):
+            self.assertEqual(self.revalidate('/marketplace', first).status_code, 304)
+        # Only the ETag covers the viewer and the site chrome, so a date alone never gets a 304
+        self.assertNotIn('Last-Modified', first.headers)
+        since = self.client.get('/marketplace', headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(since.status_code, 200)
+
+        db.session.add(Bid(request_id=self.req_id, seller_id=self.seller.id, price='1 USD'))
+        db.session.commit()
+        self.assertEqual(self.revalidate('/marketplace', first).status_code, 200)
+
+    def test_request_detail_changes_with_its_bids(self):
+        url = f'/request/{self.req_id}'
+        first = self.client.get(url)
+        self.assertEqual(self.revalidate(url, first).status_code, 304)
+        # Another request's bids leave this page alone
+        other = Request(author=self.buyer, product_type='PE', quantity='1 Ton')
+        db.session.add(other)
+        db.session.commit()
+        self.assertEqual(self.revalidate(url, first).status_code, 304)
+
+        self.client.post(url, data={'price': '900 USD'})
+        # The flash from the bid must be shown, then the page has a new version
+        flashed = self.revalidate(url, first)
+        self.assertEqual(flashed.status_code, 200)
+        self.assertIn('Bid submitted', flashed.get_data(as_text=True))
+        self.assertNotEqual(flashed.headers['ETag'], first.headers['ETag'])
+
+    def test_marketplace_rows_rerender_on_change(self):
+        self.assertIn('Status: Open', self.client.get('/marketplace').get_data(as_text=True))
+        self.req.status = 'Closed'
+        db.session.commit()
+        self.assertIn('Status: Closed', self.client.get('/marketplace').get_data(as_text=True))
+
+class LoginRateLimitCase(ViewCase):
+    def test_bucket_refills(self):
+        self.assertEqual(ratelimit.take('k', burst=2, per_minute=60, now=100), (True, 0))
+        self.assertEqual(ratelimit.take('k', burst=2, per_minute=60, now=100), (True, 0))
+        allowed, retry_after = ratelimit.take('k', burst=2, per_minute=60, now=100.5)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 0.5)
+        self.assertTrue(ratelimit.take('k', burst=2, per_minute=60, now=101)[0])
+        # Never refills past the burst size
+        self.assertEqual([ratelimit.take('k', 2, 60, now=1000)[0] for _ in range(3)], [True, True, False])
+
+    def test_login_rejected_before_hashing(self):
+        self.app.config.update(LOGIN_IP_BURST=100, LOGIN_USER_BURST=2)
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        for _ in range(2):
+            self.assertEqual(self.client.post('/login', data={'username': 'susan', 'password': 'dog'}).status_code, 302)
+        checked = []
+        original = User.check_password
+        User.check_password = lambda self, password: checked.append(password) or original(self, password)
+        self.addCleanup(setattr, User, 'check_password', original)
+        response = self.client.post('/login', data={'username': 'SUSAN', 'password': 'cat'})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        self.assertEqual(checked, [])
+        # Other accounts from the same address are still let through
+        self.assertEqual(self.client.post('/login', data={'username': 'bob', 'password': 'x'}).status_code, 302)
+
+    def test_rehash_on_login(self):
+        u = User(username='susan', email='susan@example.com')
+        u.password_hash = generate_password_hash('cat', method='pbkdf2:sha256:1000')
+        db.session.add(u)
+        db.session.commit()
+        self.assertTrue(u.password_needs_rehash())
+        self.client.post('/login', data={'username': 'susan', 'password': 'cat'})
+        u = User.query.filter_by(username='susan').one()
+        self.assertTrue(u.password_hash.startswith(self.app.config['PASSWORD_HASH_METHOD'] + '$'))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_shorthand_hash_method_does_not_rehash(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256'
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        self.assertFalse(u.password_needs_rehash())
+        u.password_hash = generate_password_hash('cat', method='pbkdf2:sha256:1000')
+        self.assertTrue(u.password_needs_rehash())
+
+class UserCacheCase(ViewCase):
+    def test_snapshot_skips_user_query_until_invalidated(self):
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.login(u)
+        self.client.get('/dashboard')
+        with self.assertMaxQueries(10) as statements:
+            self.assertEqual(self.client.get('/').status_code, 200)
+        self.assertFalse([s for s in statements if 'FROM user' in s])
+
+        ledger.apply(u.id, 5, 'Gift')
+        db.session.commit()
+        self.assertEqual(user_cache.get(u.id)['credits'], 5)
+
+        u.is_blocked = True
+        db.session.commit()
+        self.assertEqual(self.client.get('/dashboard').status_code, 302)
+        response = self.client.post('/login', data={'username': 'susan', 'password': 'cat'})
+        self.assertTrue(response.location.endswith('/login'))
+
+class ArchiveCase(ViewCase):
+    def test_old_closed_requests_move_with_their_bids(self):
+        old = datetime.utcnow() - timedelta(days=400)
+        buyer = User(username='buyer', email='buyer@example.com')
+        seller = User(username='seller', email='seller@example.com', is_seller=True)
+        stale = [Request(author=buyer, product_type=f'PVC {i}', status='Closed', timestamp=old) for i in range(3)]
+        recent = Request(author=buyer, product_type='PVC recent', status='Closed')
+        still_open = Request(author=buyer, product_type='PVC open', status='Open', timestamp=old)
+        db.session.add_all([buyer, seller, recent, still_open, *stale])
+        db.session.add_all([Bid(request=stale[0], bidder=seller, price='1000 USD', timestamp=old),
+                            Bid(request=still_open, bidder=seller, price='900 USD')])
+        db.session.commit()
+        db.session.add(Notification(user_id=seller.id, request=stale[0], message='New request'))
+        db.session.execute(db.update(Request).where(Request.timestamp == old).values(updated_at=old))
+        db.session.commit()
+        with db.engine.begin() as connection:
+            stats.rebuild(connection)
+        before = stats.totals()
+
+        self.assertEqual(archive.archive_requests(batch_size=2), 3)
+        self.assertEqual({r.product_type for r in Request.query}, {'PVC recent', 'PVC open'})
+        self.assertEqual(ArchivedRequest.query.count(), 3)
+        archived_bid = ArchivedBid.query.one()
+        self.assertEqual((archived_bid.request.product_type, archived_bid.price), ('PVC 0', '1000 USD'))
+        self.assertEqual(Bid.query.count(), 1)
+        # Inbox history stays, pointing at the archived request
+        note = Notification.query.one()
+        self.assertEqual((note.request_id, note.archived_request.product_type), (None, 'PVC 0'))
+        self.assertEqual(set(search_request_ids('pvc')), {recent.id, still_open.id})
+        with db.engine.begin() as connection:
+            stats.rebuild(connection)
+        db.session.expire_all()
+        self.assertEqual(stats.totals(), before)
+
+        self.login(buyer)
+        self.assertNotIn('PVC 1', self.client.get('/dashboard').get_data(as_text=True))
+        self.assertIn('PVC 1', self.client.get('/dashboard?history=1').get_data(as_text=True))
+        self.login(seller)
+        self.assertIn('Bid on PVC 0', self.client.get('/dashboard?history=1').get_data(as_text=True))
+        self.assertIn('Closed, archived', self.client.get('/inbox').get_data(as_text=True))
+        admin = User(username='admin', email='admin@example.com', is_admin=True)
+        db.session.add(admin)
+        db.session.commit()
+        self.login(admin)
+        self.assertNotIn('PVC 2', self.client.get('/admin/requests').get_data(as_text=True))
+        self.assertIn('PVC 2', self.client.get('/admin/requests?history=1').get_data(as_text=True))
+
+    def test_history_pages_through_live_and_archived_rows(self):
+        old = datetime.utcnow() - timedelta(days=400)
+        buyer = User(username='buyer', email='buyer@example.com')
+        db.session.add(buyer)
+        db.session.add_all([Request(author=buyer, product_type=f'PVC {i}', status='Closed' if i < 3 else 'Open',
+                                    timestamp=old + timedelta(days=i)) for i in range(5)])
+        db.session.commit()
+        db.session.execute(db.update(Request).values(updated_at=old))
+        db.session.commit()
+        self.assertEqual(archive.archive_requests(), 3)
+
+        rows, cursor = archive.requests_for_user(buyer.id, history=True, limit=2)
+        seen = [row.product_type for row in rows]
+        while cursor:
+            rows, cursor = archive.requests_for_user(buyer.id, history=True, cursor=cursor, limit=2)
+            seen += [row.product_type for row in rows]
+        self.assertEqual(seen, [f'PVC {i}' for i in reversed(range(5))])
+        self.assertEqual([row.product_type for row in archive.requests_for_user(buyer.id)[0]], ['PVC 4', 'PVC 3'])
+
+        self.app.config['DASHBOARD_PAGE_SIZE'] = 2
+        self.login(buyer)
+        page = self.client.get('/dashboard?history=1').get_data(as_text=True)
+        self.assertIn('PVC 3', page)
+        self.assertNotIn('PVC 2', page)
+        self.assertIn('requests_cursor=', page)
+        self.assertEqual(self.client.get('/dashboard?requests_cursor=bogus').status_code, 400)
+
+    def test_dashboard_lists_page_independently(self):
+        user = User(username='trader', email='trader@example.com', is_seller=True)
+        other = User(username='buyer', email='buyer@example.com')
+        db.session.add_all([Request(author=user, product_type=f'PVC {i}') for i in range(3)])
+        for i in range(3):
+            db.session.add(Bid(request=Request(author=other, product_type=f'PE {i}'), bidder=user, price=f'{i} USD'))
+        db.session.commit()
+        self.app.config['DASHBOARD_PAGE_SIZE'] = 2
+        self.login(user)
+        def link(page, label):
+            href = re.search(r'href="([^"]+)"[^>]*>' + label, page).group(1)
+            return html.unescape(href)
+        older_requests = link(self.client.get('/dashboard').get_data(as_text=True), 'Older requests')
+        older_bids = link(self.client.get(older_requests).get_data(as_text=True), 'Older bids')
+        self.assertIn('requests_cursor=', older_bids)
+        page = self.client.get(older_bids).get_data(as_text=True)
+        # Second page of both lists
+        self.assertIn('PVC 0', page)
+        self.assertNotIn('PVC 2', page)
+        self.assertIn('Bid on PE 0', page)
+        self.assertNotIn('Bid on PE 2', page)
+
+    def test_ids_of_archived_rows_are_not_reused(self):
+        old = datetime.utcnow() - timedelta(days=400)
+        buyer = User(username='buyer', email='buyer@example.com')
+        seller = User(username='seller', email='seller@example.com', is_seller=True)
+        def closed_request(name):
+            req = Request(author=buyer, product_type=name, status='Closed', timestamp=old)
+            db.session.add_all([req, Bid(request=req, bidder=seller, price='1000 USD', timestamp=old)])
+            db.session.commit()
+            db.session.execute(db.update(Request).where(Request.id == req.id).values(updated_at=old))
+            db.session.commit()
+            return req.id
+        first = closed_request('PVC 1')
+        self.assertEqual(archive.archive_requests(), 1)
+        # The newest request and bid were archived; new rows must not take their ids
+        second = closed_request('PVC 2')
+        self.assertGreater(second, first)
+        self.assertEqual(archive.archive_requests(), 1)
+        self.assertEqual(ArchivedRequest.query.count(), 2)
+        self.assertEqual(ArchivedBid.query.count(), 2)
+
+    def test_deleting_a_request_removes_its_notifications(self):
+        admin = User(username='admin', email='admin@example.com', is_admin=True)
+        seller = User(username='seller', email='seller@example.com', is_seller=True)
+        req = Request(author=admin, product_type='PVC', status='Open')
+        db.session.add_all([admin, seller, req])
+        db.session.flush()
+        db.session.add(Notification(user_id=seller.id, request_id=req.id, message='New request'))
+        db.session.commit()
+        req_id, seller_id = req.id, seller.id
+        self.login(admin)
+        self.client.post(f'/admin/requests/{req_id}/delete')
+        self.assertIsNone(db.session.get(Request, req_id))
+        self.assertEqual(Notification.query.count(), 0)
+        self.login(db.session.get(User, seller_id))
+        self.assertEqual(self.client.get('/inbox').status_code, 200)
+
+class RequestAttributeCase(ViewCase):
+    def setUp(self):
+        super().setUp()
+        polymers = Category(name='Polymers', schema='Grade, MFI:number, Origin')
+        db.session.add_all([polymers, Category(name='PVC', parent=polymers, schema='K Value:number')])
+        self.buyer = User(username='buyer', email='buyer@example.com', credits=5)
+        self.seller = User(username='seller', email='seller@example.com', is_seller=True)
+        db.session.add_all([self.buyer, self.seller])
+        db.session.commit()
+
+    def test_fields_follow_the_category_tree(self):
+        self.assertEqual([f['key'] for f in categories.fields_for('Polymers', 'PVC')],
+                         ['grade', 'mfi', 'origin', 'k_value'])
+        self.assertEqual(categories.parse_fields('[{"name": "MFI", "type": "number"}, "Grade"]'),
+                         [{'name': 'MFI', 'key': 'mfi', 'type': 'number'},
+                          {'name': 'Grade', 'key': 'grade', 'type': 'text'}])
+
+    def test_create_filter_and_show(self):
+        self.login(self.buyer)
+        page = self.client.get('/create_request?category=Polymers').get_data(as_text=True)
+        self.assertIn('name="attr_mfi"', page)
+        self.assertNotIn('name="attr_origin"', page)
+
+        data = {'category': 'Polymers', 'product_type': 'PVC', 'quantity': '1 Ton', 'deadline': '2030-01-01',
+                'attr_grade': 'K70', 'attr_mfi': 'abc'}
+        self.assertIn('MFI must be a number', self.client.post('/create_request', data=data).get_data(as_text=True))
+        self.assertEqual(Request.query.count(), 0)
+        for value in ('nan', 'inf', '-Infinity'):
+            data['attr_mfi'] = value
+            self.assertIn('MFI must be a number', self.client.post('/create_request', data=data).get_data(as_text=True))
+        self.assertEqual(Request.query.count(), 0)
+        data['attr_mfi'] = '2,5'
+        self.client.post('/create_request', data=data)
+        low = Request.query.one()
+        self.assertEqual({(a.name, a.value_text, a.value_number) for a in low.attributes},
+                         {('grade', 'K70', None), ('mfi', '2,5', 2.5)})
+
+        created, errors = import_requests(self.buyer.id, [
+            {'category': 'Polymers', 'product_type': 'PE', 'quantity': '1 Ton', 'deadline': '2030-01-01', 'mfi': '7'},
+            {'category': 'Polymers', 'product_type': 'PP', 'quantity': '1 Ton', 'deadline': '2030-01-01', 'mfi': 'x'}])
+        db.session.commit()
+        self.assertEqual((created, errors), (1, [(3, 'MFI must be a number')]))
+        self.assertEqual(RequestAttribute.query.filter_by(name='mfi', value_number=7).count(), 1)
+
+        plan = ' '.join(str(row) for row in db.session.execute(db.text(
+            "EXPLAIN QUERY PLAN SELECT request_id FROM request_attribute "
+            "WHERE name = 'mfi' AND value_number BETWEEN 2 AND 5")))
+        self.assertIn('ix_request_attribute_number', plan)
+
+        self.login(self.seller)
+        page = self.client.get('/marketplace?category=Polymers&attr_mfi_min=2&attr_mfi_max=5').get_data(as_text=True)
+        self.assertIn(f'/request/{low.id}"', page)
+        self.assertIn('name="attr_mfi_min"', page)
+        self.assertNotIn('PE', page)
+        self.assertEqual(self.client.get('/marketplace?attr_mfi_min=high').status_code, 400)
+        self.assertEqual(self.client.get('/marketplace?attr_mfi_min=-inf').status_code, 400)
+        self.assertIn('<strong>MFI:</strong> 2,5', self.client.get(f'/request/{low.id}').get_data(as_text=True))
+
+class TickerHistoryCase(ViewCase):
+    def test_import_rollups_and_change_rate(self):
+        admin = User(username='admin', email='admin@example.com', is_admin=True)
+        db.session.add(admin)
+        db.session.commit()
+        self.login(admin)
+        # Two whole days in the past, so the point entered by hand below starts a third
+        today = datetime.utcnow().replace(hour=9, minute=0, second=0, microsecond=0) - timedelta(days=1)
+        yesterday = today - timedelta(days=1)
+        csv_data = 'ticker,timestamp,value\n' + ''.join(
+            f'USD/TRY,{ts.isoformat()},{value}\n'
+            for ts, value in ((yesterday, 30), (yesterday + timedelta(minutes=30), 31.5),
+                              (yesterday + timedelta(hours=2), 32), (today, 33), (today + timedelta(minutes=5), 32.64)))
+        for _ in range(2):  # a repeated upload adds nothing
+            response = self.client.post('/admin/tickers/import', content_type='multipart/form-data',
+                                        data={'file': (io.BytesIO(csv_data.encode()), 'prices.csv')})
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(TickerPrice.query.count(), 5)
+
+        daily = TickerRollup.query.filter_by(resolution='d').order_by(TickerRollup.bucket).all()
+        self.assertEqual([(bar.open, bar.high, bar.low, bar.close, bar.count) for bar in daily],
+                         [(30, 32, 30, 32, 3), (33, 33, 32.64, 32.64, 2)])
+        self.assertEqual(TickerRollup.query.filter_by(resolution='h').count(), 3)
+        ticker = get_tickers()[0]
+        self.assertEqual((ticker.name, ticker.value, ticker.change_rate), ('USD/TRY', '32.64', '+2.00%'))
+        self.assertEqual(pricing.fx_rates('TRY')['USD'], 32.64)
+
+        chart = self.client.get(f'/tickers/{ticker.id}/chart.json?days=7').get_json()
+        self.assertEqual(chart['bars'][-1], [today.replace(hour=0).isoformat(), 33, 33, 32.64, 32.64])
+        self.assertEqual(len(self.client.get(f'/tickers/{ticker.id}/chart.json?resolution=h&days=3').get_json()['bars']), 3)
+        self.assertEqual(self.client.get(f'/tickers/{ticker.id}/chart.json?resolution=m').status_code, 400)
+
+        # A hand-entered price is one more point, compared with the last day's close
+        self.client.post('/admin/tickers', data={'name': 'USD/TRY', 'value': '33.2928'})
+        self.assertEqual(get_tickers()[0].change_rate, '+2.00%')
+
+    def test_hand_entered_zero_price(self):
+        admin = User(username='admin', email='admin@example.com', is_admin=True)
+        db.session.add(admin)
+        db.session.commit()
+        self.login(admin)
+        self.client.post('/admin/tickers', data={'name': 'SPREAD', 'value': '0'})
+        self.assertEqual([p.value for p in TickerPrice.query], [0])
+        self.assertEqual(get_tickers()[0].value, '0')
+
+    def test_parse_timestamp_converts_offsets_to_utc(self):
+        expected = datetime(2024, 1, 1, 7, 30)
+        for value in ('2024-01-01T10:30:00+03:00', '2024-01-01T07:30:00Z', '2024-01-01T07:30:00',
+                      datetime(2024, 1, 1, 10, 30, tzinfo=timezone(timedelta(hours=3))), '1704094200'):
+            with self.subTest(value=value):
+                self.assertEqual(ticker_history.parse_timestamp(value), expected)
+
+class BootstrapCase(ViewCase):
+    def test_bootstrap_is_idempotent(self):
+        runner = self.app.test_cli_runner()
+        for _ in range(2):
+            result = runner.invoke(args=['bootstrap'])
+            self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('seeded 0 categories; admin user already exists', result.output)
+        self.assertEqual(Category.query.count(), len(bootstrap.DEFAULT_CATEGORIES))
+        admin = User.query.filter_by(username=self.app.config['ADMIN_USERNAME']).one()
+        self.assertTrue(admin.is_admin)
+        self.assertTrue(admin.check_password(self.app.config['ADMIN_PASSWORD']))
+        self.assertEqual(stats.totals([stats.SIGNUPS]), {stats.SIGNUPS: 1})
+
+class AwardCase(ViewCase):
+    def setUp(self):
+        super().setUp()
+        self.buyer = User(username='buyer', email='buyer@example.com')
+        self.sellers = [User(username=f'seller{i}', email=f'seller{i}@example.com', is_seller=True) for i in range(3)]
+        self.req = Request(author=self.buyer, product_type='PVC', quantity='100 Ton')
+        db.session.add_all([self.buyer, *self.sellers, self.req])
+        db.session.commit()
+
+    def bid(self, seller, price):
+        self.login(seller)
+        return self.client.post(f'/request/{self.req.id}', data={'price': price})
+
+    def test_summary_follows_new_bids(self):
+        for seller, price in ((0, '1000 USD / Ton'), (0, '1200 USD / Ton'), (1, '1.1 USD/kg'), (1, 'negotiable')):
+            self.bid(self.sellers[seller], price)
+        db.session.expire_all()
+        summary = lambda req: (req.bid_count, req.price_min, req.price_max, req.price_median)
+        self.assertEqual(summary(self.req), (4, 1000, 1200, 1100))
+        self.bid(self.sellers[2], '900 USD/ton')
+        db.session.expire_all()
+        self.assertEqual(summary(self.req), (5, 900, 1200, 1050))
+        self.assertEqual(self.req.last_bid_at, max(b.timestamp for b in Bid.query))
+
+        # The dashboard reads the summary off the request rows
+        self.login(self.buyer)
+        with self.assertMaxQueries(4) as statements:
+            page = self.client.get('/dashboard').get_data(as_text=True)
+        self.assertIn('Offers: 5 | 900.00–1200.00, median 1050.00 USD', page)
+        self.assertFalse(any('FROM bid' in s for s in statements))
+
+        # Rebuilt from scratch, as bootstrap does for requests from before the summary
+        db.session.execute(db.update(Request).values(bid_count=None, price_min=None, price_median=None))
+        db.session.execute(db.update(Bid).values(price_normalized=None))
+        db.session.commit()
+        self.assertEqual(bidding.backfill_summaries(), 1)
+        db.session.expire_all()
+        self.assertEqual(summary(self.req), (5, 900, 1200, 1050))
+
+    def test_award_closes_request_and_notifies_losers(self):
+        self.bid(self.sellers[0], '1000 USD / Ton')
+        self.bid(self.sellers[0], '990 USD / Ton')
+        self.bid(self.sellers[1], '1.1 USD/kg')
+        self.bid(self.sellers[2], 'negotiable')
+        winner = Bid.query.filter_by(seller_id=self.sellers[1].id).one()
+
+        self.login(self.sellers[0])
+        self.assertEqual(self.client.post(f'/request/{self.req.id}/award/{winner.id}').status_code, 403)
+        self.login(self.buyer)
+        self.assertIn('Accept offer', self.client.get(f'/request/{self.req.id}').get_data(as_text=True))
+        self.client.post(f'/request/{self.req.id}/award/{winner.id}')
+
+        db.session.expire_all()
+        self.assertEqual(self.req.status, 'Awarded')
+        self.assertEqual({(b.seller_id, b.status) for b in Bid.query},
+                         {(self.sellers[0].id, 'Lost'), (self.sellers[1].id, 'Awarded'), (self.sellers[2].id, 'Lost')})
+        notes = {n.user_id: n.message for n in Notification.query}
+        self.assertEqual(len(notes), Notification.query.count())
+        self.assertEqual(notes, {self.sellers[0].id: 'Another offer was chosen for PVC.',
+                                 self.sellers[1].id: 'Your offer on PVC was accepted.',
+                                 self.sellers[2].id: 'Another offer was chosen for PVC.'})
+
+        # Only one award per request, and no more offers
+        loser = Bid.query.filter_by(seller_id=self.sellers[2].id).one()
+        response = self.client.post(f'/request/{self.req.id}/award/{loser.id}', follow_redirects=True)
+        self.assertIn('already been awarded', response.get_data(as_text=True))
+        self.assertEqual(Bid.query.filter_by(status='Awarded').one().id, winner.id)
+        self.bid(self.sellers[2], '800 USD / Ton')
+        self.assertEqual(Bid.query.count(), 4)
+
+class AwardCsrfCase(ViewCase):
+    config = type('CsrfConfig', (TestConfig,), {'WTF_CSRF_ENABLED': True})
+
+    def test_owner_page_is_not_revalidated(self):
+        buyer = User(username='buyer', email='buyer@example.com')
+        seller = User(username='seller', email='seller@example.com', is_seller=True)
+        req = Request(author=buyer, product_type='PVC', quantity='1 Ton')
+        db.session.add_all([buyer, seller, req, Bid(request=req, bidder=seller, price='1000 USD / Ton')])
+        db.session.commit()
+        req_id, bid_id = req.id, Bid.query.one().id
+        self.login(buyer)
+        first = self.client.get(f'/request/{req_id}')
+        self.assertNotIn('ETag', first.headers)
+        self.assertTrue(first.cache_control.no_store)
+        # Even a matching validator gets the page again, with a token for this session
+        page = self.client.get(f'/request/{req_id}', headers={'If-None-Match': '*'})
+        self.assertEqual(page.status_code, 200)
+        token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page.get_data(as_text=True)).group(1)
+        self.assertEqual(self.client.post(f'/request/{req_id}/award/{bid_id}').status_code, 400)
+        response = self.client.post(f'/request/{req_id}/award/{bid_id}', data={'csrf_token': token})
+        self.assertEqual(response.status_code, 302)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Request, req_id).status, 'Awarded')
+
+class ApiCase(ViewCase):
+    def setUp(self):
+        super().setUp()
+        self.buyer = User(username='buyer', email='buyer@example.com')
+        self.seller = User(username='seller', email='seller@example.com', is_seller=True)
+        db.session.add_all([self.buyer, self.seller])
+        db.session.commit()
+        start = datetime(2024, 1, 1)
+        self.requests = [Request(author=self.buyer, product_type=f'PVC {i}', category='Polymers', quantity='1 Ton',
+                                 timestamp=start + timedelta(hours=i % 3)) for i in range(5)]
+        db.session.add_all(self.requests)
+        db.session.flush()
+        db.session.add_all([RequestAttribute(request_id=self.requests[0].id, name='mfi', value_text='2.5',
+                                             value_number=2.5),
+                            Bid(request=self.requests[0], bidder=self.seller, price='1000 USD / Ton')])
+        ledger.apply(self.buyer.id, 10, 'Bought 10 credits package')
+        ledger.apply(self.seller.id, 3, 'Seed')
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['create-api-token', 'buyer', '--name', 'erp'])
+        self.token = result.output.strip()
+        self.headers = {'Authorization': f'Bearer {self.token}'}
+
+    def get(self, url):
+        return self.client.get(url, headers=self.headers)
+
+    def test_requires_token(self):
+        response = self.client.get('/api/v1/requests')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.headers['WWW-Authenticate'], 'Bearer')
+        self.assertEqual(self.client.get('/api/v1/requests', headers={'Authorization': 'Bearer nope'}).status_code, 401)
+        self.app.test_cli_runner().invoke(args=['revoke-api-token', self.token])
+        self.assertEqual(self.get('/api/v1/requests').status_code, 401)
+
+    def test_cursor_pages_with_sparse_fields(self):
+        seen, cursor = [], ''
+        with self.assertMaxQueries(3):
+            page = self.get('/api/v1/requests?fields=id,status&limit=2').get_json()
+        while True:
+            self.assertTrue(all(set(item) == {'id', 'status'} for item in page['items']))
+            seen += [item['id'] for item in page['items']]
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+            page = self.get(f'/api/v1/requests?fields=id,status&limit=2&cursor={cursor}').get_json()
+        self.assertEqual(sorted(seen), sorted(r.id for r in self.requests))
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(self.get('/api/v1/requests?fields=id,secret').status_code, 400)
+        self.assertEqual(self.get('/api/v1/requests?cursor=bogus').status_code, 400)
+
+    def test_batched_ids_and_row_layout(self):
+        first, second = self.requests[0].id, self.requests[3].id
+        body = self.get(f'/api/v1/requests?ids={second},{first},999&fields=id,product_type,bid_count,attributes').get_json()
+        self.assertEqual(body['items'], [
+            {'id': second, 'product_type': 'PVC 3', 'bid_count': 0, 'attributes': {}},
+            {'id': first, 'product_type': 'PVC 0', 'bid_count': 1, 'attributes': {'mfi': '2.5'}}])
+        self.assertEqual(body['missing'], [999])
+        body = self.get(f'/api/v1/requests?ids={first}&fields=id,price_min&layout=rows').get_json()
+        self.assertEqual((body['fields'], body['rows']), (['id', 'price_min'], [[first, 1000.0]]))
+        self.assertEqual(self.get('/api/v1/requests?ids=1,x').status_code, 400)
+
+    def test_bids_categories_and_ledger(self):
+        bids = self.get(f'/api/v1/bids?request_id={self.requests[0].id}&fields=seller,price,timestamp').get_json()
+        self.assertEqual(bids['items'][0]['seller'], 'seller')
+        self.assertEqual(bids['items'][0]['price'], '1000 USD / Ton')
+        datetime.fromisoformat(bids['items'][0]['timestamp'])
+        db.session.add(Category(name='Polymers'))
+        db.session.commit()
+        self.assertEqual([c['name'] for c in self.get('/api/v1/categories').get_json()['items']], ['Polymers'])
+        ledger_page = self.get('/api/v1/ledger').get_json()
+        self.assertEqual(ledger_page['balance'], 10)
+        self.assertEqual([(t['amount'], t['description']) for t in ledger_page['items']],
+                         [(10, 'Bought 10 credits package')])
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,6 @@
+# gunicorn entry point (see gunicorn.conf.py): the app is built once in the
+# master and forked into the workers with its templates already compiled.
+from app import create_app, precompile_templates
+
+app = create_app()
+precompile_templates(app)